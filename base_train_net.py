@@ -25,7 +25,8 @@ import torchvision.transforms as transforms
 from torch.utils.data.sampler import Sampler
 
 from roi_data_layer.roidb import combined_roidb
-from roi_data_layer.roibatchLoader import roibatchLoader
+from roi_data_layer.packedShards import get_packed_dir
+from roi_data_layer.roibatchLoader import collate_minibatch, load_image_batch, roibatchLoader
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
 from model.utils.net_utils import weights_normal_init, save_net, load_net, \
       adjust_learning_rate, save_checkpoint, clip_gradient
@@ -92,6 +93,12 @@ def parse_args():
     parser.add_argument(
         "--bs", dest="batch_size", help="batch_size", default=1, type=int
     )
+    parser.add_argument(
+        "--packed",
+        dest="packed",
+        help="read images from the shards pack_dataset.py wrote under data/packed",
+        action="store_true",
+    )
     parser.add_argument(
         "--cag",
         dest="class_agnostic",
@@ -426,6 +433,7 @@ if __name__ == "__main__":
     # torch.backends.cudnn.benchmark = True
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    device = torch.device("cuda" if args.cuda else "cpu")
 
     # train set
     # -- Note: Use validation set and disable the flipped to enable faster loading.
@@ -449,6 +457,7 @@ if __name__ == "__main__":
         args.batch_size,
         imdb.num_classes,
         training=True,
+        packed=get_packed_dir(args.imdb_name) if args.packed else None,
     )
     print('dataset: ', type(dataset), len(dataset))
     dataloader = torch.utils.data.DataLoader(
@@ -456,6 +465,7 @@ if __name__ == "__main__":
         batch_size=args.batch_size,
         sampler=sampler_batch,
         num_workers=args.num_workers,
+        collate_fn=collate_minibatch,
     )
     print('dataloader: ', type(dataloader), len(dataloader))
 
@@ -465,13 +475,12 @@ if __name__ == "__main__":
     im_cls_lb = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
-    # ship to cuda
-    if args.cuda:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        im_cls_lb = im_cls_lb.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    im_cls_lb = im_cls_lb.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data)
@@ -541,14 +550,13 @@ if __name__ == "__main__":
     elif args.optimizer == "sgd":
         optimizer = torch.optim.SGD(params, momentum=cfg.TRAIN.MOMENTUM)
 
-    if args.cuda:
-        fasterRCNN.cuda()
+    fasterRCNN.to(device)
 
     if args.resume:
         print(args.resume_name)
         load_name = os.path.join(output_dir, args.resume_name)
         print("loading checkpoint %s" % (load_name))
-        checkpoint = torch.load(load_name)
+        checkpoint = torch.load(load_name, map_location=device)
         args.session = checkpoint["session"]
         args.start_epoch = checkpoint["epoch"]
         fasterRCNN.load_state_dict(checkpoint["model"])
@@ -580,7 +588,7 @@ if __name__ == "__main__":
             # eta = 1.0
             count_iter += 1
             # put source data into variable
-            im_data.data.resize_(data[0].size()).copy_(data[0])
+            load_image_batch(im_data.data, data[0])
             im_info.data.resize_(data[1].size()).copy_(data[1])
             # im_cls_lb.data.resize_(data[2].size()).copy_(data[2])
             gt_boxes.data.resize_(data[2].size()).copy_(data[2])
@@ -32,10 +32,11 @@ from model.utils.net_utils import (
     save_net,
     weights_normal_init,
 )
-from roi_da_data_layer.roibatchLoader import roibatchLoader
+from roi_da_data_layer.pairedBatchLoader import pairedBatchLoader
+from roi_data_layer.packedShards import get_packed_dir
+from roi_da_data_layer.roibatchLoader import load_image_batch, roibatchLoader
 from roi_da_data_layer.roidb import combined_roidb
 from torch.autograd import Variable
-from torch.utils.data.sampler import Sampler
 from tensorboardX import SummaryWriter
 from datetime import datetime
 
@@ -86,6 +87,13 @@ def parse_args():
         default=0,
         type=int,
     )
+    parser.add_argument(
+        "--prefetch",
+        dest="prefetch",
+        help="number of source/target steps to load ahead",
+        default=2,
+        type=int,
+    )
     parser.add_argument(
         "--cuda", dest="cuda", help="whether use CUDA", action="store_true"
     )
@@ -98,6 +106,12 @@ def parse_args():
     parser.add_argument(
         "--bs", dest="batch_size", help="batch_size", default=1, type=int
     )
+    parser.add_argument(
+        "--packed",
+        dest="packed",
+        help="read images from the shards pack_dataset.py wrote under data/packed",
+        action="store_true",
+    )
     parser.add_argument(
         "--cag",
         dest="class_agnostic",
@@ -229,6 +243,28 @@ def parse_args():
         "--da_weight", dest="da_weight", help="da_weight", default=1.0, type=float
     )
 
+    parser.add_argument(
+        "--joint",
+        dest="joint",
+        help="run source and target images through the backbone as one batch",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--t_imdbs",
+        dest="t_imdbs",
+        help="comma separated target imdbs, each one a separate target domain",
+        default=None,
+        type=str,
+    )
+
+    parser.add_argument(
+        "--domain_heads",
+        dest="domain_heads",
+        help="give every target domain its own discriminator head",
+        action="store_true",
+    )
+
     parser.add_argument(
         "--use_tensorboard",
         dest="use_tensorboard",
@@ -248,36 +284,6 @@ def parse_args():
     return args
 
 
-class sampler(Sampler):
-    def __init__(self, train_size, batch_size):
-        self.num_data = train_size
-        self.num_per_batch = int(train_size / batch_size)
-        self.batch_size = batch_size
-        self.range = torch.arange(0, batch_size).view(1, batch_size).long()
-        self.leftover_flag = False
-        if train_size % batch_size:
-            self.leftover = torch.arange(
-                self.num_per_batch * batch_size, train_size
-            ).long()
-            self.leftover_flag = True
-
-    def __iter__(self):
-        rand_num = torch.randperm(self.num_per_batch).view(-1, 1) * self.batch_size
-        self.rand_num = (
-            rand_num.expand(self.num_per_batch, self.batch_size) + self.range
-        )
-
-        self.rand_num_view = self.rand_num.view(-1)
-
-        if self.leftover_flag:
-            self.rand_num_view = torch.cat((self.rand_num_view, self.leftover), 0)
-
-        return iter(self.rand_num_view)
-
-    def __len__(self):
-        return self.num_data
-
-
 if __name__ == "__main__":
 
     args = parse_args()
@@ -388,6 +394,23 @@ if __name__ == "__main__":
             "30",
         ]
 
+    elif args.dataset == "itri_nthu_cities":
+        print("Loading ITRI dataset as source domain and the NTHU cities as target domains...")
+        args.s_imdb_name = "itri_train"
+        args.t_imdb_name = (
+            "nthu_Tokyo_train,nthu_Taipei_train,nthu_Rio_train,nthu_Rome_train"
+        )
+        args.s_imdbtest_name = "itri_test"
+        args.t_imdbtest_name = "nthu_Tokyo_test"
+        args.set_cfgs = [
+            "ANCHOR_SCALES",
+            "[8,16,32]",
+            "ANCHOR_RATIOS",
+            "[0.5,1,2]",
+            "MAX_NUM_GT_BOXES",
+            "30",
+        ]
+
 
     args.cfg_file = (
         "cfgs/{}_ls.yml".format(args.net)
@@ -407,6 +430,7 @@ if __name__ == "__main__":
     # torch.backends.cudnn.benchmark = True
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    device = torch.device("cuda" if args.cuda else "cpu")
 
     # train set
     # -- Note: Use validation set and disable the flipped to enable faster loading.
@@ -416,19 +440,22 @@ if __name__ == "__main__":
     s_imdb, s_roidb, s_ratio_list, s_ratio_index = combined_roidb(args.s_imdb_name)
     s_train_size = len(s_roidb)  # add flipped         image_index*2
 
-    t_imdb, t_roidb, t_ratio_list, t_ratio_index = combined_roidb(args.t_imdb_name)
-    t_train_size = len(t_roidb)  # add flipped         image_index*2
+    # "," separates target domains, "+" still merges imdbs into one domain
+    t_imdb_names = (args.t_imdbs or args.t_imdb_name).split(",")
+    multi_target = len(t_imdb_names) > 1
+    t_roidbs = [combined_roidb(name) for name in t_imdb_names]
 
-    print("source {:d} target {:d} roidb entries".format(len(s_roidb), len(t_roidb)))
+    print(
+        "source {:d} target {} roidb entries".format(
+            len(s_roidb), [len(t_roidb) for _, t_roidb, _, _ in t_roidbs]
+        )
+    )
 
     # output_dir = args.save_dir + "/" + args.net + "/" + args.dataset
     output_dir = args.save_dir
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    s_sampler_batch = sampler(s_train_size, args.batch_size)
-    t_sampler_batch = sampler(t_train_size, args.batch_size)
-
     dataset_s = roibatchLoader(
         s_roidb,
         s_ratio_list,
@@ -436,27 +463,31 @@ if __name__ == "__main__":
         args.batch_size,
         s_imdb.num_classes,
         training=True,
-    )
-
-    dataloader_s = torch.utils.data.DataLoader(
+        packed=get_packed_dir(args.s_imdb_name) if args.packed else None,
+    )
+
+    datasets_t = [
+        roibatchLoader(
+            t_roidb,
+            t_ratio_list,
+            t_ratio_index,
+            args.batch_size,
+            t_imdb.num_classes,
+            training=True,
+            packed=get_packed_dir(name) if args.packed else None,
+        )
+        for name, (t_imdb, t_roidb, t_ratio_list, t_ratio_index) in zip(
+            t_imdb_names, t_roidbs
+        )
+    ]
+    paired_loader = pairedBatchLoader(
         dataset_s,
-        batch_size=args.batch_size,
-        sampler=s_sampler_batch,
-        num_workers=args.num_workers,
-    )
-    dataset_t = roibatchLoader(
-        t_roidb,
-        t_ratio_list,
-        t_ratio_index,
+        datasets_t if multi_target else datasets_t[0],
         args.batch_size,
-        t_imdb.num_classes,
-        training=True,
-    )
-    dataloader_t = torch.utils.data.DataLoader(
-        dataset_t,
-        batch_size=args.batch_size,
-        sampler=t_sampler_batch,
         num_workers=args.num_workers,
+        prefetch=args.prefetch,
+        seed=cfg.RNG_SEED,
+        pin_memory=args.cuda,
     )
     # initilize the tensor holder here.
     im_data = torch.FloatTensor(1)
@@ -464,13 +495,14 @@ if __name__ == "__main__":
     im_cls_lb = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
-    # ship to cuda
-    if args.cuda:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        im_cls_lb = im_cls_lb.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    t_im_data = torch.FloatTensor(1)
+    # ship to the device
+    im_data = im_data.to(device)
+    t_im_data = t_im_data.to(device)
+    im_info = im_info.to(device)
+    im_cls_lb = im_cls_lb.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data)
@@ -478,6 +510,11 @@ if __name__ == "__main__":
     im_cls_lb = Variable(im_cls_lb)
     num_boxes = Variable(num_boxes)
     gt_boxes = Variable(gt_boxes)
+    t_im_data = Variable(t_im_data)
+    # one holder per target domain, the first one is t_im_data
+    t_im_data_list = [t_im_data] + [
+        Variable(torch.FloatTensor(1).to(device)) for _ in t_imdb_names[1:]
+    ]
     if args.cuda:
         cfg.CUDA = True
 
@@ -493,6 +530,7 @@ if __name__ == "__main__":
             class_agnostic=args.class_agnostic,
             lc=args.lc,
             gc=args.gc,
+            num_domain_heads=len(t_imdb_names) if args.domain_heads else 1,
 #            da_use_contex=args.da_use_contex,
         )
 
@@ -505,6 +543,7 @@ if __name__ == "__main__":
             class_agnostic=args.class_agnostic,
             lc=args.lc,
             gc=args.gc,
+            num_domain_heads=len(t_imdb_names) if args.domain_heads else 1,
 #            da_use_contex=args.da_use_contex,
         )
 
@@ -546,14 +585,13 @@ if __name__ == "__main__":
     elif args.optimizer == "sgd":
         optimizer = torch.optim.SGD(params, momentum=cfg.TRAIN.MOMENTUM)
 
-    if args.cuda:
-        fasterRCNN.cuda()
+    fasterRCNN.to(device)
 
     if args.resume:
         print(args.resume_name)
         load_name = os.path.join(output_dir, args.resume_name)
         print("loading checkpoint %s" % (load_name))
-        checkpoint = torch.load(load_name)
+        checkpoint = torch.load(load_name, map_location=device)
         args.session = checkpoint["session"]
         args.start_epoch = checkpoint["epoch"]
         fasterRCNN.load_state_dict(checkpoint["model"])
@@ -561,6 +599,8 @@ if __name__ == "__main__":
         lr = optimizer.param_groups[0]["lr"]
         if "pooling_mode" in checkpoint.keys():
             cfg.POOLING_MODE = checkpoint["pooling_mode"]
+        if "loader" in checkpoint.keys():
+            paired_loader.load_state_dict(checkpoint["loader"])
         print("loaded checkpoint %s" % (load_name))
 
     iters_per_epoch = int(10000 / args.batch_size)
@@ -579,50 +619,79 @@ if __name__ == "__main__":
             adjust_learning_rate(optimizer, args.lr_decay_gamma)
             lr *= args.lr_decay_gamma
 
-        data_iter_s = iter(dataloader_s)
-        data_iter_t = iter(dataloader_t)
         for step in range(iters_per_epoch):
-            try:
-                data_s = next(data_iter_s)
-            except:
-                data_iter_s = iter(dataloader_s)
-                data_s = next(data_iter_s)
-            try:
-                data_t = next(data_iter_t)
-            except:
-                data_iter_t = iter(dataloader_t)
-                data_t = next(data_iter_t)
+            data_s, data_t = next(paired_loader)
             # eta = 1.0
             count_iter += 1
             # put source data into variable
-            im_data.data.resize_(data_s[0].size()).copy_(data_s[0])
+            load_image_batch(im_data.data, data_s[0])
             im_info.data.resize_(data_s[1].size()).copy_(data_s[1])
             im_cls_lb.data.resize_(data_s[2].size()).copy_(data_s[2])
             gt_boxes.data.resize_(data_s[3].size()).copy_(data_s[3])
             num_boxes.data.resize_(data_s[4].size()).copy_(data_s[4])
 
             fasterRCNN.zero_grad()
-            (
-                rois,
-                cls_prob,
-                bbox_pred,
-                category_loss_cls,
-                rpn_loss_cls,
-                rpn_loss_box,
-                RCNN_loss_cls,
-                RCNN_loss_bbox,
-                rois_label,
-                out_d_pixel,
-                out_d,
-#                source_ins_da,
-            ) = fasterRCNN(
-                im_data,
-                im_info,
-                im_cls_lb,
-                gt_boxes,
-                num_boxes,
-#                weight_value=args.da_weight,
-            )
+            if multi_target:
+                for holder, batch in zip(t_im_data_list, data_t):
+                    load_image_batch(holder.data, batch[0])
+                (
+                    rois,
+                    cls_prob,
+                    bbox_pred,
+                    category_loss_cls,
+                    rpn_loss_cls,
+                    rpn_loss_box,
+                    RCNN_loss_cls,
+                    RCNN_loss_bbox,
+                    rois_label,
+                    out_d_pixel,
+                    out_d,
+                    out_d_pixel_t,
+                    out_d_t,
+                ) = fasterRCNN.forward_multi_target(
+                    im_data, im_info, im_cls_lb, gt_boxes, num_boxes, t_im_data_list,
+                )
+            elif args.joint:
+                load_image_batch(t_im_data.data, data_t[0])
+                (
+                    rois,
+                    cls_prob,
+                    bbox_pred,
+                    category_loss_cls,
+                    rpn_loss_cls,
+                    rpn_loss_box,
+                    RCNN_loss_cls,
+                    RCNN_loss_bbox,
+                    rois_label,
+                    out_d_pixel,
+                    out_d,
+                    out_d_pixel_t,
+                    out_d_t,
+                ) = fasterRCNN.forward_joint(
+                    im_data, im_info, im_cls_lb, gt_boxes, num_boxes, t_im_data,
+                )
+            else:
+                (
+                    rois,
+                    cls_prob,
+                    bbox_pred,
+                    category_loss_cls,
+                    rpn_loss_cls,
+                    rpn_loss_box,
+                    RCNN_loss_cls,
+                    RCNN_loss_bbox,
+                    rois_label,
+                    out_d_pixel,
+                    out_d,
+#                    source_ins_da,
+                ) = fasterRCNN(
+                    im_data,
+                    im_info,
+                    im_cls_lb,
+                    gt_boxes,
+                    num_boxes,
+#                    weight_value=args.da_weight,
+                )
             loss = (
                 category_loss_cls.mean()
                 + rpn_loss_cls.mean()
@@ -639,34 +708,46 @@ if __name__ == "__main__":
                 writer.add_scalar("rpn_loss_box", rpn_loss_box.item(), (epoch-1)*iters_per_epoch + step)
                 writer.add_scalar("RCNN_loss_cls", RCNN_loss_cls.item(), (epoch-1)*iters_per_epoch + step)
                 writer.add_scalar("RCNN_loss_bbox", RCNN_loss_bbox.item(), (epoch-1)*iters_per_epoch + step)
-            # domain label
-            domain_s = Variable(torch.zeros(out_d.size(0)).long().cuda())
-            # global alignment loss
-            dloss_s = 0.5 * FL(out_d, domain_s)
+            # the alignment losses are averaged over the discriminator heads
+            if not multi_target:
+                out_d_pixel, out_d = [out_d_pixel], [out_d]
+            # global alignment loss, domain label 0
+            dloss_s = sum(
+                0.5 * FL(d, d.new_zeros(d.size(0), dtype=torch.long)) for d in out_d
+            ) / len(out_d)
             # local alignment loss
-            dloss_s_p = 0.5 * torch.mean(out_d_pixel ** 2)
-
-            # put target data into variable
-            im_data.data.resize_(data_t[0].size()).copy_(data_t[0])
-            im_info.data.resize_(data_t[1].size()).copy_(data_t[1])
-            # gt is empty
-            gt_boxes.data.resize_(1, 1, 5).zero_()
-            num_boxes.data.resize_(1).zero_()
-  #          out_d_pixel, out_d, target_ins_da = fasterRCNN(
-            out_d_pixel, out_d = fasterRCNN(
-                im_data,
-                im_info,
-                im_cls_lb,
-                gt_boxes,
-                num_boxes,
-                target=True,
- #               weight_value=args.da_weight,
-            )
-            # domain label
-            domain_t = Variable(torch.ones(out_d.size(0)).long().cuda())
-            dloss_t = 0.5 * FL(out_d, domain_t)
+            dloss_s_p = sum(
+                0.5 * torch.mean(d_pixel ** 2) for d_pixel in out_d_pixel
+            ) / len(out_d_pixel)
+
+            if not args.joint and not multi_target:
+                # put target data into variable
+                load_image_batch(im_data.data, data_t[0])
+                im_info.data.resize_(data_t[1].size()).copy_(data_t[1])
+                # gt is empty
+                gt_boxes.data.resize_(data_t[0].size(0), 1, 5).zero_()
+                num_boxes.data.resize_(data_t[0].size(0)).zero_()
+      #          out_d_pixel_t, out_d_t, target_ins_da = fasterRCNN(
+                out_d_pixel_t, out_d_t = fasterRCNN(
+                    im_data,
+                    im_info,
+                    im_cls_lb,
+                    gt_boxes,
+                    num_boxes,
+                    target=True,
+     #               weight_value=args.da_weight,
+                )
+            # and over the target domains
+            if not multi_target:
+                out_d_pixel_t, out_d_t = [out_d_pixel_t], [out_d_t]
+            # domain label 1 for every target domain
+            dloss_t = sum(
+                0.5 * FL(d, d.new_ones(d.size(0), dtype=torch.long)) for d in out_d_t
+            ) / len(out_d_t)
             # local alignment loss
-            dloss_t_p = 0.5 * torch.mean((1 - out_d_pixel) ** 2)
+            dloss_t_p = sum(
+                0.5 * torch.mean((1 - d_pixel) ** 2) for d_pixel in out_d_pixel_t
+            ) / len(out_d_pixel_t)
             if args.dataset == "sim10k":
                 loss += (dloss_s + dloss_t + dloss_s_p + dloss_t_p) * args.eta
             else:
@@ -743,7 +824,10 @@ if __name__ == "__main__":
                     "optimizer": optimizer.state_dict(),
                     "pooling_mode": cfg.POOLING_MODE,
                     "class_agnostic": args.class_agnostic,
+                    "loader": paired_loader.state_dict(),
                 },
                 save_name,
             )
             print("save model: {}".format(save_name))
+
+    paired_loader.close()
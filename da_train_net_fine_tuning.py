@@ -31,10 +31,11 @@ from model.utils.net_utils import (
     save_net,
     weights_normal_init,
 )
-from roi_da_data_layer.roibatchLoader import roibatchLoader
+from roi_da_data_layer.pairedBatchLoader import infiniteSampler
+from roi_data_layer.packedShards import get_packed_dir
+from roi_da_data_layer.roibatchLoader import collate_minibatch, load_image_batch, roibatchLoader
 from roi_da_data_layer.roidb import combined_roidb
 from torch.autograd import Variable
-from torch.utils.data.sampler import Sampler
 from tensorboardX import SummaryWriter
 from datetime import datetime
 
@@ -97,6 +98,12 @@ def parse_args():
     parser.add_argument(
         "--bs", dest="batch_size", help="batch_size", default=1, type=int
     )
+    parser.add_argument(
+        "--packed",
+        dest="packed",
+        help="read images from the shards pack_dataset.py wrote under data/packed",
+        action="store_true",
+    )
     parser.add_argument(
         "--cag",
         dest="class_agnostic",
@@ -247,36 +254,6 @@ def parse_args():
     return args
 
 
-class sampler(Sampler):
-    def __init__(self, train_size, batch_size):
-        self.num_data = train_size
-        self.num_per_batch = int(train_size / batch_size)
-        self.batch_size = batch_size
-        self.range = torch.arange(0, batch_size).view(1, batch_size).long()
-        self.leftover_flag = False
-        if train_size % batch_size:
-            self.leftover = torch.arange(
-                self.num_per_batch * batch_size, train_size
-            ).long()
-            self.leftover_flag = True
-
-    def __iter__(self):
-        rand_num = torch.randperm(self.num_per_batch).view(-1, 1) * self.batch_size
-        self.rand_num = (
-            rand_num.expand(self.num_per_batch, self.batch_size) + self.range
-        )
-
-        self.rand_num_view = self.rand_num.view(-1)
-
-        if self.leftover_flag:
-            self.rand_num_view = torch.cat((self.rand_num_view, self.leftover), 0)
-
-        return iter(self.rand_num_view)
-
-    def __len__(self):
-        return self.num_data
-
-
 if __name__ == "__main__":
 
     args = parse_args()
@@ -427,6 +404,7 @@ if __name__ == "__main__":
     # torch.backends.cudnn.benchmark = True
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    device = torch.device("cuda" if args.cuda else "cpu")
 
     # train set
     # -- Note: Use validation set and disable the flipped to enable faster loading.
@@ -441,7 +419,7 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    s_sampler_batch = sampler(s_train_size, args.batch_size)
+    s_sampler_batch = infiniteSampler(s_train_size, args.batch_size, cfg.RNG_SEED)
 
     dataset_s = roibatchLoader(
         s_roidb,
@@ -450,6 +428,7 @@ if __name__ == "__main__":
         args.batch_size,
         s_imdb.num_classes,
         training=True,
+        packed=get_packed_dir(args.s_imdb_name) if args.packed else None,
     )
     print('dataset_s: ', type(dataset_s), len(dataset_s))
     dataloader_s = torch.utils.data.DataLoader(
@@ -457,6 +436,8 @@ if __name__ == "__main__":
         batch_size=args.batch_size,
         sampler=s_sampler_batch,
         num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        collate_fn=collate_minibatch,
     )
     print('dataloader_s: ', type(dataloader_s), len(dataloader_s))
 
@@ -466,13 +447,12 @@ if __name__ == "__main__":
     im_cls_lb = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
-    # ship to cuda
-    if args.cuda:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        im_cls_lb = im_cls_lb.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    im_cls_lb = im_cls_lb.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data)
@@ -548,14 +528,13 @@ if __name__ == "__main__":
     elif args.optimizer == "sgd":
         optimizer = torch.optim.SGD(params, momentum=cfg.TRAIN.MOMENTUM)
 
-    if args.cuda:
-        fasterRCNN.cuda()
+    fasterRCNN.to(device)
 
     if args.resume or True:
         print(args.resume_name)
         load_name = os.path.join(output_dir, args.resume_name)
         print("loading checkpoint %s" % (load_name))
-        checkpoint = torch.load(load_name)
+        checkpoint = torch.load(load_name, map_location=device)
         args.session = checkpoint["session"]
         args.start_epoch = checkpoint["epoch"]
         fasterRCNN.load_state_dict(checkpoint["model"])
@@ -564,6 +543,8 @@ if __name__ == "__main__":
         lr = args.lr
         if "pooling_mode" in checkpoint.keys():
             cfg.POOLING_MODE = checkpoint["pooling_mode"]
+        if args.resume and "loader" in checkpoint.keys():
+            s_sampler_batch.start = checkpoint["loader"]["source"]
         print("loaded checkpoint %s" % (load_name))
 
     iters_per_epoch = int(10000 / args.batch_size)
@@ -573,6 +554,8 @@ if __name__ == "__main__":
         FL = FocalLoss(class_num=2, gamma=args.gamma)
 
     count_iter = 0
+    # the sampler never runs out, so the workers are started only once
+    data_iter_s = iter(dataloader_s)
     for epoch in range(args.start_epoch, args.max_epochs + 1):
         # setting to train mode
         fasterRCNN.train()
@@ -582,14 +565,9 @@ if __name__ == "__main__":
             adjust_learning_rate(optimizer, args.lr_decay_gamma)
             lr *= args.lr_decay_gamma
 
-        data_iter_s = iter(dataloader_s)
         # data_iter_t = iter(dataloader_t)
         for step in range(iters_per_epoch):
-            try:
-                data_s = next(data_iter_s)
-            except:
-                data_iter_s = iter(dataloader_s)
-                data_s = next(data_iter_s)
+            data_s = next(data_iter_s)
             # try:
             #     data_t = next(data_iter_t)
             # except:
@@ -598,7 +576,7 @@ if __name__ == "__main__":
             # eta = 1.0
             count_iter += 1
             # put source data into variable
-            im_data.data.resize_(data_s[0].size()).copy_(data_s[0])
+            load_image_batch(im_data.data, data_s[0])
             im_info.data.resize_(data_s[1].size()).copy_(data_s[1])
             im_cls_lb.data.resize_(data_s[2].size()).copy_(data_s[2])
             gt_boxes.data.resize_(data_s[3].size()).copy_(data_s[3])
@@ -643,7 +621,7 @@ if __name__ == "__main__":
                 writer.add_scalar("RCNN_loss_cls", RCNN_loss_cls.item(), (epoch-1)*iters_per_epoch + step)
                 writer.add_scalar("RCNN_loss_bbox", RCNN_loss_bbox.item(), (epoch-1)*iters_per_epoch + step)
             # domain label
-            # domain_s = Variable(torch.zeros(out_d.size(0)).long().cuda())
+            # domain_s = Variable(out_d.new_zeros(out_d.size(0), dtype=torch.long))
             # # global alignment loss
             # dloss_s = 0.5 * FL(out_d, domain_s)
             # # local alignment loss
@@ -666,7 +644,7 @@ if __name__ == "__main__":
             #     weight_value=args.da_weight,
             # )
             # # domain label
-            # domain_t = Variable(torch.ones(out_d.size(0)).long().cuda())
+            # domain_t = Variable(out_d.new_ones(out_d.size(0), dtype=torch.long))
             # dloss_t = 0.5 * FL(out_d, domain_t)
             # # local alignment loss
             # dloss_t_p = 0.5 * torch.mean((1 - out_d_pixel) ** 2)
@@ -748,6 +726,10 @@ if __name__ == "__main__":
                     "optimizer": optimizer.state_dict(),
                     "pooling_mode": cfg.POOLING_MODE,
                     "class_agnostic": args.class_agnostic,
+                    "loader": {
+                        "source": s_sampler_batch.start
+                        + count_iter * args.batch_size
+                    },
                 },
                 save_name,
             )
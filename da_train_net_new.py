@@ -31,10 +31,11 @@ from model.utils.net_utils import (
     save_net,
     weights_normal_init,
 )
-from roi_da_data_layer.roibatchLoader import roibatchLoader
+from roi_da_data_layer.pairedBatchLoader import pairedBatchLoader
+from roi_data_layer.packedShards import get_packed_dir
+from roi_da_data_layer.roibatchLoader import load_image_batch, roibatchLoader
 from roi_da_data_layer.roidb import combined_roidb
 from torch.autograd import Variable
-from torch.utils.data.sampler import Sampler
 from tensorboardX import SummaryWriter
 from datetime import datetime
 
@@ -85,6 +86,13 @@ def parse_args():
         default=0,
         type=int,
     )
+    parser.add_argument(
+        "--prefetch",
+        dest="prefetch",
+        help="number of source/target steps to load ahead",
+        default=2,
+        type=int,
+    )
     parser.add_argument(
         "--cuda", dest="cuda", help="whether use CUDA", action="store_true"
     )
@@ -97,6 +105,12 @@ def parse_args():
     parser.add_argument(
         "--bs", dest="batch_size", help="batch_size", default=1, type=int
     )
+    parser.add_argument(
+        "--packed",
+        dest="packed",
+        help="read images from the shards pack_dataset.py wrote under data/packed",
+        action="store_true",
+    )
     parser.add_argument(
         "--cag",
         dest="class_agnostic",
@@ -247,36 +261,6 @@ def parse_args():
     return args
 
 
-class sampler(Sampler):
-    def __init__(self, train_size, batch_size):
-        self.num_data = train_size
-        self.num_per_batch = int(train_size / batch_size)
-        self.batch_size = batch_size
-        self.range = torch.arange(0, batch_size).view(1, batch_size).long()
-        self.leftover_flag = False
-        if train_size % batch_size:
-            self.leftover = torch.arange(
-                self.num_per_batch * batch_size, train_size
-            ).long()
-            self.leftover_flag = True
-
-    def __iter__(self):
-        rand_num = torch.randperm(self.num_per_batch).view(-1, 1) * self.batch_size
-        self.rand_num = (
-            rand_num.expand(self.num_per_batch, self.batch_size) + self.range
-        )
-
-        self.rand_num_view = self.rand_num.view(-1)
-
-        if self.leftover_flag:
-            self.rand_num_view = torch.cat((self.rand_num_view, self.leftover), 0)
-
-        return iter(self.rand_num_view)
-
-    def __len__(self):
-        return self.num_data
-
-
 if __name__ == "__main__":
 
     args = parse_args()
@@ -405,6 +389,7 @@ if __name__ == "__main__":
     # torch.backends.cudnn.benchmark = True
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    device = torch.device("cuda" if args.cuda else "cpu")
 
     # train set
     # -- Note: Use validation set and disable the flipped to enable faster loading.
@@ -427,9 +412,6 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    s_sampler_batch = sampler(s_train_size, args.batch_size)
-    t_sampler_batch = sampler(t_train_size, args.batch_size)
-
     dataset_s = roibatchLoader(
         s_roidb,
         s_ratio_list,
@@ -437,15 +419,9 @@ if __name__ == "__main__":
         args.batch_size,
         s_imdb.num_classes,
         training=True,
+        packed=get_packed_dir(args.s_imdb_name) if args.packed else None,
     )
     print('dataset_s: ', type(dataset_s), len(dataset_s))
-    dataloader_s = torch.utils.data.DataLoader(
-        dataset_s,
-        batch_size=args.batch_size,
-        sampler=s_sampler_batch,
-        num_workers=args.num_workers,
-    )
-    print('dataloader_s: ', type(dataloader_s), len(dataloader_s))
     dataset_t = roibatchLoader(
         t_roidb,
         t_ratio_list,
@@ -453,15 +429,18 @@ if __name__ == "__main__":
         args.batch_size,
         t_imdb.num_classes,
         training=True,
+        packed=get_packed_dir(args.t_imdb_name) if args.packed else None,
     )
     print('dataset_t: ', type(dataset_t), len(dataset_t))
-    dataloader_t = torch.utils.data.DataLoader(
+    paired_loader = pairedBatchLoader(
+        dataset_s,
         dataset_t,
-        batch_size=args.batch_size,
-        sampler=t_sampler_batch,
+        args.batch_size,
         num_workers=args.num_workers,
+        prefetch=args.prefetch,
+        seed=cfg.RNG_SEED,
+        pin_memory=args.cuda,
     )
-    print('dataloader_t: ', type(dataloader_t), len(dataloader_t))
 
     # initilize the tensor holder here.
     im_data = torch.FloatTensor(1)
@@ -469,13 +448,12 @@ if __name__ == "__main__":
     im_cls_lb = torch.FloatTensor(1)
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
-    # ship to cuda
-    if args.cuda:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        im_cls_lb = im_cls_lb.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    im_cls_lb = im_cls_lb.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data)
@@ -551,14 +529,13 @@ if __name__ == "__main__":
     elif args.optimizer == "sgd":
         optimizer = torch.optim.SGD(params, momentum=cfg.TRAIN.MOMENTUM)
 
-    if args.cuda:
-        fasterRCNN.cuda()
+    fasterRCNN.to(device)
 
     if args.resume or True:
         print(args.resume_name)
         load_name = os.path.join(output_dir, args.resume_name)
         print("loading checkpoint %s" % (load_name))
-        checkpoint = torch.load(load_name)
+        checkpoint = torch.load(load_name, map_location=device)
         args.session = checkpoint["session"]
         args.start_epoch = checkpoint["epoch"]
         fasterRCNN.load_state_dict(checkpoint["model"])
@@ -566,6 +543,8 @@ if __name__ == "__main__":
         lr = optimizer.param_groups[0]["lr"]
         if "pooling_mode" in checkpoint.keys():
             cfg.POOLING_MODE = checkpoint["pooling_mode"]
+        if "loader" in checkpoint.keys():
+            paired_loader.load_state_dict(checkpoint["loader"])
         print("loaded checkpoint %s" % (load_name))
 
     iters_per_epoch = int(10000 / args.batch_size)
@@ -584,23 +563,12 @@ if __name__ == "__main__":
             adjust_learning_rate(optimizer, args.lr_decay_gamma)
             lr *= args.lr_decay_gamma
 
-        data_iter_s = iter(dataloader_s)
-        data_iter_t = iter(dataloader_t)
         for step in range(iters_per_epoch):
-            try:
-                data_s = next(data_iter_s)
-            except:
-                data_iter_s = iter(dataloader_s)
-                data_s = next(data_iter_s)
-            try:
-                data_t = next(data_iter_t)
-            except:
-                data_iter_t = iter(dataloader_t)
-                data_t = next(data_iter_t)
+            data_s, data_t = next(paired_loader)
             # eta = 1.0
             count_iter += 1
             # put source data into variable
-            im_data.data.resize_(data_s[0].size()).copy_(data_s[0])
+            load_image_batch(im_data.data, data_s[0])
             im_info.data.resize_(data_s[1].size()).copy_(data_s[1])
             im_cls_lb.data.resize_(data_s[2].size()).copy_(data_s[2])
             gt_boxes.data.resize_(data_s[3].size()).copy_(data_s[3])
@@ -645,18 +613,18 @@ if __name__ == "__main__":
                 writer.add_scalar("RCNN_loss_cls", RCNN_loss_cls.item(), (epoch-1)*iters_per_epoch + step)
                 writer.add_scalar("RCNN_loss_bbox", RCNN_loss_bbox.item(), (epoch-1)*iters_per_epoch + step)
             # domain label
-            domain_s = Variable(torch.zeros(out_d.size(0)).long().cuda())
+            domain_s = Variable(out_d.new_zeros(out_d.size(0), dtype=torch.long))
             # global alignment loss
             dloss_s = 0.5 * FL(out_d, domain_s)
             # local alignment loss
             dloss_s_p = 0.5 * torch.mean(out_d_pixel ** 2)
 
             # put target data into variable
-            im_data.data.resize_(data_t[0].size()).copy_(data_t[0])
+            load_image_batch(im_data.data, data_t[0])
             im_info.data.resize_(data_t[1].size()).copy_(data_t[1])
             # gt is empty
-            gt_boxes.data.resize_(1, 1, 5).zero_()
-            num_boxes.data.resize_(1).zero_()
+            gt_boxes.data.resize_(data_t[0].size(0), 1, 5).zero_()
+            num_boxes.data.resize_(data_t[0].size(0)).zero_()
             out_d_pixel, out_d, target_ins_da = fasterRCNN(
             # out_d_pixel, out_d = fasterRCNN(
                 im_data,
@@ -668,7 +636,7 @@ if __name__ == "__main__":
                 weight_value=args.da_weight,
             )
             # domain label
-            domain_t = Variable(torch.ones(out_d.size(0)).long().cuda())
+            domain_t = Variable(out_d.new_ones(out_d.size(0), dtype=torch.long))
             dloss_t = 0.5 * FL(out_d, domain_t)
             # local alignment loss
             dloss_t_p = 0.5 * torch.mean((1 - out_d_pixel) ** 2)
@@ -750,7 +718,10 @@ if __name__ == "__main__":
                     "optimizer": optimizer.state_dict(),
                     "pooling_mode": cfg.POOLING_MODE,
                     "class_agnostic": args.class_agnostic,
+                    "loader": paired_loader.state_dict(),
                 },
                 save_name,
             )
             print("save model: {}".format(save_name))
+
+    paired_loader.close()
@@ -23,8 +23,14 @@ from model.da_faster_rcnn.vgg16 import vgg16
 from model.roi_layers import nms
 from model.rpn.bbox_transform import bbox_transform_inv, clip_boxes
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
-from model.utils.net_utils import load_net, save_net, vis_detections
-from roi_da_data_layer.roibatchLoader import roibatchLoader
+from model.utils.detections import postprocess_detections, split_detections
+from model.utils.net_utils import (
+    load_detection_weights,
+    load_net,
+    save_net,
+    vis_detections,
+)
+from roi_da_data_layer.roibatchLoader import load_image_batch, roibatchLoader
 from roi_da_data_layer.roidb import combined_roidb
 from torch.autograd import Variable
 
@@ -191,6 +197,7 @@ if __name__ == "__main__":
 
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    device = torch.device("cuda" if args.cuda else "cpu")
 
     np.random.seed(cfg.RNG_SEED)
     if args.dataset == "pascal_voc":
@@ -398,10 +405,8 @@ if __name__ == "__main__":
     # print(fasterRCNN.state_dict().keys())
 
     print("load checkpoint %s" % (load_name))
-    checkpoint = torch.load(load_name)
-    fasterRCNN.load_state_dict(
-        {k: v for k, v in checkpoint["model"].items() if k in fasterRCNN.state_dict()}
-    )
+    checkpoint = torch.load(load_name, map_location=device)
+    load_detection_weights(fasterRCNN, checkpoint["model"])
     # fasterRCNN.load_state_dict(checkpoint['model'])
     if "pooling_mode" in checkpoint.keys():
         cfg.POOLING_MODE = checkpoint["pooling_mode"]
@@ -414,13 +419,12 @@ if __name__ == "__main__":
     num_boxes = torch.LongTensor(1)
     gt_boxes = torch.FloatTensor(1)
 
-    # ship to cuda
-    if args.cuda:
-        im_data = im_data.cuda()
-        im_info = im_info.cuda()
-        im_cls_lb = im_cls_lb.cuda()
-        num_boxes = num_boxes.cuda()
-        gt_boxes = gt_boxes.cuda()
+    # ship to the device
+    im_data = im_data.to(device)
+    im_info = im_info.to(device)
+    im_cls_lb = im_cls_lb.to(device)
+    num_boxes = num_boxes.to(device)
+    gt_boxes = gt_boxes.to(device)
 
     # make variable
     im_data = Variable(im_data)
@@ -432,8 +436,10 @@ if __name__ == "__main__":
     if args.cuda:
         cfg.CUDA = True
 
-    if args.cuda:
-        fasterRCNN.cuda()
+    fasterRCNN.to(device)
+    # regression target statistics, created once on the device
+    box_stds = torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).to(device)
+    box_means = torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).to(device)
 
     start = time.time()
     max_per_image = 100
@@ -469,11 +475,11 @@ if __name__ == "__main__":
     det_file = os.path.join(output_dir, "detections.pkl")
 
     fasterRCNN.eval()
-    empty_array = np.transpose(np.array([[], [], [], [], []]), (1, 0))
+    fasterRCNN.RCNN_rpn.precompute_roidb_anchors(roidb, im_data.data)
     for i in range(num_images):
 
         data = next(data_iter)
-        im_data.data.resize_(data[0].size()).copy_(data[0])
+        load_image_batch(im_data.data, data[0])
         im_info.data.resize_(data[1].size()).copy_(data[1])
         im_cls_lb.data.resize_(data[2].size()).copy_(data[2])
         gt_boxes.data.resize_(data[3].size()).copy_(data[3])
@@ -482,19 +488,7 @@ if __name__ == "__main__":
         det_tic = time.time()
 
         with torch.no_grad():
-            (
-                rois,
-                cls_prob,
-                bbox_pred,
-                category_cls_loss,
-                rpn_loss_cls,
-                rpn_loss_box,
-                RCNN_loss_cls,
-                RCNN_loss_bbox,
-                rois_label,
-                d_pixel,
-                domain_p,
-            ) = fasterRCNN(im_data, im_info, im_cls_lb, gt_boxes, num_boxes)
+            rois, cls_prob, bbox_pred = fasterRCNN.detect(im_data, im_info)
 
         scores = cls_prob.data
         boxes = rois.data[:, :, 1:5]
@@ -505,18 +499,10 @@ if __name__ == "__main__":
             if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
                 # Optionally normalize targets by a precomputed mean and stdev
                 if args.class_agnostic:
-                    box_deltas = (
-                        box_deltas.view(-1, 4)
-                        * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda()
-                        + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    )
+                    box_deltas = box_deltas.view(-1, 4) * box_stds + box_means
                     box_deltas = box_deltas.view(1, -1, 4)
                 else:
-                    box_deltas = (
-                        box_deltas.view(-1, 4)
-                        * torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS).cuda()
-                        + torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS).cuda()
-                    )
+                    box_deltas = box_deltas.view(-1, 4) * box_stds + box_means
                     box_deltas = box_deltas.view(1, -1, 4 * len(imdb.classes))
 
             pred_boxes = bbox_transform_inv(boxes, box_deltas, 1)
@@ -535,41 +521,14 @@ if __name__ == "__main__":
         if vis:
             im = cv2.imread(imdb.image_path_at(i))
             im2show = np.copy(im)
+        dets, labels = postprocess_detections(
+            scores, pred_boxes, thresh, cfg.TEST.NMS, max_per_image, args.class_agnostic
+        )
+        class_dets = split_detections(dets, labels, imdb.num_classes)
         for j in xrange(1, imdb.num_classes):
-            inds = torch.nonzero(scores[:, j] > thresh).view(-1)
-            # if there is det
-            if inds.numel() > 0:
-                cls_scores = scores[:, j][inds]
-                _, order = torch.sort(cls_scores, 0, True)
-                if args.class_agnostic:
-                    cls_boxes = pred_boxes[inds, :]
-                else:
-                    cls_boxes = pred_boxes[inds][:, j * 4 : (j + 1) * 4]
-
-                cls_dets = torch.cat((cls_boxes, cls_scores.unsqueeze(1)), 1)
-                # cls_dets = torch.cat((cls_boxes, cls_scores), 1)
-                cls_dets = cls_dets[order]
-                # keep = nms(cls_dets, cfg.TEST.NMS)
-                keep = nms(cls_boxes[order, :], cls_scores[order], cfg.TEST.NMS)
-                cls_dets = cls_dets[keep.view(-1).long()]
-                if vis:
-                    im2show = vis_detections(
-                        im2show, imdb.classes[j], cls_dets.cpu().numpy(), 0.3
-                    )
-                all_boxes[j][i] = cls_dets.cpu().numpy()
-            else:
-                all_boxes[j][i] = empty_array
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack(
-                [all_boxes[j][i][:, -1] for j in xrange(1, imdb.num_classes)]
-            )
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
+            all_boxes[j][i] = class_dets[j]
+            if vis and len(class_dets[j]) > 0:
+                im2show = vis_detections(im2show, imdb.classes[j], class_dets[j], 0.3)
 
         misc_toc = time.time()
         nms_time = misc_toc - misc_tic
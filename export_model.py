@@ -0,0 +1,63 @@
+# --------------------------------------------------------
+# Strip the training-only weights from a DA checkpoint
+# --------------------------------------------------------
+"""Write a detection-only copy of a checkpoint saved by the train scripts.
+
+The optimizer and loader state, the category classifier, the instance
+discriminator and the image discriminators whose context vectors are not used
+(--lc / --gc, as in training) are dropped. eval/test_SW_ICR_CCR.py loads the
+result like a full checkpoint.
+
+    python export_model.py --load models/vgg16/cityscape/model.pth \
+        --out models/vgg16/cityscape/model_deploy.pth --lc --gc
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+
+import _init_paths
+import torch
+from model.utils.net_utils import strip_training_weights
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a detection checkpoint")
+    parser.add_argument(
+        "--load",
+        dest="load_name",
+        help="checkpoint to export",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "--out", dest="out_name", help="exported checkpoint", required=True, type=str
+    )
+    parser.add_argument(
+        "--lc",
+        dest="lc",
+        help="whether use context vector for pixel level",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--gc",
+        dest="gc",
+        help="whether use context vector for global level",
+        action="store_true",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    checkpoint = torch.load(args.load_name, map_location="cpu")
+    model = strip_training_weights(checkpoint["model"], args.lc, args.gc)
+    exported = {"model": model}
+    for key in ("pooling_mode", "class_agnostic", "epoch"):
+        if key in checkpoint:
+            exported[key] = checkpoint[key]
+    torch.save(exported, args.out_name)
+    print(
+        "Kept {} of {} weights in {}".format(
+            len(model), len(checkpoint["model"]), args.out_name
+        )
+    )
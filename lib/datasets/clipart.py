@@ -18,7 +18,7 @@ from model.utils.config import cfg
 from . import ds_utils
 from .config_dataset import cfg_d
 from .imdb import ROOT_DIR, imdb
-from .voc_eval import voc_eval
+from .voc_eval import get_voc_record, voc_eval
 
 # --------------------------------------------------------
 # Fast R-CNN
@@ -149,19 +149,15 @@ class clipart(imdb):
         Return the database of ground-truth regions of interest.
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = os.path.join(self.cache_path, self.name + "_gt_roidb.pkl")
-        if os.path.exists(cache_file):
-            with open(cache_file, "rb") as fid:
-                roidb = pickle.load(fid)  # ,encoding='latin1')
-            print("{} gt roidb loaded from {}".format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_pascal_annotation(index) for index in self.image_index]
-        with open(cache_file, "wb") as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print("wrote gt roidb to {}".format(cache_file))
+        return self._cached_gt_roidb(
+            self._load_pascal_annotation, load_records=self._load_voc_records
+        )
 
-        return gt_roidb
+    def _annotation_files(self):
+        return [
+            os.path.join(self._data_path, "Annotations", index + ".xml")
+            for index in self.image_index
+        ]
 
     def selective_search_roidb(self):
         """
@@ -229,14 +225,14 @@ class clipart(imdb):
 
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-    def _load_pascal_annotation(self, index):
+    def _load_pascal_annotation(self, index, records=None):
         """
         Load image and bounding boxes info from XML file in the PASCAL VOC
         format.
         """
         filename = os.path.join(self._data_path, "Annotations", index + ".xml")
-        tree = ET.parse(filename)
-        objs = tree.findall("object")
+        record = get_voc_record(filename, records)
+        objs = record["objects"]
         # if not self.config['use_diff']:
         #     # Exclude the samples labeled as difficult
         #     non_diff_objs = [
@@ -256,18 +252,17 @@ class clipart(imdb):
 
         # Load object bounding boxes into a data frame.
         for ix, obj in enumerate(objs):
-            bbox = obj.find("bndbox")
+            bbox = obj["bbox"]
             # Make pixel indexes 0-based
-            x1 = float(bbox.find("xmin").text) - 1
-            y1 = float(bbox.find("ymin").text) - 1
-            x2 = float(bbox.find("xmax").text) - 1
-            y2 = float(bbox.find("ymax").text) - 1
+            x1 = bbox[0] - 1
+            y1 = bbox[1] - 1
+            x2 = bbox[2] - 1
+            y2 = bbox[3] - 1
 
-            diffc = obj.find("difficult")
-            difficult = 0 if diffc == None else int(diffc.text)
+            difficult = obj["difficult"] or 0
             ishards[ix] = difficult
 
-            cls = self._class_to_ind[obj.find("name").text.lower().strip()]
+            cls = self._class_to_ind[obj["name"].lower().strip()]
             boxes[ix, :] = [x1, y1, x2, y2]
             gt_classes[ix] = cls
             overlaps[ix, cls] = 1.0
@@ -389,6 +384,7 @@ class clipart(imdb):
                 cachedir,
                 ovthresh=0.5,
                 use_07_metric=use_07_metric,
+                records_file=self._voc_records_file(),
             )
             aps += [ap]
             print("AP for {} = {:.4f}".format(cls, ap))
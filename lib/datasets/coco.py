@@ -116,19 +116,10 @@ class coco(imdb):
     Return the database of ground-truth regions of interest.
     This function loads/saves from/to a cache file to speed up future calls.
     """
-        cache_file = osp.join(self.cache_path, self.name + "_gt_roidb.pkl")
-        if osp.exists(cache_file):
-            with open(cache_file, "rb") as fid:
-                roidb = pickle.load(fid)
-            print("{} gt roidb loaded from {}".format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_coco_annotation(index) for index in self._image_index]
-
-        with open(cache_file, "wb") as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print("wrote gt roidb to {}".format(cache_file))
-        return gt_roidb
+        return self._cached_gt_roidb(self._load_coco_annotation)
+
+    def _annotation_files(self):
+        return [self._get_ann_file()]
 
     def _load_coco_annotation(self, index):
         """
@@ -181,19 +181,15 @@ class imagenet(imdb):
         Return the database of ground-truth regions of interest.
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = os.path.join(self.cache_path, self.name + "_gt_roidb.pkl")
-        if os.path.exists(cache_file):
-            with open(cache_file, "rb") as fid:
-                roidb = pickle.load(fid)
-            print("{} gt roidb loaded from {}".format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_imagenet_annotation(index) for index in self.image_index]
-        with open(cache_file, "wb") as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print("wrote gt roidb to {}".format(cache_file))
-
-        return gt_roidb
+        return self._cached_gt_roidb(self._load_imagenet_annotation)
+
+    def _annotation_files(self):
+        return [
+            os.path.join(
+                self._data_path, "Annotations", self._image_set, index + ".xml"
+            )
+            for index in self.image_index
+        ]
 
     def _load_imagenet_annotation(self, index):
         """
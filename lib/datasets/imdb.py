@@ -6,8 +6,12 @@
 # --------------------------------------------------------
 from __future__ import absolute_import, division, print_function
 
+import hashlib
 import os
 import os.path as osp
+import pickle
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 # from model.utils.cython_bbox import bbox_overlaps
 import numpy as np
@@ -15,8 +19,23 @@ import PIL
 import scipy.sparse
 from model.utils.config import cfg
 
+from .voc_eval import load_voc_records
+
+try:
+    from collections.abc import MutableSequence  # Python 3
+except ImportError:
+    from collections import MutableSequence  # Python 2
+
 ROOT_DIR = osp.join(osp.dirname(__file__), "..", "..")
 
+# bump when the fields an annotation loader returns change
+ROIDB_CACHE_VERSION = 1
+
+
+def _probe_image_size(path):
+    # PIL only parses the header here, the pixels are never decoded
+    return PIL.Image.open(path).size
+
 
 class imdb(object):
     """Image database."""
@@ -106,11 +125,106 @@ class imdb(object):
     """
         raise NotImplementedError
 
+    def _annotation_files(self):
+        """Files the gt roidb is parsed from, used to invalidate its cache."""
+        return []
+
+    def _annotation_signature(self):
+        """Hash of everything the cached gt roidb depends on.
+
+        Besides the image list and the classes, it covers the mtime and size
+        of every annotation file, so editing, adding or removing a file makes
+        the cache stale.
+        """
+        files = self._annotation_files()
+        pool = ThreadPool(cfg.NUM_IO_THREADS)
+        try:
+            stats = pool.map(os.stat, files)
+        finally:
+            pool.close()
+        sha = hashlib.sha1()
+        sha.update(
+            repr((ROIDB_CACHE_VERSION, self.name, self.classes)).encode("utf-8")
+        )
+        sha.update(repr(list(self.image_index)).encode("utf-8"))
+        for f, st in zip(files, stats):
+            sha.update(repr((f, st.st_mtime, st.st_size)).encode("utf-8"))
+        return sha.hexdigest()
+
+    def _voc_records_file(self):
+        """Cache of the parsed xml annotations, shared by gt_roidb and eval."""
+        return osp.join(self.cache_path, self.name + "_voc_records.pkl")
+
+    def _load_voc_records(self, annotation_files):
+        return load_voc_records(annotation_files, self._voc_records_file())
+
+    def _cached_gt_roidb(self, load_annotation, load_records=None):
+        """Return [load_annotation(index) for index in image_index], cached.
+
+        The cache is a <name>_gt_roidb.npz of flat arrays (see
+        _save_roidb_arrays) that loads without unpickling anything. It is
+        rebuilt when _annotation_signature changes. Entries are turned back
+        into dicts only when they are first accessed. When the cache has to be
+        rebuilt, load_records(annotation_files) can parse the files in bulk;
+        load_annotation(index, records) then builds each entry from them.
+        """
+        cache_file = osp.join(self.cache_path, self.name + "_gt_roidb.npz")
+        signature = self._annotation_signature()
+        if osp.exists(cache_file):
+            roidb = _load_roidb_arrays(cache_file, signature)
+            if roidb is not None:
+                print("{} gt roidb loaded from {}".format(self.name, cache_file))
+                return roidb
+            print("{} gt roidb cache is stale, rebuilding".format(self.name))
+
+        if load_records is None:
+            gt_roidb = [load_annotation(index) for index in self.image_index]
+        else:
+            records = load_records(self._annotation_files())
+            gt_roidb = [load_annotation(index, records) for index in self.image_index]
+        if _save_roidb_arrays(cache_file, gt_roidb, signature):
+            print("wrote gt roidb to {}".format(cache_file))
+        return gt_roidb
+
     def _get_widths(self):
-        return [
-            PIL.Image.open(self.image_path_at(i)).size[0]
-            for i in range(self.num_images)
-        ]
+        return [size[0] for size in self._get_sizes()]
+
+    def _get_sizes(self):
+        """(width, height) of every image, read through a persistent index.
+
+        The index maps each image path to its mtime and size and lives next
+        to the roidb caches. Only images that are new or changed since it was
+        written are opened, and those are probed by a pool of threads since
+        the time goes into file system round trips rather than CPU.
+        """
+        paths = [self.image_path_at(i) for i in range(self.num_images)]
+        cache_file = osp.join(self.cache_path, self.name + "_image_sizes.pkl")
+        index = {}
+        if osp.exists(cache_file):
+            with open(cache_file, "rb") as fid:
+                index = pickle.load(fid)
+
+        unique_paths = list(set(paths))
+        pool = ThreadPool(cfg.NUM_IO_THREADS)
+        try:
+            mtimes = dict(zip(unique_paths, pool.map(osp.getmtime, unique_paths)))
+            stale = [p for p in unique_paths if index.get(p, (None,))[0] != mtimes[p]]
+            if stale:
+                sizes = pool.map(_probe_image_size, stale)
+        finally:
+            pool.close()
+
+        if stale:
+            for path, size in zip(stale, sizes):
+                index[path] = (mtimes[path], size)
+            with open(cache_file, "wb") as fid:
+                pickle.dump(index, fid, pickle.HIGHEST_PROTOCOL)
+            print(
+                "probed {} image sizes for {}, index written to {}".format(
+                    len(stale), self.name, cache_file
+                )
+            )
+        return [index[path][1] for path in paths]
 
     def append_flipped_images(self):
         num_images = self.num_images
@@ -273,3 +387,112 @@ class imdb(object):
 
     def competition_mode(self, on):
         """Turn competition mode on or off."""
+
+
+def _save_roidb_arrays(cache_file, roidb, signature):
+    """Write a roidb as flat arrays: per-box fields ("box." and, for sparse
+    matrices, "sparse.") are concatenated over all images and split again by
+    box_offsets; other arrays ("array.", e.g. seg_map) are raveled and
+    concatenated, with their shapes in "shape."; per-image scalars ("image.")
+    are one array each."""
+    columns = {"signature": np.array(signature)}
+    num_boxes = [len(r["boxes"]) for r in roidb]
+    columns["box_offsets"] = np.concatenate([[0], np.cumsum(num_boxes)]).astype(
+        np.int64
+    )
+    for key in roidb[0].keys() if roidb else []:
+        values = [r[key] for r in roidb]
+        per_box = all(
+            getattr(v, "ndim", 0) > 0 and v.shape[0] == n
+            for v, n in zip(values, num_boxes)
+        )
+        if scipy.sparse.issparse(values[0]):
+            kind, column = "sparse", np.concatenate([v.toarray() for v in values])
+        elif isinstance(values[0], np.ndarray) and per_box:
+            kind, column = "box", np.concatenate(values)
+        elif isinstance(values[0], np.ndarray):
+            kind, column = "array", np.concatenate([v.ravel() for v in values])
+            columns["shape." + key] = np.array([v.shape for v in values], np.int64)
+        else:
+            kind, column = "image", np.array(values)
+        if column.dtype == object:
+            # loading it back would need pickle, keep the roidb uncached
+            print("cannot cache the {} field of the gt roidb".format(key))
+            return False
+        columns[kind + "." + key] = column
+
+    # write to a private file first so a crashed job never leaves half a cache
+    fd, tmp_file = tempfile.mkstemp(dir=osp.dirname(cache_file), suffix=".npz")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **columns)
+    os.rename(tmp_file, cache_file)
+    return True
+
+
+def _load_roidb_arrays(cache_file, signature):
+    """Read a roidb written by _save_roidb_arrays, or None if it is stale."""
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            if str(data["signature"]) != signature:
+                return None
+            columns = dict((key, data[key]) for key in data.files)
+    except (IOError, ValueError, KeyError):
+        return None
+    return _lazyRoidb(columns)
+
+
+class _lazyRoidb(MutableSequence):
+    """List of roidb entries that builds each dict on first access."""
+
+    def __init__(self, columns):
+        self._offsets = columns.pop("box_offsets")
+        columns.pop("signature")
+        self._columns = []
+        for name, value in columns.items():
+            kind, key = name.split(".", 1)
+            if kind == "shape":
+                continue
+            if kind == "array":
+                shapes = columns["shape." + key]
+                sizes = np.prod(shapes, axis=1)
+                offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+                value = (value, shapes, offsets)
+            self._columns.append((kind, key, value))
+        # ints are entries not built yet, dicts are built or appended ones
+        self._entries = list(range(len(self._offsets) - 1))
+
+    def _build(self, j):
+        start, end = self._offsets[j], self._offsets[j + 1]
+        entry = {}
+        for kind, key, value in self._columns:
+            if kind == "image":
+                entry[key] = value[j].item()
+            elif kind == "sparse":
+                entry[key] = scipy.sparse.csr_matrix(value[start:end])
+            elif kind == "array":
+                flat, shapes, offsets = value
+                entry[key] = flat[offsets[j] : offsets[j + 1]].reshape(shapes[j])
+            else:
+                entry[key] = value[start:end]
+        return entry
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        entry = self._entries[i]
+        if not isinstance(entry, dict):
+            entry = self._build(entry)
+            self._entries[i] = entry
+        return entry
+
+    def __setitem__(self, i, entry):
+        self._entries[i] = entry
+
+    def __delitem__(self, i):
+        del self._entries[i]
+
+    def insert(self, i, entry):
+        self._entries.insert(i, entry)
+
+    def __len__(self):
+        return len(self._entries)
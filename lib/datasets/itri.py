@@ -4,7 +4,6 @@ import os
 import pickle
 import subprocess
 import uuid
-import xml.etree.ElementTree as ET
 
 # import PIL
 import numpy as np
@@ -15,7 +14,7 @@ from model.utils.config import cfg
 
 from . import ds_utils
 from .imdb import ROOT_DIR, imdb
-from .voc_eval import voc_eval
+from .voc_eval import get_voc_record, voc_eval
 
 try:
     xrange
@@ -131,21 +130,15 @@ class itri(imdb):
 
         This function loads/saves from/to a cache file to speed up future calls.
         """
+        return self._cached_gt_roidb(
+            self._load_pascal_annotation, load_records=self._load_voc_records
+        )
 
-        cache_file = os.path.join(self.cache_path, self.name + "_gt_roidb.pkl")
-        if os.path.exists(cache_file):
-            with open(cache_file, "rb") as fid:
-                roidb = pickle.load(fid)
-            print("{} gt roidb loaded from {}".format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_pascal_annotation(index) for index in self.image_index]
-
-        with open(cache_file, "wb") as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print("wrote gt roidb to {}".format(cache_file))
-
-        return gt_roidb
+    def _annotation_files(self):
+        return [
+            os.path.join(self._data_path, "Annotations", index + ".xml")
+            for index in self.image_index
+        ]
 
     def selective_search_roidb(self):
         """
@@ -214,14 +207,14 @@ class itri(imdb):
 
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-    def _load_pascal_annotation(self, index):
+    def _load_pascal_annotation(self, index, records=None):
         """
         Load image and bounding boxes info from XML file in the PASCAL VOC
         format.
         """
         filename = os.path.join(self._data_path, "Annotations", index + ".xml")
-        tree = ET.parse(filename)
-        objs = tree.findall("object")
+        record = get_voc_record(filename, records)
+        objs = record["objects"]
         # if not self.config['use_diff']:
         #     # Exclude the samples labeled as difficult
         #     non_diff_objs = [
@@ -241,18 +234,17 @@ class itri(imdb):
 
         # Load object bounding boxes into a data frame.
         for ix, obj in enumerate(objs):
-            bbox = obj.find("bndbox")
+            bbox = obj["bbox"]
             # Make pixel indexes 0-based
-            x1 = max(float(bbox.find("xmin").text) - 1, 0)
-            y1 = max(float(bbox.find("ymin").text) - 1, 0)
-            x2 = max(float(bbox.find("xmax").text) - 1, 0)
-            y2 = max(float(bbox.find("ymax").text) - 1, 0)
+            x1 = max(bbox[0] - 1, 0)
+            y1 = max(bbox[1] - 1, 0)
+            x2 = max(bbox[2] - 1, 0)
+            y2 = max(bbox[3] - 1, 0)
 
-            diffc = obj.find("difficult")
-            difficult = 0 if diffc == None else int(diffc.text)
+            difficult = obj["difficult"] or 0
             ishards[ix] = difficult
 
-            cls = self._class_to_ind[obj.find("name").text.lower().strip()]
+            cls = self._class_to_ind[obj["name"].lower().strip()]
             boxes[ix, :] = [x1, y1, x2, y2]
             if boxes[ix, 0] > 2048 or boxes[ix, 1] > 1024:
                 print(boxes[ix, :])
@@ -345,6 +337,7 @@ class itri(imdb):
                 cachedir,
                 ovthresh=0.5,
                 use_07_metric=use_07_metric,
+                records_file=self._voc_records_file(),
             )
             aps += [ap]
             print("AP for {} = {:.4f}".format(cls, ap))
@@ -13,7 +13,6 @@ import pdb
 import pickle
 import subprocess
 import uuid
-import xml.etree.ElementTree as ET
 
 import datasets.ds_utils as ds_utils
 import numpy as np
@@ -22,7 +21,7 @@ import scipy.sparse
 from datasets.imdb import imdb
 from model.utils.config import cfg
 
-from .voc_eval import voc_eval
+from .voc_eval import get_voc_record, voc_eval
 
 
 class pascal_voc(imdb):
@@ -129,22 +128,15 @@ class pascal_voc(imdb):
 
     This function loads/saves from/to a cache file to speed up future calls.
     """
-        cache_file = os.path.join(self.cache_path, self.name + "_gt_roidb.pkl")
-        if os.path.exists(cache_file):
-            with open(cache_file, "rb") as fid:
-                try:
-                    roidb = pickle.load(fid)
-                except:
-                    roidb = pickle.load(fid, encoding="bytes")
-            print("{} gt roidb loaded from {}".format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_pascal_annotation(index) for index in self.image_index]
-        with open(cache_file, "wb") as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print("wrote gt roidb to {}".format(cache_file))
-
-        return gt_roidb
+        return self._cached_gt_roidb(
+            self._load_pascal_annotation, load_records=self._load_voc_records
+        )
+
+    def _annotation_files(self):
+        return [
+            os.path.join(self._data_path, "Annotations", index + ".xml")
+            for index in self.image_index
+        ]
 
     def rpn_roidb(self):
         if int(self._year) == 2007 or self._image_set != "test":
@@ -164,19 +156,17 @@ class pascal_voc(imdb):
             box_list = pickle.load(f)
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-    def _load_pascal_annotation(self, index):
+    def _load_pascal_annotation(self, index, records=None):
         """
     Load image and bounding boxes info from XML file in the PASCAL VOC
     format.
     """
         filename = os.path.join(self._data_path, "Annotations", index + ".xml")
-        tree = ET.parse(filename)
-        objs = tree.findall("object")
+        record = get_voc_record(filename, records)
+        objs = record["objects"]
         if not self.config["use_diff"]:
             # Exclude the samples labeled as difficult
-            non_diff_objs = [
-                obj for obj in objs if int(obj.find("difficult").text) == 0
-            ]
+            non_diff_objs = [obj for obj in objs if obj["difficult"] == 0]
             # if len(non_diff_objs) != len(objs):
             #     print 'Removed {} difficult objects'.format(
             #         len(objs) - len(non_diff_objs))
@@ -191,13 +181,13 @@ class pascal_voc(imdb):
 
         # Load object bounding boxes into a data frame.
         for ix, obj in enumerate(objs):
-            bbox = obj.find("bndbox")
+            bbox = obj["bbox"]
             # Make pixel indexes 0-based
-            x1 = float(bbox.find("xmin").text) - 1
-            y1 = float(bbox.find("ymin").text) - 1
-            x2 = float(bbox.find("xmax").text) - 1
-            y2 = float(bbox.find("ymax").text) - 1
-            cls = self._class_to_ind[obj.find("name").text.lower().strip()]
+            x1 = bbox[0] - 1
+            y1 = bbox[1] - 1
+            x2 = bbox[2] - 1
+            y2 = bbox[3] - 1
+            cls = self._class_to_ind[obj["name"].lower().strip()]
             boxes[ix, :] = [x1, y1, x2, y2]
             gt_classes[ix] = cls
             overlaps[ix, cls] = 1.0
@@ -283,6 +273,7 @@ class pascal_voc(imdb):
                 cachedir,
                 ovthresh=0.5,
                 use_07_metric=use_07_metric,
+                records_file=self._voc_records_file(),
             )
             aps += [ap]
             print(("AP for {} = {:.4f}".format(cls, ap)))
@@ -208,20 +208,10 @@ class vg(imdb):
 
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = os.path.join(self.cache_path, self.name + "_gt_roidb.pkl")
-        if os.path.exists(cache_file):
-            fid = gzip.open(cache_file, "rb")
-            roidb = pickle.load(fid)
-            fid.close()
-            print("{} gt roidb loaded from {}".format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_vg_annotation(index) for index in self.image_index]
-        fid = gzip.open(cache_file, "wb")
-        pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        fid.close()
-        print("wrote gt roidb to {}".format(cache_file))
-        return gt_roidb
+        return self._cached_gt_roidb(self._load_vg_annotation)
+
+    def _annotation_files(self):
+        return [self._annotation_path(index) for index in self.image_index]
 
     def _get_size(self, index):
         return PIL.Image.open(self.image_path_from_index(index)).size
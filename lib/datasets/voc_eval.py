@@ -5,30 +5,124 @@
 # --------------------------------------------------------
 from __future__ import absolute_import, division, print_function
 
+import multiprocessing
 import os
 import pickle
+import tempfile
 import xml.etree.ElementTree as ET
 
 import numpy as np
 
+def _text(elem, tag):
+    child = elem.find(tag)
+    return None if child is None else child.text
 
-def parse_rec(filename):
+
+def read_voc_record(filename):
+    """Compact record of a PASCAL VOC xml file.
+
+    {"size": (width, height) or None, "objects": [...]}, every object a dict
+    of its name, pose, truncated and difficult tags (None when missing) and
+    its bbox as float (xmin, ymin, xmax, ymax).
+    """
+    root = ET.parse(filename).getroot()
+    size = root.find("size")
+    width, height = (None, None) if size is None else (
+        _text(size, "width"),
+        _text(size, "height"),
+    )
+    objects = []
+    for obj in root.findall("object"):
+        bbox = obj.find("bndbox")
+        difficult = _text(obj, "difficult")
+        objects.append(
+            {
+                "name": obj.find("name").text,
+                "pose": _text(obj, "pose"),
+                "truncated": _text(obj, "truncated"),
+                "difficult": None if difficult is None else int(difficult),
+                "bbox": tuple(
+                    float(bbox.find(tag).text)
+                    for tag in ("xmin", "ymin", "xmax", "ymax")
+                ),
+            }
+        )
+    return {
+        "size": (int(width), int(height)) if width and height else None,
+        "objects": objects,
+    }
+
+
+def _stat_key(filename):
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+
+
+def _read_voc_record(filename):
+    return filename, _stat_key(filename), read_voc_record(filename)
+
+
+def load_voc_records(filenames, cache_file=None, num_workers=None):
+    """Records (see read_voc_record) of VOC xml files by absolute path.
+
+    Parsing is dominated by file system latency, so the files are spread in
+    chunks over a pool of num_workers processes (all cores by default) that
+    send back the records. With cache_file the records are kept in a pickle
+    along with the mtime and size of their file; a later run, such as eval in
+    its own process, only parses the files that are new or changed.
+    """
+    filenames = sorted(set(os.path.abspath(f) for f in filenames))
+    cached = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+
+    entries = {}
+    todo = []
+    for filename in filenames:
+        entry = cached.get(filename)
+        if entry is not None and entry[0] == _stat_key(filename):
+            entries[filename] = entry
+        else:
+            todo.append(filename)
+    if todo:
+        num_workers = min(num_workers or multiprocessing.cpu_count(), len(todo))
+        chunksize = max(1, len(todo) // (num_workers * 4))
+        print("Parsing {:d} annotation files".format(len(todo)))
+        with multiprocessing.Pool(num_workers) as pool:
+            for filename, key, record in pool.imap_unordered(
+                _read_voc_record, todo, chunksize
+            ):
+                entries[filename] = (key, record)
+        if cache_file is not None:
+            # only the requested files are written back, so the cache never
+            # outgrows the annotation set it was built for; a private file
+            # first so a crashed job never leaves half a cache
+            fd, tmp_file = tempfile.mkstemp(
+                dir=os.path.dirname(cache_file), suffix=".pkl"
+            )
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, cache_file)
+    return {filename: record for filename, (_, record) in entries.items()}
+
+
+def get_voc_record(filename, records=None):
+    """Record of filename from records, read from disk when it is missing."""
+    record = None if records is None else records.get(os.path.abspath(filename))
+    return read_voc_record(filename) if record is None else record
+
+
+def parse_rec(filename, records=None):
     """ Parse a PASCAL VOC xml file """
-    tree = ET.parse(filename)
     objects = []
-    for obj in tree.findall("object"):
+    for obj in get_voc_record(filename, records)["objects"]:
         obj_struct = {}
-        obj_struct["name"] = obj.find("name").text
-        obj_struct["pose"] = obj.find("pose").text
-        obj_struct["truncated"] = int(obj.find("truncated").text)
-        obj_struct["difficult"] = int(obj.find("difficult").text)
-        bbox = obj.find("bndbox")
-        obj_struct["bbox"] = [
-            int(bbox.find("xmin").text),
-            int(bbox.find("ymin").text),
-            int(bbox.find("xmax").text),
-            int(bbox.find("ymax").text),
-        ]
+        obj_struct["name"] = obj["name"]
+        obj_struct["pose"] = obj["pose"]
+        obj_struct["truncated"] = int(obj["truncated"])
+        obj_struct["difficult"] = obj["difficult"]
+        obj_struct["bbox"] = [int(x) for x in obj["bbox"]]
         objects.append(obj_struct)
 
     return objects
@@ -76,6 +170,7 @@ def voc_eval(
     cachedir,
     ovthresh=0.5,
     use_07_metric=False,
+    records_file=None,
 ):
     """rec, prec, ap = voc_eval(detpath,
                               annopath,
@@ -96,39 +191,32 @@ def voc_eval(
   [ovthresh]: Overlap threshold (default = 0.5)
   [use_07_metric]: Whether to use VOC07's 11 point AP computation
       (default False)
+  [records_file]: Annotation records cache (see load_voc_records), by
+      default a file in cachedir
   """
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
-    # cachedir caches the annotations in a pickle file
+    # records_file caches the parsed annotations in a pickle file
 
     # first load gt
     if not os.path.isdir(cachedir):
         os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, "%s_annots.pkl" % imagesetfile)
+    if records_file is None:
+        records_file = os.path.join(
+            cachedir, "%s_records.pkl" % os.path.basename(imagesetfile)
+        )
     # read list of images
     with open(imagesetfile, "r") as f:
         lines = f.readlines()
     imagenames = [x.strip() for x in lines]
 
-    if not os.path.isfile(cachefile):
-        # load annotations
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename))
-            if i % 100 == 0:
-                print("Reading annotation for {:d}/{:d}".format(i + 1, len(imagenames)))
-        # save
-        print("Saving cached annotations to {:s}".format(cachefile))
-        with open(cachefile, "wb") as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, "rb") as f:
-            try:
-                recs = pickle.load(f)
-            except:
-                recs = pickle.load(f, encoding="bytes")
+    # load annotations, reusing the records parsed for the gt roidb
+    annofiles = [annopath.format(imagename) for imagename in imagenames]
+    records = load_voc_records(annofiles, records_file)
+    recs = {}
+    for imagename, annofile in zip(imagenames, annofiles):
+        recs[imagename] = parse_rec(annofile, records)
 
     # extract gt objects for this class
     class_recs = {}
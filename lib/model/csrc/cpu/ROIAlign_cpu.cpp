@@ -110,47 +110,39 @@ void pre_calc_for_bilinear_interpolate(
   }
 }
 
+// sampling points of one roi, shared by all of its channels
 template <typename T>
-void ROIAlignForward_cpu_kernel(
-    const int nthreads,
-    const T* bottom_data,
+struct RoiSampling {
+  int batch_ind;
+  int count;
+  std::vector<PreCalc<T>> pre_calc;
+};
+
+template <typename T>
+void roi_samplings(
+    const int n_rois,
+    const T* bottom_rois,
     const T& spatial_scale,
-    const int channels,
     const int height,
     const int width,
     const int pooled_height,
     const int pooled_width,
     const int sampling_ratio,
-    const T* bottom_rois,
-    //int roi_cols,
-    T* top_data) {
-  //AT_ASSERT(roi_cols == 4 || roi_cols == 5);
+    std::vector<RoiSampling<T>>& samplings) {
   int roi_cols = 5;
 
-  int n_rois = nthreads / channels / pooled_width / pooled_height;
-  // (n, c, ph, pw) is an element in the pooled output
-  // can be parallelized using omp
-  // #pragma omp parallel for num_threads(32)
+#pragma omp parallel for
   for (int n = 0; n < n_rois; n++) {
-    int index_n = n * channels * pooled_width * pooled_height;
-
-    // roi could have 4 or 5 columns
     const T* offset_bottom_rois = bottom_rois + n * roi_cols;
-    int roi_batch_ind = 0;
-    if (roi_cols == 5) {
-      roi_batch_ind = offset_bottom_rois[0];
-      offset_bottom_rois++;
-    }
+    RoiSampling<T>& sampling = samplings[n];
+    sampling.batch_ind = offset_bottom_rois[0];
+    offset_bottom_rois++;
 
     // Do not using rounding; this implementation detail is critical
     T roi_start_w = offset_bottom_rois[0] * spatial_scale;
     T roi_start_h = offset_bottom_rois[1] * spatial_scale;
     T roi_end_w = offset_bottom_rois[2] * spatial_scale;
     T roi_end_h = offset_bottom_rois[3] * spatial_scale;
-    // T roi_start_w = round(offset_bottom_rois[0] * spatial_scale);
-    // T roi_start_h = round(offset_bottom_rois[1] * spatial_scale);
-    // T roi_end_w = round(offset_bottom_rois[2] * spatial_scale);
-    // T roi_end_h = round(offset_bottom_rois[3] * spatial_scale);
 
     // Force malformed ROIs to be 1x1
     T roi_width = std::max(roi_end_w - roi_start_w, (T)1.);
@@ -166,11 +158,11 @@ void ROIAlignForward_cpu_kernel(
         (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
 
     // We do average (integral) pooling inside a bin
-    const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
+    sampling.count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
 
     // we want to precalculate indeces and weights shared by all chanels,
     // this is the key point of optimiation
-    std::vector<PreCalc<T>> pre_calc(
+    sampling.pre_calc.resize(
         roi_bin_grid_h * roi_bin_grid_w * pooled_width * pooled_height);
     pre_calc_for_bilinear_interpolate(
         height,
@@ -185,12 +177,46 @@ void ROIAlignForward_cpu_kernel(
         bin_size_w,
         roi_bin_grid_h,
         roi_bin_grid_w,
-        pre_calc);
+        sampling.pre_calc);
+  }
+}
 
-      for (int c = 0; c < channels; c++) {
-      int index_n_c = index_n + c * pooled_width * pooled_height;
+template <typename T>
+void ROIAlignForward_cpu_kernel(
+    const int nthreads,
+    const T* bottom_data,
+    const T& spatial_scale,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois,
+    T* top_data) {
+  int n_rois = nthreads / channels / pooled_width / pooled_height;
+  std::vector<RoiSampling<T>> samplings(n_rois);
+  roi_samplings(
+      n_rois,
+      bottom_rois,
+      spatial_scale,
+      height,
+      width,
+      pooled_height,
+      pooled_width,
+      sampling_ratio,
+      samplings);
+
+  // (n, c, ph, pw) is an element in the pooled output, every (n, c) plane
+  // is written by one thread
+#pragma omp parallel for collapse(2)
+  for (int n = 0; n < n_rois; n++) {
+    for (int c = 0; c < channels; c++) {
+      const RoiSampling<T>& sampling = samplings[n];
+      int index_n_c = (n * channels + c) * pooled_width * pooled_height;
       const T* offset_bottom_data =
-          bottom_data + (roi_batch_ind * channels + c) * height * width;
+          bottom_data + (sampling.batch_ind * channels + c) * height * width;
+      const int bin_count = sampling.count;
       int pre_calc_index = 0;
 
       for (int ph = 0; ph < pooled_height; ph++) {
@@ -198,18 +224,16 @@ void ROIAlignForward_cpu_kernel(
           int index = index_n_c + ph * pooled_width + pw;
 
           T output_val = 0.;
-          for (int iy = 0; iy < roi_bin_grid_h; iy++) {
-            for (int ix = 0; ix < roi_bin_grid_w; ix++) {
-              PreCalc<T> pc = pre_calc[pre_calc_index];
-              output_val += pc.w1 * offset_bottom_data[pc.pos1] +
-                  pc.w2 * offset_bottom_data[pc.pos2] +
-                  pc.w3 * offset_bottom_data[pc.pos3] +
-                  pc.w4 * offset_bottom_data[pc.pos4];
-
-              pre_calc_index += 1;
-            }
+          for (int i = 0; i < bin_count; i++) {
+            const PreCalc<T>& pc = sampling.pre_calc[pre_calc_index];
+            output_val += pc.w1 * offset_bottom_data[pc.pos1] +
+                pc.w2 * offset_bottom_data[pc.pos2] +
+                pc.w3 * offset_bottom_data[pc.pos3] +
+                pc.w4 * offset_bottom_data[pc.pos4];
+
+            pre_calc_index += 1;
           }
-          output_val /= count;
+          output_val /= bin_count;
 
           top_data[index] = output_val;
         } // for pw
@@ -218,14 +242,72 @@ void ROIAlignForward_cpu_kernel(
   } // for n
 }
 
+template <typename T>
+void ROIAlignBackward_cpu_kernel(
+    const int n_rois,
+    const T* top_diff,
+    const T& spatial_scale,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois,
+    T* bottom_diff) {
+  std::vector<RoiSampling<T>> samplings(n_rois);
+  roi_samplings(
+      n_rois,
+      bottom_rois,
+      spatial_scale,
+      height,
+      width,
+      pooled_height,
+      pooled_width,
+      sampling_ratio,
+      samplings);
+
+  // rois of one image overlap, so threads split the channels and every
+  // thread scatters into its own channel planes only
+#pragma omp parallel for
+  for (int c = 0; c < channels; c++) {
+    for (int n = 0; n < n_rois; n++) {
+      const RoiSampling<T>& sampling = samplings[n];
+      const T* offset_top_diff =
+          top_diff + (n * channels + c) * pooled_width * pooled_height;
+      T* offset_bottom_diff =
+          bottom_diff + (sampling.batch_ind * channels + c) * height * width;
+      const int bin_count = sampling.count;
+      int pre_calc_index = 0;
+
+      for (int ph = 0; ph < pooled_height; ph++) {
+        for (int pw = 0; pw < pooled_width; pw++) {
+          const T top_diff_this_bin =
+              offset_top_diff[ph * pooled_width + pw] / bin_count;
+          for (int i = 0; i < bin_count; i++) {
+            // points outside of the feature map have zero weights
+            const PreCalc<T>& pc = sampling.pre_calc[pre_calc_index];
+            offset_bottom_diff[pc.pos1] += top_diff_this_bin * pc.w1;
+            offset_bottom_diff[pc.pos2] += top_diff_this_bin * pc.w2;
+            offset_bottom_diff[pc.pos3] += top_diff_this_bin * pc.w3;
+            offset_bottom_diff[pc.pos4] += top_diff_this_bin * pc.w4;
+
+            pre_calc_index += 1;
+          }
+        } // for pw
+      } // for ph
+    } // for n
+  } // for c
+}
+
 at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
                                 const at::Tensor& rois,
                                 const float spatial_scale,
                                 const int pooled_height,
                                 const int pooled_width,
                                 const int sampling_ratio) {
-  AT_ASSERTM(!input.type().is_cuda(), "input must be a CPU tensor");
-  AT_ASSERTM(!rois.type().is_cuda(), "rois must be a CPU tensor");
+  AT_ASSERTM(!input.is_cuda(), "input must be a CPU tensor");
+  AT_ASSERTM(!rois.is_cuda(), "rois must be a CPU tensor");
 
   auto num_rois = rois.size(0);
   auto channels = input.size(1);
@@ -239,10 +321,10 @@ at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
     return output;
   }
 
-  AT_DISPATCH_FLOATING_TYPES(input.type(), "ROIAlign_forward", [&] {
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "ROIAlign_forward", [&] {
     ROIAlignForward_cpu_kernel<scalar_t>(
          output_size,
-         input.data<scalar_t>(),
+         input.contiguous().data_ptr<scalar_t>(),
          spatial_scale,
          channels,
          height,
@@ -250,8 +332,46 @@ at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
          pooled_height,
          pooled_width,
          sampling_ratio,
-         rois.data<scalar_t>(),
-         output.data<scalar_t>());
+         rois.contiguous().data_ptr<scalar_t>(),
+         output.data_ptr<scalar_t>());
   });
   return output;
 }
+
+at::Tensor ROIAlign_backward_cpu(const at::Tensor& grad,
+                                 const at::Tensor& rois,
+                                 const float spatial_scale,
+                                 const int pooled_height,
+                                 const int pooled_width,
+                                 const int batch_size,
+                                 const int channels,
+                                 const int height,
+                                 const int width,
+                                 const int sampling_ratio) {
+  AT_ASSERTM(!grad.is_cuda(), "grad must be a CPU tensor");
+  AT_ASSERTM(!rois.is_cuda(), "rois must be a CPU tensor");
+
+  auto num_rois = rois.size(0);
+  auto grad_input = at::zeros({batch_size, channels, height, width}, grad.options());
+
+  // handle possibly empty gradients
+  if (grad.numel() == 0) {
+    return grad_input;
+  }
+
+  AT_DISPATCH_FLOATING_TYPES(grad.scalar_type(), "ROIAlign_backward", [&] {
+    ROIAlignBackward_cpu_kernel<scalar_t>(
+         num_rois,
+         grad.contiguous().data_ptr<scalar_t>(),
+         spatial_scale,
+         channels,
+         height,
+         width,
+         pooled_height,
+         pooled_width,
+         sampling_ratio,
+         rois.contiguous().data_ptr<scalar_t>(),
+         grad_input.data_ptr<scalar_t>());
+  });
+  return grad_input;
+}
@@ -0,0 +1,176 @@
+// Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+#include "cpu/vision.h"
+
+#include <cfloat>
+
+
+template <typename T>
+void RoIPoolForward_cpu_kernel(const int num_rois, const T* bottom_data,
+    const T spatial_scale, const int channels, const int height,
+    const int width, const int pooled_height, const int pooled_width,
+    const T* bottom_rois, T* top_data, int* argmax_data) {
+  // (n, c, ph, pw) is an element in the pooled output, every (n, c) plane
+  // is written by one thread
+#pragma omp parallel for collapse(2)
+  for (int n = 0; n < num_rois; n++) {
+    for (int c = 0; c < channels; c++) {
+      const T* offset_bottom_rois = bottom_rois + n * 5;
+      int roi_batch_ind = offset_bottom_rois[0];
+      int roi_start_w = round(offset_bottom_rois[1] * spatial_scale);
+      int roi_start_h = round(offset_bottom_rois[2] * spatial_scale);
+      int roi_end_w = round(offset_bottom_rois[3] * spatial_scale);
+      int roi_end_h = round(offset_bottom_rois[4] * spatial_scale);
+
+      // Force malformed ROIs to be 1x1
+      int roi_width = std::max(roi_end_w - roi_start_w + 1, 1);
+      int roi_height = std::max(roi_end_h - roi_start_h + 1, 1);
+      T bin_size_h = static_cast<T>(roi_height)
+                         / static_cast<T>(pooled_height);
+      T bin_size_w = static_cast<T>(roi_width)
+                         / static_cast<T>(pooled_width);
+
+      const T* offset_bottom_data =
+          bottom_data + (roi_batch_ind * channels + c) * height * width;
+      int top_offset = (n * channels + c) * pooled_height * pooled_width;
+
+      for (int ph = 0; ph < pooled_height; ph++) {
+        for (int pw = 0; pw < pooled_width; pw++) {
+          int hstart = static_cast<int>(floor(static_cast<T>(ph)
+                                              * bin_size_h));
+          int wstart = static_cast<int>(floor(static_cast<T>(pw)
+                                              * bin_size_w));
+          int hend = static_cast<int>(ceil(static_cast<T>(ph + 1)
+                                           * bin_size_h));
+          int wend = static_cast<int>(ceil(static_cast<T>(pw + 1)
+                                           * bin_size_w));
+
+          // Add roi offsets and clip to input boundaries
+          hstart = std::min(std::max(hstart + roi_start_h, 0), height);
+          hend = std::min(std::max(hend + roi_start_h, 0), height);
+          wstart = std::min(std::max(wstart + roi_start_w, 0), width);
+          wend = std::min(std::max(wend + roi_start_w, 0), width);
+          bool is_empty = (hend <= hstart) || (wend <= wstart);
+
+          // Define an empty pooling region to be zero
+          T maxval = is_empty ? 0 : -FLT_MAX;
+          // If nothing is pooled, argmax = -1 causes nothing to be backprop'd
+          int maxidx = -1;
+          for (int h = hstart; h < hend; ++h) {
+            for (int w = wstart; w < wend; ++w) {
+              int bottom_index = h * width + w;
+              if (offset_bottom_data[bottom_index] > maxval) {
+                maxval = offset_bottom_data[bottom_index];
+                maxidx = bottom_index;
+              }
+            }
+          }
+          int index = top_offset + ph * pooled_width + pw;
+          top_data[index] = maxval;
+          argmax_data[index] = maxidx;
+        } // for pw
+      } // for ph
+    } // for c
+  } // for n
+}
+
+template <typename T>
+void RoIPoolBackward_cpu_kernel(const T* top_diff,
+    const int* argmax_data, const int num_rois, const int channels,
+    const int height, const int width, const int pooled_height,
+    const int pooled_width, T* bottom_diff, const T* bottom_rois) {
+  // rois of one image overlap, so threads split the channels and every
+  // thread scatters into its own channel planes only
+#pragma omp parallel for
+  for (int c = 0; c < channels; c++) {
+    for (int n = 0; n < num_rois; n++) {
+      int roi_batch_ind = bottom_rois[n * 5];
+      int bottom_offset = (roi_batch_ind * channels + c) * height * width;
+      int top_offset    = (n * channels + c) * pooled_height * pooled_width;
+      const T* offset_top_diff = top_diff + top_offset;
+      T* offset_bottom_diff = bottom_diff + bottom_offset;
+      const int* offset_argmax_data = argmax_data + top_offset;
+
+      for (int i = 0; i < pooled_height * pooled_width; i++) {
+        int argmax = offset_argmax_data[i];
+        if (argmax != -1) {
+          offset_bottom_diff[argmax] += offset_top_diff[i];
+        }
+      }
+    } // for n
+  } // for c
+}
+
+std::tuple<at::Tensor, at::Tensor> ROIPool_forward_cpu(const at::Tensor& input,
+                                const at::Tensor& rois,
+                                const float spatial_scale,
+                                const int pooled_height,
+                                const int pooled_width) {
+  AT_ASSERTM(!input.is_cuda(), "input must be a CPU tensor");
+  AT_ASSERTM(!rois.is_cuda(), "rois must be a CPU tensor");
+
+  auto num_rois = rois.size(0);
+  auto channels = input.size(1);
+  auto height = input.size(2);
+  auto width = input.size(3);
+
+  auto output = at::empty({num_rois, channels, pooled_height, pooled_width}, input.options());
+  auto argmax = at::zeros({num_rois, channels, pooled_height, pooled_width}, input.options().dtype(at::kInt));
+
+  if (output.numel() == 0) {
+    return std::make_tuple(output, argmax);
+  }
+
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "ROIPool_forward", [&] {
+    RoIPoolForward_cpu_kernel<scalar_t>(
+         num_rois,
+         input.contiguous().data_ptr<scalar_t>(),
+         spatial_scale,
+         channels,
+         height,
+         width,
+         pooled_height,
+         pooled_width,
+         rois.contiguous().data_ptr<scalar_t>(),
+         output.data_ptr<scalar_t>(),
+         argmax.data_ptr<int>());
+  });
+  return std::make_tuple(output, argmax);
+}
+
+at::Tensor ROIPool_backward_cpu(const at::Tensor& grad,
+                                const at::Tensor& input,
+                                const at::Tensor& rois,
+                                const at::Tensor& argmax,
+                                const float spatial_scale,
+                                const int pooled_height,
+                                const int pooled_width,
+                                const int batch_size,
+                                const int channels,
+                                const int height,
+                                const int width) {
+  AT_ASSERTM(!grad.is_cuda(), "grad must be a CPU tensor");
+  AT_ASSERTM(!rois.is_cuda(), "rois must be a CPU tensor");
+
+  auto num_rois = rois.size(0);
+  auto grad_input = at::zeros({batch_size, channels, height, width}, grad.options());
+
+  // handle possibly empty gradients
+  if (grad.numel() == 0) {
+    return grad_input;
+  }
+
+  AT_DISPATCH_FLOATING_TYPES(grad.scalar_type(), "ROIPool_backward", [&] {
+    RoIPoolBackward_cpu_kernel<scalar_t>(
+         grad.contiguous().data_ptr<scalar_t>(),
+         argmax.contiguous().data_ptr<int>(),
+         num_rois,
+         channels,
+         height,
+         width,
+         pooled_height,
+         pooled_width,
+         grad_input.data_ptr<scalar_t>(),
+         rois.contiguous().data_ptr<scalar_t>());
+  });
+  return grad_input;
+}
@@ -61,10 +61,10 @@ class _InstanceDA(nn.Module):
         self.clssifer = nn.Linear(1024, 1)
         self.LabelResizeLayer = InstanceLabelResizeLayer()
 
-    def forward(self, x, need_backprop):
+    def forward(self, x, need_backprop, image_ids=None):
         x = grad_reverse(x)
         x = self.dc_drop1(self.dc_relu1(self.dc_ip1(x)))
         x = self.dc_drop2(self.dc_relu2(self.dc_ip2(x)))
         x = torch.sigmoid(self.clssifer(x))
-        label = self.LabelResizeLayer(x, need_backprop)
+        label = self.LabelResizeLayer(x, need_backprop, image_ids)
         return x, label
@@ -1,7 +1,5 @@
 from __future__ import absolute_import, division, print_function
 
-import cv2
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -19,38 +17,19 @@ class ImageLabelResizeLayer(nn.Module):
         super(ImageLabelResizeLayer, self).__init__()
 
     def forward(self, x, need_backprop):
-
-        feats = x.detach().cpu().numpy()
-        lbs = need_backprop.detach().cpu().numpy()
-        gt_blob = np.zeros(
-            (lbs.shape[0], feats.shape[2], feats.shape[3], 1), dtype=np.float32
-        )
-        for i in range(lbs.shape[0]):
-            lb = np.array([lbs[i]])
-            lbs_resize = cv2.resize(
-                lb, (feats.shape[3], feats.shape[2]), interpolation=cv2.INTER_NEAREST
-            )
-            gt_blob[i, 0 : lbs_resize.shape[0], 0 : lbs_resize.shape[1], 0] = lbs_resize
-
-        channel_swap = (0, 3, 1, 2)
-        gt_blob = gt_blob.transpose(channel_swap)
-        y = Variable(torch.from_numpy(gt_blob)).cuda()
-        y = y.squeeze(1).long()
-        return y
+        # every position of the (N, H, W) map carries the label of its image
+        lbs = need_backprop.detach().to(x.device).long().view(-1, 1, 1)
+        return lbs.expand(lbs.size(0), x.size(2), x.size(3)).contiguous()
 
 
 class InstanceLabelResizeLayer(nn.Module):
     def __init__(self):
         super(InstanceLabelResizeLayer, self).__init__()
-        self.minibatch = 256
-
-    def forward(self, x, need_backprop):
-        feats = x.data.cpu().numpy()
-        lbs = need_backprop.data.cpu().numpy()
-        resized_lbs = np.ones((feats.shape[0], 1), dtype=np.float32)
-        for i in range(lbs.shape[0]):
-            resized_lbs[i * self.minibatch : (i + 1) * self.minibatch] = lbs[i]
-
-        y = torch.from_numpy(resized_lbs).cuda()
 
-        return y
+    def forward(self, x, need_backprop, image_ids=None):
+        # every roi carries the label of its image, image_ids maps the rois of
+        # x to their images; a single label covers all rois of the pass
+        lbs = need_backprop.detach().to(x.device, x.dtype).view(-1)
+        if lbs.numel() == 1:
+            return lbs.view(1, 1).expand(x.size(0), 1).contiguous()
+        return lbs[image_ids.to(x.device)].view(-1, 1)
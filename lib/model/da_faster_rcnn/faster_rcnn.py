@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -12,10 +14,10 @@ from model.utils.net_utils import (
     _affine_theta,
     _crop_pool_layer,
     _smooth_l1_loss,
-    grad_reverse,
+    context_linear,
+    pad_rois,
 )
 from torch.autograd import Variable
-import pdb
 
 
 class _fasterRCNN(nn.Module):
@@ -59,40 +61,177 @@ class _fasterRCNN(nn.Module):
 
         # feed image data to base model to obtain base feature map
         base_feat1 = self.RCNN_base1(im_data)
+        # the discriminators reverse the gradient of their logits into the
+        # backbone, the context vectors come from the same pass
         if self.lc:
-            d_pixel, _ = self.netD_pixel(grad_reverse(base_feat1, lambd=eta))
+            d_pixel, feat_pixel = self.netD_pixel(base_feat1, lambd=eta)
             # print(d_pixel)
-            if not target:
-                _, feat_pixel = self.netD_pixel(base_feat1.detach())
         else:
-            d_pixel = self.netD_pixel(grad_reverse(base_feat1, lambd=eta))
+            d_pixel = self.netD_pixel(base_feat1, lambd=eta)
+        base_feat = self.RCNN_base2(base_feat1)
+        if self.gc:
+            domain_p, feat = self.netD(base_feat, lambd=eta)
+        else:
+            domain_p = self.netD(base_feat, lambd=eta)
+        if target:
+            return d_pixel, domain_p  # , diff
+        return self._detection_forward(
+            base_feat,
+            im_info,
+            im_cls_lb,
+            gt_boxes,
+            num_boxes,
+            feat_pixel if self.lc else None,
+            feat if self.gc else None,
+        ) + (d_pixel, domain_p)
+
+    def forward_joint(
+        self, im_data, im_info, im_cls_lb, gt_boxes, num_boxes, t_im_data, eta=1.0
+    ):
+        """Run one training step over a source and a target batch together.
+
+        Both batches are zero-padded to a common size and stacked, so
+        RCNN_base1/RCNN_base2, netD_pixel and netD are called once per step.
+        Only the source half of the features is sent to the RPN and the ROI
+        head. The pixel-level domain maps are cropped back to each image's own
+        extent; the global discriminator pools over the padded canvas, its
+        context vectors over the source images only.
+        """
+        outputs = self.forward_multi_target(
+            im_data, im_info, im_cls_lb, gt_boxes, num_boxes, [t_im_data], eta
+        )
+        d_pixel_s, domain_p_s, d_pixel_t, domain_p_t = outputs[-4:]
+        return outputs[:-4] + (d_pixel_s[0], domain_p_s[0], d_pixel_t[0], domain_p_t[0])
+
+    def forward_multi_target(
+        self, im_data, im_info, im_cls_lb, gt_boxes, num_boxes, t_im_data, eta=1.0
+    ):
+        """forward_joint over a source batch and a list of target batches, one
+        per target domain, all stacked into a single backbone pass.
+
+        The detection outputs are followed by four lists: the source pixel
+        maps and global logits of every discriminator head, then the target
+        pixel maps and global logits of every domain. A model built with one
+        head per target domain scores domain d with head d, otherwise all
+        domains share the one head.
+        """
+        batches = [im_data] + list(t_im_data)
+        sizes = [(batch.size(2), batch.size(3)) for batch in batches]
+        canvas_size = (max(h for h, _ in sizes), max(w for _, w in sizes))
+        starts = [0]
+        for batch in batches:
+            starts.append(starts[-1] + batch.size(0))
+        joint_data = im_data.new(starts[-1], im_data.size(1), *canvas_size).zero_()
+        for i, batch in enumerate(batches):
+            rows = slice(starts[i], starts[i + 1])
+            joint_data[rows, :, : sizes[i][0], : sizes[i][1]] = batch
+        num_source = starts[1]
+
+        im_info = im_info.data
+        gt_boxes = gt_boxes.data
+        num_boxes = num_boxes.data
+
+        def source_part(feat):
+            # the context vectors pool over the source images only, not over
+            # the padded canvas
+            return self._crop_to_image(feat[:num_source], sizes[0], canvas_size)
+
+        base_feat1 = self.RCNN_base1(joint_data)
+        feat_pixel = None
+        if self.lc:
+            d_pixel, feat_pixel = self.netD_pixel(
+                base_feat1, lambd=eta, context_crop=source_part
+            )
+        else:
+            d_pixel = self.netD_pixel(base_feat1, lambd=eta)
+        # vgg16's netD_pixel flattens its output, restore the map layout with
+        # one channel per head
+        d_pixel = d_pixel.view(
+            base_feat1.size(0), -1, base_feat1.size(2), base_feat1.size(3)
+        )
+
         base_feat = self.RCNN_base2(base_feat1)
+        s_base_feat = source_part(base_feat)
+        feat = None
         if self.gc:
-            domain_p, _ = self.netD(grad_reverse(base_feat, lambd=eta))
-            if target:
-                return d_pixel, domain_p  # , diff
-            _, feat = self.netD(base_feat.detach())
+            domain_p, feat = self.netD(base_feat, lambd=eta, context_crop=source_part)
         else:
-            domain_p = self.netD(grad_reverse(base_feat, lambd=eta))
-            if target:
-                return d_pixel, domain_p  # ,diff
-        #print('base_feat', base_feat.shape, base_feat)
-        if torch.isnan(base_feat).any():
-            pdb.set_trace()
+            domain_p = self.netD(base_feat, lambd=eta)
+        domain_p = domain_p.view(domain_p.size(0), -1, 2)
+
+        num_heads = d_pixel.size(1)
+        assert num_heads in (1, len(t_im_data)), "one head per target domain"
+        d_pixel_s = self._crop_to_image(d_pixel[:num_source], sizes[0], canvas_size)
+        d_pixel_s = [d_pixel_s[:, k : k + 1] for k in range(num_heads)]
+        domain_p_s = [domain_p[:num_source, k] for k in range(num_heads)]
+        d_pixel_t = []
+        domain_p_t = []
+        for d in range(len(t_im_data)):
+            k = d if num_heads > 1 else 0
+            rows = slice(starts[d + 1], starts[d + 2])
+            d_pixel_t.append(
+                self._crop_to_image(d_pixel[rows, k : k + 1], sizes[d + 1], canvas_size)
+            )
+            domain_p_t.append(domain_p[rows, k])
+
+        return self._detection_forward(
+            s_base_feat, im_info, im_cls_lb, gt_boxes, num_boxes, feat_pixel, feat
+        ) + (d_pixel_s, domain_p_s, d_pixel_t, domain_p_t)
+
+    def detect(self, im_data, im_info):
+        """Detection-only forward for evaluation and deployment.
+
+        Only the discriminator trunks run, to provide the context vectors of
+        --lc and --gc; their domain classifiers and the category supervision
+        are skipped. Returns the rois,
+        cls_prob and bbox_pred that forward returns in eval mode.
+        """
+        assert not self.training, "detect() runs in eval mode only"
+        base_feat1 = self.RCNN_base1(im_data)
+        feat_pixel = self.netD_pixel.context_vector(base_feat1) if self.lc else None
+        base_feat = self.RCNN_base2(base_feat1)
+        feat = self.netD.context_vector(base_feat) if self.gc else None
+        rois, cls_prob, bbox_pred = self._detection_forward(
+            base_feat, im_info.data, None, None, None, feat_pixel, feat
+        )[:3]
+        return rois, cls_prob, bbox_pred
+
+    @staticmethod
+    def _crop_to_image(feat, im_size, canvas_size):
+        """Crop the part of a stacked feature map that covers one image size."""
+        height = int(math.ceil(feat.size(2) * im_size[0] / float(canvas_size[0])))
+        width = int(math.ceil(feat.size(3) * im_size[1] / float(canvas_size[1])))
+        return feat[:, :, :height, :width]
+
+    def _detection_forward(
+        self, base_feat, im_info, im_cls_lb, gt_boxes, num_boxes, feat_pixel, feat
+    ):
+        """RPN, ROI head and category supervision on the source features.
+
+        im_cls_lb is None skips the category supervision.
+        """
+        batch_size = base_feat.size(0)
+
         # feed base feature map tp RPN to obtain rois
-        rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
+        rois, num_rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
             base_feat, im_info, gt_boxes, num_boxes
         )
         # supervise base feature map with category level label
-        cls_feat = self.avg_pool(base_feat)
-        cls_feat = self.conv_lst(cls_feat).squeeze(-1).squeeze(-1)
-        # cls_feat = self.conv_lst(self.bn1(self.avg_pool(base_feat))).squeeze(-1).squeeze(-1)
-        category_loss_cls = nn.BCEWithLogitsLoss()(cls_feat, im_cls_lb)
+        category_loss_cls = 0
+        if im_cls_lb is not None:
+            cls_feat = self.avg_pool(base_feat)
+            cls_feat = self.conv_lst(cls_feat).squeeze(-1).squeeze(-1)
+            # cls_feat = self.conv_lst(self.bn1(self.avg_pool(base_feat))).squeeze(-1).squeeze(-1)
+            category_loss_cls = nn.BCEWithLogitsLoss()(cls_feat, im_cls_lb)
 
         # if it is training phrase, then use ground trubut bboxes for refining
         if self.training:
-            roi_data = self.RCNN_proposal_target(rois, gt_boxes, num_boxes)
+            roi_data = self.RCNN_proposal_target(rois, num_rois, gt_boxes, num_boxes)
             rois, rois_label, rois_target, rois_inside_ws, rois_outside_ws = roi_data
+            num_rois = num_rois.new(batch_size).fill_(rois.size(1))
+            # every image has the same number of sampled rois
+            max_rois = rois.size(1)
+            rois = rois.view(-1, 5)
 
             rois_label = Variable(rois_label.view(-1).long())
             rois_target = Variable(rois_target.view(-1, rois_target.size(2)))
@@ -101,6 +240,7 @@ class _fasterRCNN(nn.Module):
                 rois_outside_ws.view(-1, rois_outside_ws.size(2))
             )
         else:
+            max_rois = None
             rois_label = None
             rois_target = None
             rois_inside_ws = None
@@ -109,26 +249,31 @@ class _fasterRCNN(nn.Module):
             rpn_loss_bbox = 0
 
         rois = Variable(rois)
+        image_ids = rois.data[:, 0].long()
         # do roi pooling based on predicted rois
 
         if cfg.POOLING_MODE == "align":
-            pooled_feat = self.RCNN_roi_align(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_align(base_feat, rois)
         elif cfg.POOLING_MODE == "pool":
-            pooled_feat = self.RCNN_roi_pool(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_pool(base_feat, rois)
+        elif cfg.POOLING_MODE == "crop":
+            pooled_feat, _ = _crop_pool_layer(
+                base_feat, rois, cfg.CROP_RESIZE_WITH_MAX_POOL
+            )
 
         # feed pooled features to top model
         pooled_feat = self._head_to_tail(pooled_feat)
         # feat_pixel = torch.zeros(feat_pixel.size()).cuda()
-        if self.lc:
-            feat_pixel = feat_pixel.view(1, -1).repeat(pooled_feat.size(0), 1)
-            pooled_feat = torch.cat((feat_pixel, pooled_feat), 1)
+        # the image level context enters the heads once per image
+        context = []
         if self.gc:
-            feat = feat.view(1, -1).repeat(pooled_feat.size(0), 1)
-            pooled_feat = torch.cat((feat, pooled_feat), 1)
-            # compute bbox offset
+            context.append(feat.view(batch_size, -1))
+        if self.lc:
+            context.append(feat_pixel.view(batch_size, -1))
+        context = torch.cat(context, 1) if context else None
 
         # compute bbox offset
-        bbox_pred = self.RCNN_bbox_pred(pooled_feat)
+        bbox_pred = context_linear(self.RCNN_bbox_pred, pooled_feat, context, image_ids)
         if self.training and not self.class_agnostic:
             bbox_pred_view = bbox_pred.view(
                 bbox_pred.size(0), int(bbox_pred.size(1) / 4), 4
@@ -143,7 +288,7 @@ class _fasterRCNN(nn.Module):
             bbox_pred = bbox_pred_select.squeeze(1)
 
         # compute object classification probability
-        cls_score = self.RCNN_cls_score(pooled_feat)
+        cls_score = context_linear(self.RCNN_cls_score, pooled_feat, context, image_ids)
         cls_prob = F.softmax(cls_score, 1)
 
         RCNN_loss_cls = 0
@@ -158,8 +303,10 @@ class _fasterRCNN(nn.Module):
                 bbox_pred, rois_target, rois_inside_ws, rois_outside_ws
             )
 
-        cls_prob = cls_prob.view(batch_size, rois.size(1), -1)
-        bbox_pred = bbox_pred.view(batch_size, rois.size(1), -1)
+        # the rois are packed over the batch, pad them to the longest image
+        cls_prob = pad_rois(cls_prob, image_ids, num_rois, max_rois)
+        bbox_pred = pad_rois(bbox_pred, image_ids, num_rois, max_rois)
+        rois = pad_rois(rois, image_ids, num_rois, max_rois)
 
         return (
             rois,
@@ -171,9 +318,7 @@ class _fasterRCNN(nn.Module):
             RCNN_loss_cls,
             RCNN_loss_bbox,
             rois_label,
-            d_pixel,
-            domain_p,
-        )  # ,diff
+        )
 
     def _init_weights(self):
         def normal_init(m, mean, stddev, truncated=False):
@@ -12,7 +12,8 @@ from model.utils.net_utils import (
     _affine_theta,
     _crop_pool_layer,
     _smooth_l1_loss,
-    grad_reverse,
+    context_linear,
+    pad_rois,
 )
 from torch.autograd import Variable
 
@@ -56,25 +57,22 @@ class _fasterRCNN(nn.Module):
 
         # feed image data to base model to obtain base feature map
         base_feat1 = self.RCNN_base1(im_data)
+        # the discriminators reverse the gradient of their logits into the
+        # backbone, the context vectors come from the same pass
         if self.lc:
-            d_pixel, _ = self.netD_pixel(grad_reverse(base_feat1, lambd=eta))
+            d_pixel, feat_pixel = self.netD_pixel(base_feat1, lambd=eta)
             # print(d_pixel)
-            if not target:
-                _, feat_pixel = self.netD_pixel(base_feat1.detach())
         else:
-            d_pixel = self.netD_pixel(grad_reverse(base_feat1, lambd=eta))
+            d_pixel = self.netD_pixel(base_feat1, lambd=eta)
         base_feat = self.RCNN_base2(base_feat1)
         if self.gc:
-            domain_p, _ = self.netD(grad_reverse(base_feat, lambd=eta))
-            if target:
-                return d_pixel, domain_p  # , diff
-            _, feat = self.netD(base_feat.detach())
+            domain_p, feat = self.netD(base_feat, lambd=eta)
         else:
-            domain_p = self.netD(grad_reverse(base_feat, lambd=eta))
-            if target:
-                return d_pixel, domain_p  # ,diff
+            domain_p = self.netD(base_feat, lambd=eta)
+        if target:
+            return d_pixel, domain_p  # , diff
         # feed base feature map tp RPN to obtain rois
-        rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
+        rois, num_rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
             base_feat, im_info, gt_boxes, num_boxes
         )
         # supervise base feature map with category level label
@@ -83,8 +81,12 @@ class _fasterRCNN(nn.Module):
 
         # if it is training phrase, then use ground trubut bboxes for refining
         if self.training:
-            roi_data = self.RCNN_proposal_target(rois, gt_boxes, num_boxes)
+            roi_data = self.RCNN_proposal_target(rois, num_rois, gt_boxes, num_boxes)
             rois, rois_label, rois_target, rois_inside_ws, rois_outside_ws = roi_data
+            num_rois = num_rois.new(batch_size).fill_(rois.size(1))
+            # every image has the same number of sampled rois
+            max_rois = rois.size(1)
+            rois = rois.view(-1, 5)
 
             rois_label = Variable(rois_label.view(-1).long())
             rois_target = Variable(rois_target.view(-1, rois_target.size(2)))
@@ -93,6 +95,7 @@ class _fasterRCNN(nn.Module):
                 rois_outside_ws.view(-1, rois_outside_ws.size(2))
             )
         else:
+            max_rois = None
             rois_label = None
             rois_target = None
             rois_inside_ws = None
@@ -101,26 +104,31 @@ class _fasterRCNN(nn.Module):
             rpn_loss_bbox = 0
 
         rois = Variable(rois)
+        image_ids = rois.data[:, 0].long()
         # do roi pooling based on predicted rois
 
         if cfg.POOLING_MODE == "align":
-            pooled_feat = self.RCNN_roi_align(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_align(base_feat, rois)
         elif cfg.POOLING_MODE == "pool":
-            pooled_feat = self.RCNN_roi_pool(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_pool(base_feat, rois)
+        elif cfg.POOLING_MODE == "crop":
+            pooled_feat, _ = _crop_pool_layer(
+                base_feat, rois, cfg.CROP_RESIZE_WITH_MAX_POOL
+            )
 
         # feed pooled features to top model
         pooled_feat = self._head_to_tail(pooled_feat)
         # feat_pixel = torch.zeros(feat_pixel.size()).cuda()
-        if self.lc:
-            feat_pixel = feat_pixel.view(1, -1).repeat(pooled_feat.size(0), 1)
-            pooled_feat = torch.cat((feat_pixel, pooled_feat), 1)
+        # the image level context enters the heads once per image
+        context = []
         if self.gc:
-            feat = feat.view(1, -1).repeat(pooled_feat.size(0), 1)
-            pooled_feat = torch.cat((feat, pooled_feat), 1)
-            # compute bbox offset
+            context.append(feat.view(batch_size, -1))
+        if self.lc:
+            context.append(feat_pixel.view(batch_size, -1))
+        context = torch.cat(context, 1) if context else None
 
         # compute bbox offset
-        bbox_pred = self.RCNN_bbox_pred(pooled_feat)
+        bbox_pred = context_linear(self.RCNN_bbox_pred, pooled_feat, context, image_ids)
         if self.training and not self.class_agnostic:
             bbox_pred_view = bbox_pred.view(
                 bbox_pred.size(0), int(bbox_pred.size(1) / 4), 4
@@ -135,7 +143,7 @@ class _fasterRCNN(nn.Module):
             bbox_pred = bbox_pred_select.squeeze(1)
 
         # compute object classification probability
-        cls_score = self.RCNN_cls_score(pooled_feat)
+        cls_score = context_linear(self.RCNN_cls_score, pooled_feat, context, image_ids)
         cls_prob = F.softmax(cls_score, 1)
 
         RCNN_loss_cls = 0
@@ -150,8 +158,10 @@ class _fasterRCNN(nn.Module):
                 bbox_pred, rois_target, rois_inside_ws, rois_outside_ws
             )
 
-        cls_prob = cls_prob.view(batch_size, rois.size(1), -1)
-        bbox_pred = bbox_pred.view(batch_size, rois.size(1), -1)
+        # the rois are packed over the batch, pad them to the longest image
+        cls_prob = pad_rois(cls_prob, image_ids, num_rois, max_rois)
+        bbox_pred = pad_rois(bbox_pred, image_ids, num_rois, max_rois)
+        rois = pad_rois(rois, image_ids, num_rois, max_rois)
 
         return (
             rois,
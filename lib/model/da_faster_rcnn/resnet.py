@@ -8,6 +8,7 @@ import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 from model.da_faster_rcnn.faster_rcnn import _fasterRCNN
 from model.utils.config import cfg
+from model.utils.net_utils import detach_input, grad_reverse, pool_context, reverse_into
 from torch.autograd import Variable
 
 __all__ = ["ResNet", "resnet18", "resnet34", "resnet50", "resnet101", "resnet152"]
@@ -37,11 +38,14 @@ def conv1x1(in_planes, out_planes, stride=1):
 
 
 class netD_pixel(nn.Module):
-    def __init__(self, context=False):
+    def __init__(self, context=False, num_domains=1):
         super(netD_pixel, self).__init__()
         self.conv1 = nn.Conv2d(256, 256, kernel_size=1, stride=1, padding=0, bias=False)
         self.conv2 = nn.Conv2d(256, 128, kernel_size=1, stride=1, padding=0, bias=False)
-        self.conv3 = nn.Conv2d(128, 1, kernel_size=1, stride=1, padding=0, bias=False)
+        # one output map per target domain head
+        self.conv3 = nn.Conv2d(
+            128, num_domains, kernel_size=1, stride=1, padding=0, bias=False
+        )
         self.context = context
         self._init_weights()
 
@@ -63,20 +67,29 @@ class netD_pixel(nn.Module):
         normal_init(self.conv2, 0, 0.01)
         normal_init(self.conv3, 0, 0.01)
 
-    def forward(self, x):
-        x = F.relu(self.conv1(x))
-        x = F.relu(self.conv2(x))
+    def _trunk(self, h):
+        h = F.relu(self.conv1(h))
+        return F.relu(self.conv2(h))
+
+    def context_vector(self, x, context_crop=None):
+        """The context vector alone, without the domain classifier."""
+        return pool_context(self._trunk(x), context_crop)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # one trunk pass on a leaf copy of x: the context vector trains the
+        # trunk only, the logits also reverse their gradient into x
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = F.avg_pool2d(x, (x.size(2), x.size(3)))
-            x = self.conv3(x)
-            return torch.sigmoid(x), feat
+            feat = pool_context(h, context_crop)
+            h = reverse_into(h, trunk_input, x, lambd)
+            return torch.sigmoid(self.conv3(h)), feat
         else:
-            x = self.conv3(x)
-            return torch.sigmoid(x)
+            return torch.sigmoid(self.conv3(h))
 
 
 class netD(nn.Module):
-    def __init__(self, context=False):
+    def __init__(self, context=False, num_domains=1):
         super(netD, self).__init__()
         self.conv1 = conv3x3(1024, 512, stride=2)
         self.bn1 = nn.BatchNorm2d(512)
@@ -84,19 +97,30 @@ class netD(nn.Module):
         self.bn2 = nn.BatchNorm2d(128)
         self.conv3 = conv3x3(128, 128, stride=2)
         self.bn3 = nn.BatchNorm2d(128)
-        self.fc = nn.Linear(128, 2)
+        # two logits per target domain head
+        self.fc = nn.Linear(128, 2 * num_domains)
         self.context = context
         self.leaky_relu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
-    def forward(self, x):
-        x = F.dropout(F.relu(self.bn1(self.conv1(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn2(self.conv2(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn3(self.conv3(x))), training=self.training)
-        x = F.avg_pool2d(x, (x.size(2), x.size(3)))
-        x = x.view(-1, 128)
+    def _trunk(self, h):
+        h = F.dropout(F.relu(self.bn1(self.conv1(h))), training=self.training)
+        h = F.dropout(F.relu(self.bn2(self.conv2(h))), training=self.training)
+        return F.dropout(F.relu(self.bn3(self.conv3(h))), training=self.training)
+
+    def context_vector(self, x, context_crop=None):
+        """See netD_pixel.context_vector."""
+        return pool_context(self._trunk(x), context_crop).view(-1, 128)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # see netD_pixel.forward
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = x
-        x = self.fc(x)
+            feat = pool_context(h, context_crop).view(-1, 128)
+            h = reverse_into(h, trunk_input, x, lambd)
+        h = F.avg_pool2d(h, (h.size(2), h.size(3)))
+        h = h.view(-1, 128)
+        x = self.fc(h)
         if self.context:
             return x, feat
         else:
@@ -325,6 +349,7 @@ class resnet(_fasterRCNN):
         class_agnostic=False,
         lc=False,
         gc=False,
+        num_domain_heads=1,
     ):
         self.model_path = pretrained_path
         self.dout_base_model = 1024
@@ -332,6 +357,7 @@ class resnet(_fasterRCNN):
         self.class_agnostic = class_agnostic
         self.lc = lc
         self.gc = gc
+        self.num_domain_heads = num_domain_heads
         self.layers = num_layers
         if not pretrained_path:
             self.model_path = pretrained_path
@@ -344,7 +370,7 @@ class resnet(_fasterRCNN):
             resnet = resnet50()
         if self.pretrained == True:
             print("Loading pretrained weights from %s" % (self.model_path))
-            state_dict = torch.load(self.model_path)
+            state_dict = torch.load(self.model_path, map_location="cpu")
             resnet.load_state_dict(
                 {k: v for k, v in state_dict.items() if k in resnet.state_dict()}
             )
@@ -353,8 +379,8 @@ class resnet(_fasterRCNN):
             resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool, resnet.layer1
         )
         self.RCNN_base2 = nn.Sequential(resnet.layer2, resnet.layer3)
-        self.netD_pixel = netD_pixel(context=self.lc)
-        self.netD = netD(context=self.gc)
+        self.netD_pixel = netD_pixel(context=self.lc, num_domains=self.num_domain_heads)
+        self.netD = netD(context=self.gc, num_domains=self.num_domain_heads)
 
         self.RCNN_top = nn.Sequential(resnet.layer4)
         feat_d = 2048
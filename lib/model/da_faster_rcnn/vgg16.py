@@ -11,6 +11,7 @@ import torch.nn.functional as F
 import torchvision.models as models
 from model.da_faster_rcnn.faster_rcnn import _fasterRCNN
 from model.utils.config import cfg
+from model.utils.net_utils import detach_input, grad_reverse, pool_context, reverse_into
 from torch.autograd import Variable
 
 
@@ -29,32 +30,44 @@ def conv1x1(in_planes, out_planes, stride=1):
 
 
 class netD_pixel(nn.Module):
-    def __init__(self, context=False):
+    def __init__(self, context=False, num_domains=1):
         super(netD_pixel, self).__init__()
         self.conv1 = conv1x1(256, 256)
         # self.bn1 = nn.BatchNorm2d(256)
         self.conv2 = conv1x1(256, 128)
         # self.bn2 = nn.BatchNorm2d(128)
-        self.conv3 = conv1x1(128, 1)
+        # one output map per target domain head
+        self.conv3 = conv1x1(128, num_domains)
 
         self.context = context
 
-    def forward(self, x):
-        x = F.relu(x)
-        x = F.relu(self.conv1(x))
-        x = F.relu(self.conv2(x))
+    def _trunk(self, h):
+        h = F.relu(h)
+        h = F.relu(self.conv1(h))
+        return F.relu(self.conv2(h))
+
+    def context_vector(self, x, context_crop=None):
+        """The context vector alone, without the domain classifier."""
+        return pool_context(self._trunk(x), context_crop)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # one trunk pass on a leaf copy of x: the context vector trains the
+        # trunk only, the logits also reverse their gradient into x
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = F.avg_pool2d(x, (x.size(2), x.size(3)))
+            feat = pool_context(h, context_crop)
             # feat = x
-            x = torch.sigmoid(self.conv3(x))
-            return x.view(-1, 1), feat  # torch.cat((feat1,feat2),1)#F
+            h = reverse_into(h, trunk_input, x, lambd)
+            h = torch.sigmoid(self.conv3(h))
+            return h.view(-1, 1), feat  # torch.cat((feat1,feat2),1)#F
         else:
-            x = torch.sigmoid(self.conv3(x))
-            return x.view(-1, 1)  # F.sigmoid(x)
+            h = torch.sigmoid(self.conv3(h))
+            return h.view(-1, 1)  # F.sigmoid(x)
 
 
 class netD(nn.Module):
-    def __init__(self, context=False):
+    def __init__(self, context=False, num_domains=1):
         super(netD, self).__init__()
         self.conv1 = conv3x3(512, 512, stride=2)
         self.bn1 = nn.BatchNorm2d(512)
@@ -62,18 +75,29 @@ class netD(nn.Module):
         self.bn2 = nn.BatchNorm2d(128)
         self.conv3 = conv3x3(128, 128, stride=2)
         self.bn3 = nn.BatchNorm2d(128)
-        self.fc = nn.Linear(128, 2)
+        # two logits per target domain head
+        self.fc = nn.Linear(128, 2 * num_domains)
         self.context = context
 
-    def forward(self, x):
-        x = F.dropout(F.relu(self.bn1(self.conv1(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn2(self.conv2(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn3(self.conv3(x))), training=self.training)
-        x = F.avg_pool2d(x, (x.size(2), x.size(3)))
-        x = x.view(-1, 128)
+    def _trunk(self, h):
+        h = F.dropout(F.relu(self.bn1(self.conv1(h))), training=self.training)
+        h = F.dropout(F.relu(self.bn2(self.conv2(h))), training=self.training)
+        return F.dropout(F.relu(self.bn3(self.conv3(h))), training=self.training)
+
+    def context_vector(self, x, context_crop=None):
+        """See netD_pixel.context_vector."""
+        return pool_context(self._trunk(x), context_crop).view(-1, 128)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # see netD_pixel.forward
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = x
-        x = self.fc(x)
+            feat = pool_context(h, context_crop).view(-1, 128)
+            h = reverse_into(h, trunk_input, x, lambd)
+        h = F.avg_pool2d(h, (h.size(2), h.size(3)))
+        h = h.view(-1, 128)
+        x = self.fc(h)
         if self.context:
             return x, feat  # torch.cat((feat1,feat2),1)#F
         else:
@@ -105,6 +129,7 @@ class vgg16(_fasterRCNN):
         class_agnostic=False,
         lc=False,
         gc=False,
+        num_domain_heads=1,
     ):
         self.model_path = pretrained_path
         self.dout_base_model = 512
@@ -112,6 +137,7 @@ class vgg16(_fasterRCNN):
         self.class_agnostic = class_agnostic
         self.lc = lc
         self.gc = gc
+        self.num_domain_heads = num_domain_heads
 
         _fasterRCNN.__init__(self, classes, class_agnostic, self.lc, self.gc)
 
@@ -119,7 +145,7 @@ class vgg16(_fasterRCNN):
         vgg = models.vgg16()
         if self.pretrained:
             print("Loading pretrained weights from %s" % (self.model_path))
-            state_dict = torch.load(self.model_path)
+            state_dict = torch.load(self.model_path, map_location="cpu")
             vgg.load_state_dict(
                 {k: v for k, v in state_dict.items() if k in vgg.state_dict()}
             )
@@ -133,8 +159,8 @@ class vgg16(_fasterRCNN):
         self.RCNN_base2 = nn.Sequential(*list(vgg.features._modules.values())[14:-1])
         # print(self.RCNN_base1)
         # print(self.RCNN_base2)
-        self.netD = netD(context=self.gc)
-        self.netD_pixel = netD_pixel(context=self.lc)
+        self.netD = netD(context=self.gc, num_domains=self.num_domain_heads)
+        self.netD_pixel = netD_pixel(context=self.lc, num_domains=self.num_domain_heads)
         feat_d = 4096
         if self.lc:
             feat_d += 128
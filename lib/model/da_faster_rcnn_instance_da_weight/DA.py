@@ -10,6 +10,7 @@ from model.da_faster_rcnn_instance_da_weight.LabelResizeLayer import (
     InstanceLabelResizeLayer,
 )
 from model.utils.config import cfg
+from model.utils.net_utils import context_linear
 from torch.autograd import Function, Variable
 
 
@@ -61,15 +62,18 @@ class _InstanceDA(nn.Module):
         self.clssifer = nn.Linear(1024, 1)
         self.LabelResizeLayer = InstanceLabelResizeLayer()
 
-    def forward(self, x, need_backprop):
+    def forward(self, x, need_backprop, context=None, image_ids=None):
         # print('forward input: ', x)
+        # context: optional per-image features that lead the input of dc_ip1,
+        # image_ids maps every roi of x to its row of context
         x = grad_reverse(x)
         # print('grad_reverse: ', x)
-        x = self.dc_drop1(self.dc_relu1(self.dc_ip1(x)))
+        x = context_linear(self.dc_ip1, x, context, image_ids)
+        x = self.dc_drop1(self.dc_relu1(x))
         # print('dc_drop1: ', x)
         x = self.dc_drop2(self.dc_relu2(self.dc_ip2(x)))
         # print('dc_drop2: ', x)
         x = torch.sigmoid(self.clssifer(x))
         # print('sigmoid: ', x)
-        label = self.LabelResizeLayer(x, need_backprop)
+        label = self.LabelResizeLayer(x, need_backprop, image_ids)
         return x, label
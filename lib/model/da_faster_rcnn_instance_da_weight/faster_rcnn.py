@@ -13,7 +13,8 @@ from model.utils.net_utils import (
     _affine_theta,
     _crop_pool_layer,
     _smooth_l1_loss,
-    grad_reverse,
+    context_linear,
+    pad_rois,
 )
 from torch.autograd import Variable
 import pdb
@@ -58,6 +59,9 @@ class _fasterRCNN(nn.Module):
                 in_channel += 128
         print('Input Channel for RCNN Instance DA:', in_channel)
         self.RCNN_instanceDA = _InstanceDA(in_channel)
+        # instance DA labels, 1 for source and 0 for target rois
+        self.register_buffer("source_label", torch.ones(1), persistent=False)
+        self.register_buffer("target_label", torch.zeros(1), persistent=False)
 
     def forward(
         self,
@@ -74,15 +78,15 @@ class _fasterRCNN(nn.Module):
         # print("Input Image: ", im_data.shape)
         # print(im_data)
         # pdb.set_trace()
+        batch_size = im_data.size(0)
+        # one instance DA label per image, spread over its rois by image_ids
         if target:
-            need_backprop = torch.Tensor([0]).cuda()
+            need_backprop = self.target_label.expand(batch_size)
             self.RCNN_rpn.eval()
         else:
-            need_backprop = torch.Tensor([1]).cuda()
+            need_backprop = self.source_label.expand(batch_size)
             self.RCNN_rpn.train()
 
-        batch_size = im_data.size(0)
-
         im_info = im_info.data
         gt_boxes = gt_boxes.data
         num_boxes = num_boxes.data
@@ -91,28 +95,26 @@ class _fasterRCNN(nn.Module):
         base_feat1 = self.RCNN_base1(im_data)
         # print("base_feat1: ", base_feat1.shape)
         # print(base_feat1)
+        # the discriminators reverse the gradient of their logits into the
+        # backbone, the context vectors come from the same pass
         if self.lc:
-            d_pixel, _ = self.netD_pixel(grad_reverse(base_feat1, lambd=eta))
+            d_pixel, feat_pixel = self.netD_pixel(base_feat1, lambd=eta)
             # print(d_pixel)
-            # if not target:
-            if True:
-                _, feat_pixel = self.netD_pixel(base_feat1.detach())
         else:
-            d_pixel = self.netD_pixel(grad_reverse(base_feat1, lambd=eta))
+            d_pixel = self.netD_pixel(base_feat1, lambd=eta)
         base_feat = self.RCNN_base2(base_feat1)
         # print("base_feat: ", base_feat.shape)
         # print(base_feat)
         if self.gc:
-            domain_p, _ = self.netD(grad_reverse(base_feat, lambd=eta))
+            domain_p, feat = self.netD(base_feat, lambd=eta)
             # if target:
             #     return d_pixel,domain_p#, diff
-            _, feat = self.netD(base_feat.detach())
         else:
-            domain_p = self.netD(grad_reverse(base_feat, lambd=eta))
+            domain_p = self.netD(base_feat, lambd=eta)
             # if target:
             #     return d_pixel,domain_p#,diff
         # feed base feature map tp RPN to obtain rois
-        rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
+        rois, num_rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
             base_feat, im_info, gt_boxes, num_boxes
         )
         # supervise base feature map with category level label
@@ -123,8 +125,12 @@ class _fasterRCNN(nn.Module):
 
         # if it is training phrase, then use ground trubut bboxes for refining
         if self.training:
-            roi_data = self.RCNN_proposal_target(rois, gt_boxes, num_boxes)
+            roi_data = self.RCNN_proposal_target(rois, num_rois, gt_boxes, num_boxes)
             rois, rois_label, rois_target, rois_inside_ws, rois_outside_ws = roi_data
+            num_rois = num_rois.new(batch_size).fill_(rois.size(1))
+            # every image has the same number of sampled rois
+            max_rois = rois.size(1)
+            rois = rois.view(-1, 5)
 
             rois_label = Variable(rois_label.view(-1).long())
             rois_target = Variable(rois_target.view(-1, rois_target.size(2)))
@@ -133,6 +139,7 @@ class _fasterRCNN(nn.Module):
                 rois_outside_ws.view(-1, rois_outside_ws.size(2))
             )
         else:
+            max_rois = None
             rois_label = None
             rois_target = None
             rois_inside_ws = None
@@ -141,12 +148,17 @@ class _fasterRCNN(nn.Module):
             rpn_loss_bbox = 0
 
         rois = Variable(rois)
+        image_ids = rois.data[:, 0].long()
         # do roi pooling based on predicted rois
 
         if cfg.POOLING_MODE == "align":
-            pooled_feat = self.RCNN_roi_align(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_align(base_feat, rois)
         elif cfg.POOLING_MODE == "pool":
-            pooled_feat = self.RCNN_roi_pool(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_pool(base_feat, rois)
+        elif cfg.POOLING_MODE == "crop":
+            pooled_feat, _ = _crop_pool_layer(
+                base_feat, rois, cfg.CROP_RESIZE_WITH_MAX_POOL
+            )
 
         # feed pooled features to top model
         # print('pooled_feat (before):', type(pooled_feat), pooled_feat.shape)
@@ -154,30 +166,20 @@ class _fasterRCNN(nn.Module):
         pooled_feat = self._head_to_tail(pooled_feat)
         # print('pooled_feat (after):', type(pooled_feat), pooled_feat.shape)
         # print(pooled_feat)
-        instance_pooled_feat = pooled_feat
-        # print('instance_pooled_feat:', type(instance_pooled_feat), instance_pooled_feat.shape)
-        # print(instance_pooled_feat)
         # feat_pixel = torch.zeros(feat_pixel.size()).cuda()
-        if self.lc:
-            feat_pixel = feat_pixel.view(1, -1).repeat(pooled_feat.size(0), 1)
-            pooled_feat = torch.cat((feat_pixel, pooled_feat), 1)
-            if self.da_use_contex:
-                instance_pooled_feat = torch.cat(
-                    (feat_pixel.detach(), instance_pooled_feat), 1
-                )
-            # print('instance_pooled_feat after lc:', instance_pooled_feat)
+        # the image level context enters the heads once per image
+        context = []
         if self.gc:
-            feat = feat.view(1, -1).repeat(pooled_feat.size(0), 1)
-            pooled_feat = torch.cat((feat, pooled_feat), 1)
-            if self.da_use_contex:
-                instance_pooled_feat = torch.cat(
-                    (feat.detach(), instance_pooled_feat), 1
-                )
-            # print('instance_pooled_feat after gc:', instance_pooled_feat)
-            # compute bbox offset
+            context.append(feat.view(batch_size, -1))
+        if self.lc:
+            context.append(feat_pixel.view(batch_size, -1))
+        context = torch.cat(context, 1) if context else None
+        instance_context = None
+        if self.da_use_contex and context is not None:
+            instance_context = context.detach()
 
         # compute object classification probability
-        cls_score = self.RCNN_cls_score(pooled_feat)
+        cls_score = context_linear(self.RCNN_cls_score, pooled_feat, context, image_ids)
         cls_prob = F.softmax(cls_score, 1)
 
         # remove nan value
@@ -188,7 +190,7 @@ class _fasterRCNN(nn.Module):
 
         # add instance da
         instance_sigmoid, same_size_label = self.RCNN_instanceDA(
-            instance_pooled_feat, need_backprop
+            pooled_feat, need_backprop, instance_context, image_ids
         )
         # print (self.counter)
         # print ('instance_sigmoid: ', type(instance_sigmoid), len(instance_sigmoid))
@@ -198,23 +200,20 @@ class _fasterRCNN(nn.Module):
         # print (same_size_label)
 
         if target:
+            # weight each roi by how far its class score is from the image
+            # level score of that class, background rois keep weight 1
             cls_pre_label = cls_prob.argmax(1).detach()
-            cls_feat_sig = torch.sigmoid(cls_feat[0]).detach()
-            target_weight = []
-            for i in range(len(cls_pre_label)):
-                label_i = cls_pre_label[i].item()
-                if label_i > 0:
-                    diff_value = torch.exp(
-                        weight_value
-                        * torch.abs(cls_feat_sig[label_i - 1] - cls_prob[i][label_i])
-                    ).item()
-                    target_weight.append(diff_value)
-                else:
-                    target_weight.append(1.0)
-
-            instance_loss = nn.BCELoss(
-                weight=torch.Tensor(target_weight).view(-1, 1).cuda()
+            cls_feat_sig = torch.sigmoid(cls_feat).detach()
+            image_score = cls_feat_sig[image_ids, (cls_pre_label - 1).clamp(min=0)]
+            roi_score = cls_prob.detach().gather(1, cls_pre_label.view(-1, 1))
+            target_weight = torch.exp(
+                weight_value * torch.abs(image_score - roi_score.view(-1))
             )
+            target_weight = torch.where(
+                cls_pre_label > 0, target_weight, torch.ones_like(target_weight)
+            )
+
+            instance_loss = nn.BCELoss(weight=target_weight.view(-1, 1))
         else:
             instance_loss = nn.BCELoss()
         DA_ins_loss_cls = instance_loss(instance_sigmoid, same_size_label)
@@ -223,7 +222,7 @@ class _fasterRCNN(nn.Module):
             return d_pixel, domain_p, DA_ins_loss_cls
 
         # compute bbox offset
-        bbox_pred = self.RCNN_bbox_pred(pooled_feat)
+        bbox_pred = context_linear(self.RCNN_bbox_pred, pooled_feat, context, image_ids)
         if self.training and not self.class_agnostic:
             bbox_pred_view = bbox_pred.view(
                 bbox_pred.size(0), int(bbox_pred.size(1) / 4), 4
@@ -249,8 +248,10 @@ class _fasterRCNN(nn.Module):
                 bbox_pred, rois_target, rois_inside_ws, rois_outside_ws
             )
 
-        cls_prob = cls_prob.view(batch_size, rois.size(1), -1)
-        bbox_pred = bbox_pred.view(batch_size, rois.size(1), -1)
+        # the rois are packed over the batch, pad them to the longest image
+        cls_prob = pad_rois(cls_prob, image_ids, num_rois, max_rois)
+        bbox_pred = pad_rois(bbox_pred, image_ids, num_rois, max_rois)
+        rois = pad_rois(rois, image_ids, num_rois, max_rois)
 
         return (
             rois,
@@ -8,6 +8,7 @@ import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 from model.da_faster_rcnn_instance_da_weight.faster_rcnn import _fasterRCNN
 from model.utils.config import cfg
+from model.utils.net_utils import detach_input, grad_reverse, pool_context, reverse_into
 from torch.autograd import Variable
 
 __all__ = ["ResNet", "resnet18", "resnet34", "resnet50", "resnet101", "resnet152"]
@@ -63,16 +64,25 @@ class netD_pixel(nn.Module):
         normal_init(self.conv2, 0, 0.01)
         normal_init(self.conv3, 0, 0.01)
 
-    def forward(self, x):
-        x = F.relu(self.conv1(x))
-        x = F.relu(self.conv2(x))
+    def _trunk(self, h):
+        h = F.relu(self.conv1(h))
+        return F.relu(self.conv2(h))
+
+    def context_vector(self, x, context_crop=None):
+        """The context vector alone, without the domain classifier."""
+        return pool_context(self._trunk(x), context_crop)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # one trunk pass on a leaf copy of x: the context vector trains the
+        # trunk only, the logits also reverse their gradient into x
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = F.avg_pool2d(x, (x.size(2), x.size(3)))
-            x = self.conv3(x)
-            return torch.sigmoid(x), feat
+            feat = pool_context(h, context_crop)
+            h = reverse_into(h, trunk_input, x, lambd)
+            return torch.sigmoid(self.conv3(h)), feat
         else:
-            x = self.conv3(x)
-            return torch.sigmoid(x)
+            return torch.sigmoid(self.conv3(h))
 
 
 class netD(nn.Module):
@@ -88,15 +98,25 @@ class netD(nn.Module):
         self.context = context
         self.leaky_relu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
-    def forward(self, x):
-        x = F.dropout(F.relu(self.bn1(self.conv1(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn2(self.conv2(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn3(self.conv3(x))), training=self.training)
-        x = F.avg_pool2d(x, (x.size(2), x.size(3)))
-        x = x.view(-1, 128)
+    def _trunk(self, h):
+        h = F.dropout(F.relu(self.bn1(self.conv1(h))), training=self.training)
+        h = F.dropout(F.relu(self.bn2(self.conv2(h))), training=self.training)
+        return F.dropout(F.relu(self.bn3(self.conv3(h))), training=self.training)
+
+    def context_vector(self, x, context_crop=None):
+        """See netD_pixel.context_vector."""
+        return pool_context(self._trunk(x), context_crop).view(-1, 128)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # see netD_pixel.forward
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = x
-        x = self.fc(x)
+            feat = pool_context(h, context_crop).view(-1, 128)
+            h = reverse_into(h, trunk_input, x, lambd)
+        h = F.avg_pool2d(h, (h.size(2), h.size(3)))
+        h = h.view(-1, 128)
+        x = self.fc(h)
         if self.context:
             return x, feat
         else:
@@ -346,7 +366,7 @@ class resnet(_fasterRCNN):
             resnet = resnet50()
         if self.pretrained == True:
             print("Loading pretrained weights from %s" % (self.model_path))
-            state_dict = torch.load(self.model_path)
+            state_dict = torch.load(self.model_path, map_location="cpu")
             resnet.load_state_dict(
                 {k: v for k, v in state_dict.items() if k in resnet.state_dict()}
             )
@@ -11,6 +11,7 @@ import torch.nn.functional as F
 import torchvision.models as models
 from model.da_faster_rcnn_instance_da_weight.faster_rcnn import _fasterRCNN
 from model.utils.config import cfg
+from model.utils.net_utils import detach_input, grad_reverse, pool_context, reverse_into
 from torch.autograd import Variable
 
 
@@ -39,18 +40,29 @@ class netD_pixel(nn.Module):
 
         self.context = context
 
-    def forward(self, x):
-        x = F.relu(x)
-        x = F.relu(self.conv1(x))
-        x = F.relu(self.conv2(x))
+    def _trunk(self, h):
+        h = F.relu(h)
+        h = F.relu(self.conv1(h))
+        return F.relu(self.conv2(h))
+
+    def context_vector(self, x, context_crop=None):
+        """The context vector alone, without the domain classifier."""
+        return pool_context(self._trunk(x), context_crop)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # one trunk pass on a leaf copy of x: the context vector trains the
+        # trunk only, the logits also reverse their gradient into x
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = F.avg_pool2d(x, (x.size(2), x.size(3)))
+            feat = pool_context(h, context_crop)
             # feat = x
-            x = torch.sigmoid(self.conv3(x))
-            return x.view(-1, 1), feat  # torch.cat((feat1,feat2),1)#F
+            h = reverse_into(h, trunk_input, x, lambd)
+            h = torch.sigmoid(self.conv3(h))
+            return h.view(-1, 1), feat  # torch.cat((feat1,feat2),1)#F
         else:
-            x = torch.sigmoid(self.conv3(x))
-            return x.view(-1, 1)  # F.sigmoid(x)
+            h = torch.sigmoid(self.conv3(h))
+            return h.view(-1, 1)  # F.sigmoid(x)
 
 
 class netD(nn.Module):
@@ -65,15 +77,25 @@ class netD(nn.Module):
         self.fc = nn.Linear(128, 2)
         self.context = context
 
-    def forward(self, x):
-        x = F.dropout(F.relu(self.bn1(self.conv1(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn2(self.conv2(x))), training=self.training)
-        x = F.dropout(F.relu(self.bn3(self.conv3(x))), training=self.training)
-        x = F.avg_pool2d(x, (x.size(2), x.size(3)))
-        x = x.view(-1, 128)
+    def _trunk(self, h):
+        h = F.dropout(F.relu(self.bn1(self.conv1(h))), training=self.training)
+        h = F.dropout(F.relu(self.bn2(self.conv2(h))), training=self.training)
+        return F.dropout(F.relu(self.bn3(self.conv3(h))), training=self.training)
+
+    def context_vector(self, x, context_crop=None):
+        """See netD_pixel.context_vector."""
+        return pool_context(self._trunk(x), context_crop).view(-1, 128)
+
+    def forward(self, x, lambd=1.0, context_crop=None):
+        # see netD_pixel.forward
+        h = trunk_input = detach_input(x) if self.context else grad_reverse(x, lambd)
+        h = self._trunk(h)
         if self.context:
-            feat = x
-        x = self.fc(x)
+            feat = pool_context(h, context_crop).view(-1, 128)
+            h = reverse_into(h, trunk_input, x, lambd)
+        h = F.avg_pool2d(h, (h.size(2), h.size(3)))
+        h = h.view(-1, 128)
+        x = self.fc(h)
         if self.context:
             return x, feat  # torch.cat((feat1,feat2),1)#F
         else:
@@ -124,7 +146,7 @@ class vgg16(_fasterRCNN):
         print('VGG: ', vgg)
         if self.pretrained:
             print("Loading pretrained weights from %s" % (self.model_path))
-            state_dict = torch.load(self.model_path)
+            state_dict = torch.load(self.model_path, map_location="cpu")
             vgg.load_state_dict(
                 {k: v for k, v in state_dict.items() if k in vgg.state_dict()}
             )
@@ -12,6 +12,7 @@ from model.utils.net_utils import (
     _affine_theta,
     _crop_pool_layer,
     _smooth_l1_loss,
+    pad_rois,
 )
 from torch.autograd import Variable
 
@@ -43,6 +44,18 @@ class _fasterRCNN(nn.Module):
             (cfg.POOLING_SIZE, cfg.POOLING_SIZE), 1.0 / 16.0, 0
         )
 
+    def detect(self, im_data, im_info):
+        """Detection-only forward for evaluation, like the DA models' detect().
+
+        Returns the rois, cls_prob and bbox_pred that forward returns in eval
+        mode; the RPN does not read gt boxes then, so none are passed.
+        """
+        assert not self.training, "detect() runs in eval mode only"
+        batch_size = im_data.size(0)
+        gt_boxes = im_info.new_zeros(batch_size, 1, 5)
+        num_boxes = im_info.new_zeros(batch_size, dtype=torch.long)
+        return self.forward(im_data, im_info, gt_boxes, num_boxes)[:3]
+
     def forward(self, im_data, im_info, gt_boxes, num_boxes):
         batch_size = im_data.size(0)
 
@@ -57,14 +70,18 @@ class _fasterRCNN(nn.Module):
         # rois, tmp, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
         #     base_feat, im_info, gt_boxes, num_boxes
         # )
-        rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
+        rois, num_rois, rpn_loss_cls, rpn_loss_bbox = self.RCNN_rpn(
             base_feat, im_info, gt_boxes, num_boxes
         )
 
         # if it is training phrase, then use ground trubut bboxes for refining
         if self.training:
-            roi_data = self.RCNN_proposal_target(rois, gt_boxes, num_boxes)
+            roi_data = self.RCNN_proposal_target(rois, num_rois, gt_boxes, num_boxes)
             rois, rois_label, rois_target, rois_inside_ws, rois_outside_ws = roi_data
+            num_rois = num_rois.new(batch_size).fill_(rois.size(1))
+            # every image has the same number of sampled rois
+            max_rois = rois.size(1)
+            rois = rois.view(-1, 5)
 
             rois_label = Variable(rois_label.view(-1).long())
             rois_target = Variable(rois_target.view(-1, rois_target.size(2)))
@@ -73,6 +90,7 @@ class _fasterRCNN(nn.Module):
                 rois_outside_ws.view(-1, rois_outside_ws.size(2))
             )
         else:
+            max_rois = None
             rois_label = None
             rois_target = None
             rois_inside_ws = None
@@ -81,12 +99,17 @@ class _fasterRCNN(nn.Module):
             rpn_loss_bbox = 0
 
         rois = Variable(rois)
+        image_ids = rois.data[:, 0].long()
         # do roi pooling based on predicted rois
 
         if cfg.POOLING_MODE == "align":
-            pooled_feat = self.RCNN_roi_align(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_align(base_feat, rois)
         elif cfg.POOLING_MODE == "pool":
-            pooled_feat = self.RCNN_roi_pool(base_feat, rois.view(-1, 5))
+            pooled_feat = self.RCNN_roi_pool(base_feat, rois)
+        elif cfg.POOLING_MODE == "crop":
+            pooled_feat, _ = _crop_pool_layer(
+                base_feat, rois, cfg.CROP_RESIZE_WITH_MAX_POOL
+            )
 
         # feed pooled features to top model
         pooled_feat = self._head_to_tail(pooled_feat)
@@ -123,8 +146,10 @@ class _fasterRCNN(nn.Module):
                 bbox_pred, rois_target, rois_inside_ws, rois_outside_ws
             )
 
-        cls_prob = cls_prob.view(batch_size, rois.size(1), -1)
-        bbox_pred = bbox_pred.view(batch_size, rois.size(1), -1)
+        # the rois are packed over the batch, pad them to the longest image
+        cls_prob = pad_rois(cls_prob, image_ids, num_rois, max_rois)
+        bbox_pred = pad_rois(bbox_pred, image_ids, num_rois, max_rois)
+        rois = pad_rois(rois, image_ids, num_rois, max_rois)
 
         return (
             rois,
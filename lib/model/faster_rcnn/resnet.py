@@ -240,7 +240,7 @@ class resnet(_fasterRCNN):
 
         if self.pretrained == True:
             print("Loading pretrained weights from %s" % (self.model_path))
-            state_dict = torch.load(self.model_path)
+            state_dict = torch.load(self.model_path, map_location="cpu")
             resnet.load_state_dict(
                 {k: v for k, v in state_dict.items() if k in resnet.state_dict()}
             )
@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .generate_anchors import generate_anchors
+
+# --------------------------------------------------------
+# Shifted anchor grids shared by the proposal and anchor target layers
+# --------------------------------------------------------
+
+# grids are kept per (feat_height, feat_width, stride, scales, ratios, device,
+# dtype); least recently used ones are dropped past this many entries
+MAX_CACHED_GRIDS = 64
+
+_grids = OrderedDict()
+
+
+def _key(feat_height, feat_width, feat_stride, scales, ratios, device, dtype):
+    return (
+        int(feat_height),
+        int(feat_width),
+        int(feat_stride),
+        tuple(float(s) for s in scales),
+        tuple(float(r) for r in ratios),
+        str(device),
+        dtype,
+    )
+
+
+def _build(feat_height, feat_width, feat_stride, scales, ratios, device, dtype):
+    base = torch.from_numpy(
+        generate_anchors(scales=np.array(scales), ratios=np.array(ratios))
+    ).to(device=device, dtype=dtype)
+    shift_x = torch.arange(0, feat_width, device=device, dtype=dtype) * feat_stride
+    shift_y = torch.arange(0, feat_height, device=device, dtype=dtype) * feat_stride
+    # same (row major, x fastest) order as np.meshgrid(shift_x, shift_y)
+    shift_x = shift_x.view(1, -1).expand(feat_height, feat_width).reshape(-1)
+    shift_y = shift_y.view(-1, 1).expand(feat_height, feat_width).reshape(-1)
+    shifts = torch.stack((shift_x, shift_y, shift_x, shift_y), 1)
+
+    A = base.size(0)
+    K = shifts.size(0)
+    return (base.view(1, A, 4) + shifts.view(K, 1, 4)).view(K * A, 4)
+
+
+def anchor_grid(feat_height, feat_width, feat_stride, scales, ratios, like):
+    """All anchors of a feat_height x feat_width map, as a (K * A, 4) tensor
+    on the device and in the dtype of like.
+
+    The tensor is shared between callers and must not be modified in place.
+    """
+    key = _key(
+        feat_height, feat_width, feat_stride, scales, ratios, like.device, like.dtype
+    )
+    grid = _grids.pop(key, None)
+    if grid is None:
+        grid = _build(
+            feat_height,
+            feat_width,
+            feat_stride,
+            scales,
+            ratios,
+            like.device,
+            like.dtype,
+        )
+    _grids[key] = grid
+    while len(_grids) > MAX_CACHED_GRIDS:
+        _grids.popitem(last=False)
+    return grid
+
+
+def precompute_anchor_grids(im_sizes, feat_stride, scales, ratios, like):
+    """Build the grids for a set of (height, width) input sizes up front.
+
+    Backbones round the feature map size up or down depending on their
+    pooling, so both candidates are built for each input size.
+    """
+    for height, width in im_sizes:
+        feat_sizes = set(
+            (rnd(height / float(feat_stride)), rnd(width / float(feat_stride)))
+            for rnd in (math.floor, math.ceil)
+        )
+        for feat_height, feat_width in feat_sizes:
+            anchor_grid(
+                int(feat_height), int(feat_width), feat_stride, scales, ratios, like
+            )
+
+
+def clear_anchor_grids():
+    _grids.clear()
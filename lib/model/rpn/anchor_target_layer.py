@@ -1,12 +1,12 @@
 from __future__ import absolute_import
 
 import numpy as np
-import numpy.random as npr
 import torch
 import torch.nn as nn
 from model.utils.config import cfg
 
-from .bbox_transform import bbox_overlaps_batch, bbox_transform_batch, clip_boxes
+from .anchor_grid import anchor_grid
+from .bbox_transform import anchor_overlaps_reduced, bbox_transform_batch, clip_boxes
 from .generate_anchors import generate_anchors
 
 # --------------------------------------------------------
@@ -39,6 +39,7 @@ class _AnchorTargetLayer(nn.Module):
 
         self._feat_stride = feat_stride
         self._scales = scales
+        self._ratios = ratios
         anchor_scales = scales
         self._anchors = torch.from_numpy(
             generate_anchors(scales=np.array(anchor_scales), ratios=np.array(ratios))
@@ -67,57 +68,55 @@ class _AnchorTargetLayer(nn.Module):
         batch_size = gt_boxes.size(0)
 
         feat_height, feat_width = rpn_cls_score.size(2), rpn_cls_score.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(
-            np.vstack(
-                (shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())
-            ).transpose()
+        all_anchors = anchor_grid(
+            feat_height,
+            feat_width,
+            self._feat_stride,
+            self._scales,
+            self._ratios,
+            gt_boxes,
         )
-        shifts = shifts.contiguous().type_as(rpn_cls_score).float()
-
         A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(gt_boxes)  # move to specific gpu.
-        all_anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        all_anchors = all_anchors.view(K * A, 4)
-
-        total_anchors = int(K * A)
+        total_anchors = all_anchors.size(0)
 
+        # anchors inside the largest image of the batch, smaller images of
+        # the batch are padded and mask out their own outside anchors below
+        im_width = im_info[:, 1].floor()
+        im_height = im_info[:, 0].floor()
         keep = (
             (all_anchors[:, 0] >= -self._allowed_border)
             & (all_anchors[:, 1] >= -self._allowed_border)
-            & (all_anchors[:, 2] < long(im_info[0][1]) + self._allowed_border)
-            & (all_anchors[:, 3] < long(im_info[0][0]) + self._allowed_border)
+            & (all_anchors[:, 2] < long(im_width.max()) + self._allowed_border)
+            & (all_anchors[:, 3] < long(im_height.max()) + self._allowed_border)
         )
 
         inds_inside = torch.nonzero(keep).view(-1)
 
         # keep only inside anchors
         anchors = all_anchors[inds_inside, :]
+        outside = (
+            anchors[:, 2].view(1, -1)
+            >= im_width.view(-1, 1).type_as(anchors) + self._allowed_border
+        ) | (
+            anchors[:, 3].view(1, -1)
+            >= im_height.view(-1, 1).type_as(anchors) + self._allowed_border
+        )
 
         # label: 1 is positive, 0 is negative, -1 is dont care
         labels = gt_boxes.new(batch_size, inds_inside.size(0)).fill_(-1)
         bbox_inside_weights = gt_boxes.new(batch_size, inds_inside.size(0)).zero_()
         bbox_outside_weights = gt_boxes.new(batch_size, inds_inside.size(0)).zero_()
 
-        overlaps = bbox_overlaps_batch(anchors, gt_boxes)
-
-        max_overlaps, argmax_overlaps = torch.max(overlaps, 2)
-        gt_max_overlaps, _ = torch.max(overlaps, 1)
+        # keep is the number of gt boxes an anchor is the best anchor of; the
+        # full (batch, anchors, gt) overlap matrix is never built
+        max_overlaps, argmax_overlaps, keep = anchor_overlaps_reduced(
+            anchors, gt_boxes, num_boxes, cfg.TRAIN.RPN_OVERLAPS_MB * 1024 * 1024
+        )
 
         if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
             labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
 
-        gt_max_overlaps[gt_max_overlaps == 0] = 1e-5
-        keep = torch.sum(
-            overlaps.eq(gt_max_overlaps.view(batch_size, 1, -1).expand_as(overlaps)), 2
-        )
-
-        if torch.sum(keep) > 0:
-            labels[keep > 0] = 1
+        labels[keep > 0] = 1
 
         # fg label: above threshold IOU
         labels[max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP] = 1
@@ -125,42 +124,20 @@ class _AnchorTargetLayer(nn.Module):
         if cfg.TRAIN.RPN_CLOBBER_POSITIVES:
             labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
 
+        # anchors outside of their own image are don't care
+        labels[outside] = -1
+
         num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCHSIZE)
 
-        sum_fg = torch.sum((labels == 1).int(), 1)
-        sum_bg = torch.sum((labels == 0).int(), 1)
-
-        for i in range(batch_size):
-            # subsample positive labels if we have too many
-            if sum_fg[i] > num_fg:
-                fg_inds = torch.nonzero(labels[i] == 1).view(-1)
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                # rand_num = torch.randperm(fg_inds.size(0)).type_as(gt_boxes).long()
-                rand_num = (
-                    torch.from_numpy(np.random.permutation(fg_inds.size(0)))
-                    .type_as(gt_boxes)
-                    .long()
-                )
-                disable_inds = fg_inds[rand_num[: fg_inds.size(0) - num_fg]]
-                labels[i][disable_inds] = -1
-
-            #           num_bg = cfg.TRAIN.RPN_BATCHSIZE - sum_fg[i]
-            num_bg = cfg.TRAIN.RPN_BATCHSIZE - torch.sum((labels == 1).int(), 1)[i]
-
-            # subsample negative labels if we have too many
-            if sum_bg[i] > num_bg:
-                bg_inds = torch.nonzero(labels[i] == 0).view(-1)
-                # rand_num = torch.randperm(bg_inds.size(0)).type_as(gt_boxes).long()
-
-                rand_num = (
-                    torch.from_numpy(np.random.permutation(bg_inds.size(0)))
-                    .type_as(gt_boxes)
-                    .long()
-                )
-                disable_inds = bg_inds[rand_num[: bg_inds.size(0) - num_bg]]
-                labels[i][disable_inds] = -1
+        # subsample positive labels if we have too many
+        fg = labels == 1
+        labels[fg & (_random_subset(fg, num_fg, num_fg) == 0)] = -1
+
+        # subsample negative labels if we have too many
+        num_bg = cfg.TRAIN.RPN_BATCHSIZE - torch.sum((labels == 1).int(), 1)
+        bg = labels == 0
+        bg_keep = _random_subset(bg, num_bg, cfg.TRAIN.RPN_BATCHSIZE)
+        labels[bg & (bg_keep == 0)] = -1
 
         offset = torch.arange(0, batch_size) * gt_boxes.size(1)
 
@@ -176,16 +153,21 @@ class _AnchorTargetLayer(nn.Module):
         bbox_inside_weights[labels == 1] = cfg.TRAIN.RPN_BBOX_INSIDE_WEIGHTS[0]
 
         if cfg.TRAIN.RPN_POSITIVE_WEIGHT < 0:
-            num_examples = torch.sum(labels[i] >= 0)
-            positive_weights = 1.0 / num_examples.item()
-            negative_weights = 1.0 / num_examples.item()
+            # uniform weighting over the sampled anchors of each image
+            num_examples = torch.sum(labels >= 0, 1).clamp(min=1)
+            positive_weights = (
+                (1.0 / num_examples.type_as(bbox_outside_weights))
+                .view(batch_size, 1)
+                .expand_as(bbox_outside_weights)
+            )
+            negative_weights = positive_weights
         else:
             assert (cfg.TRAIN.RPN_POSITIVE_WEIGHT > 0) & (
                 cfg.TRAIN.RPN_POSITIVE_WEIGHT < 1
             )
 
-        bbox_outside_weights[labels == 1] = positive_weights
-        bbox_outside_weights[labels == 0] = negative_weights
+        bbox_outside_weights[labels == 1] = positive_weights[labels == 1]
+        bbox_outside_weights[labels == 0] = negative_weights[labels == 0]
 
         labels = _unmap(labels, total_anchors, inds_inside, batch_size, fill=-1)
         bbox_targets = _unmap(
@@ -247,6 +229,27 @@ class _AnchorTargetLayer(nn.Module):
         """Reshaping happens during the call to forward."""
 
 
+def _random_subset(mask, num_keep, max_keep):
+    """Pick up to num_keep random entries from each row of a (b, N) mask.
+
+    num_keep is an int or a (b,) tensor of values no larger than max_keep.
+    Every entry of the mask gets a random key in [0, 1) and every other entry
+    -1, so the top keys of a row are a random subset of its mask.
+    """
+    picked = torch.zeros_like(mask)
+    k = min(int(max_keep), mask.size(1))
+    if k <= 0:
+        return picked
+    keys = torch.rand(mask.size(), device=mask.device).masked_fill_(mask == 0, -1)
+    top_keys, top_inds = torch.topk(keys, k, 1)
+    if torch.is_tensor(num_keep):
+        num_keep = num_keep.view(-1, 1)
+    ranks = torch.arange(k, device=mask.device).view(1, -1)
+    take = (top_keys >= 0) & (ranks < num_keep)
+    picked.scatter_(1, top_inds, take.type_as(picked))
+    return picked
+
+
 def _unmap(data, count, inds, batch_size, fill=0):
     """ Unmap a subset of item (data) back to the original set of items (of
     size count) """
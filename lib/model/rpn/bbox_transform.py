@@ -286,3 +286,102 @@ def bbox_overlaps_batch(anchors, gt_boxes):
         raise ValueError("anchors input dimension is not correct.")
 
     return overlaps
+
+
+def _anchor_overlaps_chunk(anchors, anchors_area, gt_boxes, gt_area, ignore):
+    """IoU of (n, 4) anchors against (b, K, 4) gt boxes, as a (b, n, K) tensor.
+
+    The boxes are broadcast against each other, so only the result and its
+    few temporaries are allocated.
+    """
+    batch_size = gt_boxes.size(0)
+    K = gt_boxes.size(1)
+
+    boxes = anchors.view(1, -1, 1, 4)
+    query_boxes = gt_boxes.view(batch_size, 1, K, 4)
+    iw = (
+        torch.min(boxes[..., 2], query_boxes[..., 2])
+        - torch.max(boxes[..., 0], query_boxes[..., 0])
+        + 1
+    ).clamp_(min=0)
+    ih = (
+        torch.min(boxes[..., 3], query_boxes[..., 3])
+        - torch.max(boxes[..., 1], query_boxes[..., 1])
+        + 1
+    ).clamp_(min=0)
+    inter = iw.mul_(ih)
+    overlaps = inter / (anchors_area.view(1, -1, 1) + gt_area - inter)
+    return overlaps.masked_fill_(ignore, 0)
+
+
+def anchor_overlaps_reduced(anchors, gt_boxes, num_boxes, max_bytes):
+    """Reductions of the anchor/gt IoU matrix, computed in anchor chunks.
+
+    anchors: (N, 4) tensor, shared by the batch
+    gt_boxes: (b, K, 5) tensor, padded past num_boxes
+    num_boxes: (b,) number of real gt boxes of each image
+
+    All gt slots are looked at, the padded ones masked, so the shapes do not
+    depend on num_boxes and nothing is read back to the host. The IoU is
+    computed for as many anchors at a time as fit in about max_bytes.
+
+    Returns:
+        max_overlaps: (b, N) best IoU of each anchor
+        argmax_overlaps: (b, N) index of that gt box
+        num_best: (b, N) number of gt boxes for which the anchor has the
+            highest IoU of all anchors
+    """
+    batch_size = gt_boxes.size(0)
+    N = anchors.size(0)
+    K = gt_boxes.size(1)
+
+    gt_boxes = gt_boxes[:, :, :4].contiguous()
+    gt_boxes_x = gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1
+    gt_boxes_y = gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1
+    gt_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
+    # padded slots and degenerate gt boxes overlap nothing
+    ignore = (
+        torch.arange(K, device=gt_boxes.device).view(1, K)
+        >= num_boxes.view(-1, 1).long()
+    ) | ((gt_boxes_x == 1) & (gt_boxes_y == 1))
+    ignore = ignore.view(batch_size, 1, K)
+
+    anchors_area = (anchors[:, 2] - anchors[:, 0] + 1) * (
+        anchors[:, 3] - anchors[:, 1] + 1
+    )
+
+    # about four (b, chunk, K) temporaries are alive while a chunk is reduced
+    chunk = int(max_bytes // (4 * batch_size * K * gt_boxes.element_size()))
+    chunk = max(chunk, 1)
+    starts = range(0, N, chunk)
+
+    def overlaps_at(start):
+        end = min(start + chunk, N)
+        return _anchor_overlaps_chunk(
+            anchors[start:end], anchors_area[start:end], gt_boxes, gt_area, ignore
+        )
+
+    max_overlaps = gt_boxes.new(batch_size, N)
+    argmax_overlaps = gt_boxes.new(batch_size, N).long()
+    gt_max_overlaps = gt_boxes.new(batch_size, K).zero_()
+    overlaps = None
+    for start in starts:
+        overlaps = overlaps_at(start)
+        end = start + overlaps.size(1)
+        max_overlaps[:, start:end], argmax_overlaps[:, start:end] = torch.max(
+            overlaps, 2
+        )
+        gt_max_overlaps = torch.max(gt_max_overlaps, overlaps.max(1)[0])
+
+    # the best anchors of a gt box are only known after every chunk was seen,
+    # so the overlaps are computed again unless they fit in a single chunk
+    gt_max_overlaps[gt_max_overlaps == 0] = 1e-5
+    gt_max_overlaps = gt_max_overlaps.view(batch_size, 1, K)
+    num_best = argmax_overlaps.new(batch_size, N)
+    for start in starts:
+        if len(starts) > 1:
+            overlaps = overlaps_at(start)
+        end = start + overlaps.size(1)
+        num_best[:, start:end] = torch.sum(overlaps.eq(gt_max_overlaps), 2)
+
+    return max_overlaps, argmax_overlaps, num_best
@@ -9,6 +9,7 @@ import yaml
 from model.roi_layers import nms
 from model.utils.config import cfg
 
+from .anchor_grid import anchor_grid
 from .bbox_transform import bbox_transform_inv, clip_boxes, clip_boxes_batch
 from .generate_anchors import generate_anchors
 
@@ -36,6 +37,8 @@ class _ProposalLayer(nn.Module):
         super(_ProposalLayer, self).__init__()
 
         self._feat_stride = feat_stride
+        self._scales = scales
+        self._ratios = ratios
         self._anchors = torch.from_numpy(
             generate_anchors(scales=np.array(scales), ratios=np.array(ratios))
         ).float()
@@ -80,23 +83,15 @@ class _ProposalLayer(nn.Module):
         batch_size = bbox_deltas.size(0)
 
         feat_height, feat_width = scores.size(2), scores.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(
-            np.vstack(
-                (shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())
-            ).transpose()
+        anchors = anchor_grid(
+            feat_height,
+            feat_width,
+            self._feat_stride,
+            self._scales,
+            self._ratios,
+            scores,
         )
-        shifts = shifts.contiguous().type_as(scores).float()
-
-        A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(scores)
-        # anchors = self._anchors.view(1, A, 4) + shifts.view(1, K, 4).permute(1, 0, 2).contiguous()
-        anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        anchors = anchors.view(1, K * A, 4).expand(batch_size, K * A, 4)
+        anchors = anchors.view(1, -1, 4).expand(batch_size, anchors.size(0), 4)
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
@@ -108,73 +103,81 @@ class _ProposalLayer(nn.Module):
         scores = scores.permute(0, 2, 3, 1).contiguous()
         scores = scores.view(batch_size, -1)
 
-        # Convert anchors into proposals via bbox transformations
-        proposals = bbox_transform_inv(anchors, bbox_deltas, batch_size)
-
-        # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info, batch_size)
-        # proposals = clip_boxes_batch(proposals, im_info, batch_size)
-
-        # assign the score to 0 if it's non keep.
-        # keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
-
-        # trim keep index to make it euqal over batch
-        # keep_idx = torch.cat(tuple(keep_idx), 0)
-
-        # scores_keep = scores.view(-1)[keep_idx].view(batch_size, trim_size)
-        # proposals_keep = proposals.view(-1, 4)[keep_idx, :].contiguous().view(batch_size, trim_size, 4)
-
-        # _, order = torch.sort(scores_keep, 1, True)
-
-        scores_keep = scores
-        proposals_keep = proposals
-        _, order = torch.sort(scores_keep, 1, True)
-
-        output = scores.new(batch_size, post_nms_topN, 5).zero_()
-        output_da = scores.new(batch_size, post_nms_topN, 5).zero_()
-        for i in range(batch_size):
-            # # 3. remove predicted boxes with either height or width < threshold
-            # # (NOTE: convert min_size to input image scale stored in im_info[2])
-            proposals_single = proposals_keep[i]
-            scores_single = scores_keep[i]
-
-            # # 4. sort all (proposal, score) pairs by score from highest to lowest
-            # # 5. take top pre_nms_topN (e.g. 6000)
-            order_single = order[i]
-
-            if pre_nms_topN > 0 and pre_nms_topN < scores_keep.numel():
-                order_single = order_single[:pre_nms_topN]
-
-            proposals_single = proposals_single[order_single, :]
-            scores_single = scores_single[order_single].view(-1, 1)
-
-            # 6. apply nms (e.g. threshold = 0.7)
-            # 7. take after_nms_topN (e.g. 300)
-            # 8. return the top proposals (-> RoIs top)
-            keep_idx_i = nms(proposals_single, scores_single.squeeze(1), nms_thresh)
-            keep_idx_i = keep_idx_i.long().view(-1)
-
-            # keep_idx_i_da = nms(proposals_single, scores_single.squeeze(1), 0.5)
-            # keep_idx_i_da = keep_idx_i_da.long().view(-1)
-            # if post_nms_topN > 0:
-            #     keep_idx_i_da = keep_idx_i_da[:post_nms_topN]
-            # proposals_single_da = proposals_single[keep_idx_i_da, :]
-
-            if post_nms_topN > 0:
-                keep_idx_i = keep_idx_i[:post_nms_topN]
-            proposals_single = proposals_single[keep_idx_i, :]
-            scores_single = scores_single[keep_idx_i, :]
-
-            # padding 0 at the end.
-            num_proposal = proposals_single.size(0)
-            output[i, :, 0] = i
-            output[i, :num_proposal, 1:] = proposals_single
-
-            # num_proposal_da = proposals_single_da.size(0)
-            # output_da[i, :, 0] = i
-            # output_da[i, :num_proposal_da, 1:] = proposals_single_da
-
-        return output
+        # 3. remove predicted boxes with either height or width < threshold
+        # (NOTE: convert min_size to input image scale stored in im_info[2])
+        # 4. sort all (proposal, score) pairs by score from highest to lowest
+        # 5. take top pre_nms_topN (e.g. 6000)
+        # topk only orders the pre_nms_topN kept scores instead of all K * A
+        num_top = scores.size(1)
+        if pre_nms_topN > 0:
+            num_top = min(pre_nms_topN, num_top)
+
+        if cfg[cfg_key].RPN_GATHER_BEFORE_DECODE:
+            # select on the raw scores and decode only the selected deltas,
+            # small boxes are then dropped from the selection
+            scores_keep, order = torch.topk(scores, num_top, 1)
+            index = order.unsqueeze(2).expand(batch_size, num_top, 4)
+            proposals_keep = bbox_transform_inv(
+                anchors.gather(1, index), bbox_deltas.gather(1, index), batch_size
+            )
+            proposals_keep = clip_boxes(proposals_keep, im_info, batch_size)
+            keep = self._filter_boxes(proposals_keep, min_size * im_info[:, 2])
+        else:
+            # Convert anchors into proposals via bbox transformations
+            proposals = bbox_transform_inv(anchors, bbox_deltas, batch_size)
+
+            # 2. clip predicted boxes to image
+            proposals = clip_boxes(proposals, im_info, batch_size)
+            # proposals = clip_boxes_batch(proposals, im_info, batch_size)
+
+            # small boxes are pushed to the end of the selection and masked out
+            keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
+            scores_keep, order = torch.topk(
+                scores.masked_fill(keep == 0, float("-inf")), num_top, 1
+            )
+            index = order.unsqueeze(2).expand(batch_size, num_top, 4)
+            proposals_keep = proposals.gather(1, index)
+            keep = keep.gather(1, order)
+
+        # the proposals of all images are packed into one (R, 5) tensor, grouped
+        # by image, and num_rois holds the number of proposals of each image
+        num_rois = torch.zeros(batch_size, dtype=torch.long, device=order.device)
+        flat_keep = torch.nonzero(keep.view(-1)).view(-1)
+        if flat_keep.numel() == 0:
+            return scores.new(0, 5), num_rois
+        image_ids = torch.arange(batch_size, device=order.device).view(-1, 1)
+        image_ids = image_ids.expand(batch_size, num_top).reshape(-1)[flat_keep]
+        proposals_flat = proposals_keep.view(-1, 4)[flat_keep]
+        scores_flat = scores_keep.view(-1)[flat_keep]
+
+        # 6. apply nms (e.g. threshold = 0.7)
+        # all images go through one nms call: shifting the boxes of image i by
+        # i times the largest coordinate keeps images from suppressing each other
+        offsets = image_ids.view(-1, 1).type_as(proposals_flat) * (
+            proposals_flat.max() + 1
+        )
+        keep_idx = nms(proposals_flat + offsets, scores_flat, nms_thresh)
+        keep_idx = keep_idx.long().view(-1)
+        image_ids = image_ids[keep_idx]
+
+        # 7. take after_nms_topN (e.g. 300)
+        if post_nms_topN > 0:
+            # nms returns kept indices in input order, which is by decreasing
+            # score within an image, so the rank of a box is a running count
+            one_hot = image_ids.new(image_ids.size(0), batch_size).zero_()
+            one_hot.scatter_(1, image_ids.view(-1, 1), 1)
+            rank = one_hot.cumsum(0).gather(1, image_ids.view(-1, 1)).view(-1) - 1
+            select = torch.nonzero(rank < post_nms_topN).view(-1)
+            keep_idx = keep_idx[select]
+            image_ids = image_ids[select]
+
+        # 8. return the top proposals (-> RoIs top)
+        rois = torch.cat(
+            (image_ids.view(-1, 1).type_as(proposals_flat), proposals_flat[keep_idx]),
+            1,
+        )
+        num_rois += torch.bincount(image_ids, minlength=batch_size)
+        return rois, num_rois
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
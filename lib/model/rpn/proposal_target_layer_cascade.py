@@ -1,11 +1,11 @@
 from __future__ import absolute_import
 
 import numpy as np
-import numpy.random as npr
 import torch
 import torch.nn as nn
 
 from ..utils.config import cfg
+from ..utils.net_utils import pad_rois
 from .bbox_transform import bbox_overlaps_batch, bbox_transform_batch
 
 # --------------------------------------------------------
@@ -28,15 +28,35 @@ class _ProposalTargetLayer(nn.Module):
     def __init__(self, nclasses):
         super(_ProposalTargetLayer, self).__init__()
         self._num_classes = nclasses
-        self.BBOX_NORMALIZE_MEANS = torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
-        self.BBOX_NORMALIZE_STDS = torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS)
-        self.BBOX_INSIDE_WEIGHTS = torch.FloatTensor(cfg.TRAIN.BBOX_INSIDE_WEIGHTS)
-
-    def forward(self, all_rois, gt_boxes, num_boxes):
+        # constants follow the model to its device, they are not checkpointed
+        self.register_buffer(
+            "BBOX_NORMALIZE_MEANS",
+            torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS),
+            persistent=False,
+        )
+        self.register_buffer(
+            "BBOX_NORMALIZE_STDS",
+            torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS),
+            persistent=False,
+        )
+        self.register_buffer(
+            "BBOX_INSIDE_WEIGHTS",
+            torch.FloatTensor(cfg.TRAIN.BBOX_INSIDE_WEIGHTS),
+            persistent=False,
+        )
 
-        self.BBOX_NORMALIZE_MEANS = self.BBOX_NORMALIZE_MEANS.type_as(gt_boxes)
-        self.BBOX_NORMALIZE_STDS = self.BBOX_NORMALIZE_STDS.type_as(gt_boxes)
-        self.BBOX_INSIDE_WEIGHTS = self.BBOX_INSIDE_WEIGHTS.type_as(gt_boxes)
+    def forward(self, all_rois, num_rois, gt_boxes, num_boxes):
+
+        # the packed proposals are padded to the most the proposal layer keeps
+        # per image, a static size; the zero boxes overlap no gt box and are
+        # never sampled
+        post_nms_topN = cfg.TRAIN.RPN_POST_NMS_TOP_N
+        all_rois = pad_rois(
+            all_rois,
+            all_rois[:, 0].long(),
+            num_rois,
+            post_nms_topN if post_nms_topN > 0 else None,
+        )
 
         gt_boxes_append = gt_boxes.new(gt_boxes.size()).zero_()
         gt_boxes_append[:, :, 1:5] = gt_boxes[:, :, :4]
@@ -44,8 +64,9 @@ class _ProposalTargetLayer(nn.Module):
         # Include ground-truth boxes in the set of candidate rois
         all_rois = torch.cat([all_rois, gt_boxes_append], 1)
 
-        num_images = 1
-        rois_per_image = int(cfg.TRAIN.BATCH_SIZE / num_images)
+        # cfg.TRAIN.BATCH_SIZE counts the ROIs sampled from each image, every
+        # image of the minibatch is sampled against its own gt boxes
+        rois_per_image = int(cfg.TRAIN.BATCH_SIZE)
         fg_rois_per_image = int(np.round(cfg.TRAIN.FG_FRACTION * rois_per_image))
         fg_rois_per_image = 1 if fg_rois_per_image == 0 else fg_rois_per_image
 
@@ -76,21 +97,10 @@ class _ProposalTargetLayer(nn.Module):
             bbox_target (ndarray): b x N x 4K blob of regression targets
             bbox_inside_weights (ndarray): b x N x 4K blob of loss weights
         """
-        batch_size = labels_batch.size(0)
-        rois_per_image = labels_batch.size(1)
-        clss = labels_batch
-        bbox_targets = bbox_target_data.new(batch_size, rois_per_image, 4).zero_()
-        bbox_inside_weights = bbox_target_data.new(bbox_targets.size()).zero_()
-
-        for b in range(batch_size):
-            # assert clss[b].sum() > 0
-            if clss[b].sum() == 0:
-                continue
-            inds = torch.nonzero(clss[b] > 0).view(-1)
-            for i in range(inds.numel()):
-                ind = inds[i]
-                bbox_targets[b, ind, :] = bbox_target_data[b, ind, :]
-                bbox_inside_weights[b, ind, :] = self.BBOX_INSIDE_WEIGHTS
+        # only the foreground rois keep their targets and weights
+        fg = (labels_batch > 0).unsqueeze(2).type_as(bbox_target_data)
+        bbox_targets = bbox_target_data * fg
+        bbox_inside_weights = self.BBOX_INSIDE_WEIGHTS.view(1, 1, 4) * fg
 
         return bbox_targets, bbox_inside_weights
 
@@ -141,86 +151,69 @@ class _ProposalTargetLayer(nn.Module):
             .view(batch_size, -1)
         )
 
-        labels_batch = labels.new(batch_size, rois_per_image).zero_()
-        rois_batch = all_rois.new(batch_size, rois_per_image, 5).zero_()
-        gt_rois_batch = all_rois.new(batch_size, rois_per_image, 5).zero_()
-        # Guard against the case when an image has fewer than max_fg_rois_per_image
-        # foreground RoIs
-        for i in range(batch_size):
-
-            fg_inds = torch.nonzero(max_overlaps[i] >= cfg.TRAIN.FG_THRESH).view(-1)
-            fg_num_rois = fg_inds.numel()
-
-            # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
-            bg_inds = torch.nonzero(
-                (max_overlaps[i] < cfg.TRAIN.BG_THRESH_HI)
-                & (max_overlaps[i] >= cfg.TRAIN.BG_THRESH_LO)
-            ).view(-1)
-            bg_num_rois = bg_inds.numel()
-
-            if fg_num_rois > 0 and bg_num_rois > 0:
-                # sampling fg
-                fg_rois_per_this_image = min(fg_rois_per_image, fg_num_rois)
-
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                # rand_num = torch.randperm(fg_num_rois).long().cuda()
-                rand_num = (
-                    torch.from_numpy(np.random.permutation(fg_num_rois))
-                    .type_as(gt_boxes)
-                    .long()
-                )
-                fg_inds = fg_inds[rand_num[:fg_rois_per_this_image]]
-
-                # sampling bg
-                bg_rois_per_this_image = rois_per_image - fg_rois_per_this_image
-
-                # Seems torch.rand has a bug, it will generate very large number and make an error.
-                # We use numpy rand instead.
-                # rand_num = (torch.rand(bg_rois_per_this_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(
-                    np.random.rand(bg_rois_per_this_image) * bg_num_rois
-                )
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                bg_inds = bg_inds[rand_num]
-
-            elif fg_num_rois > 0 and bg_num_rois == 0:
-                # sampling fg
-                # rand_num = torch.floor(torch.rand(rois_per_image) * fg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * fg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num]
-                fg_rois_per_this_image = rois_per_image
-                bg_rois_per_this_image = 0
-            elif bg_num_rois > 0 and fg_num_rois == 0:
-                # sampling bg
-                # rand_num = torch.floor(torch.rand(rois_per_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-
-                bg_inds = bg_inds[rand_num]
-                bg_rois_per_this_image = rois_per_image
-                fg_rois_per_this_image = 0
-            else:
-                raise ValueError(
-                    "bg_num_rois = 0 and fg_num_rois = 0, this should not happen!"
-                )
-
-            # The indices that we're selecting (both fg and bg)
-            keep_inds = torch.cat([fg_inds, bg_inds], 0)
-
-            # Select sampled values from various arrays:
-            labels_batch[i].copy_(labels[i][keep_inds])
-
-            # Clamp labels for the background RoIs to 0
-            if fg_rois_per_this_image < rois_per_image:
-                labels_batch[i][fg_rois_per_this_image:] = 0
-
-            rois_batch[i] = all_rois[i][keep_inds]
-            rois_batch[i, :, 0] = i
-
-            gt_rois_batch[i] = gt_boxes[i][gt_assignment[i][keep_inds]]
+        fg = max_overlaps >= cfg.TRAIN.FG_THRESH
+        # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
+        bg = (max_overlaps < cfg.TRAIN.BG_THRESH_HI) & (
+            max_overlaps >= cfg.TRAIN.BG_THRESH_LO
+        )
+        fg_num_rois = torch.sum(fg.long(), 1)
+        bg_num_rois = torch.sum(bg.long(), 1)
+        has_bg = (bg_num_rois > 0).view(-1, 1)
+
+        empty = (fg_num_rois == 0) & (bg_num_rois == 0)
+        message = "bg_num_rois = 0 and fg_num_rois = 0, this should not happen!"
+        if empty.is_cuda:
+            # checked on the device, reading it back would sync every step
+            torch._assert_async(~empty.any(), message)
+        elif empty.any():
+            raise ValueError(message)
+
+        # Every image gets rois_per_image rois, the first fg_rois_per_this_image
+        # of them foreground. Images with both kinds take up to
+        # fg_rois_per_image fg rois without replacement, images with only fg
+        # rois fill every slot with them, the rest is background.
+        fg_rois_per_this_image = torch.where(
+            bg_num_rois > 0,
+            fg_num_rois.clamp(max=fg_rois_per_image),
+            fg_num_rois.clamp(max=1) * rois_per_image,
+        )
+        slots = torch.arange(rois_per_image, device=fg.device).view(1, -1)
+        fg_slot = slots < fg_rois_per_this_image.view(-1, 1)
+
+        # sampling with replacement draws from the fg (bg) rois of each image;
+        # an image with no such rois draws from all of them, and those draws
+        # are never used
+        fg_weights = fg.float() + (fg_num_rois == 0).float().view(-1, 1)
+        bg_weights = bg.float() + (bg_num_rois == 0).float().view(-1, 1)
+        fg_inds = torch.multinomial(fg_weights, rois_per_image, replacement=True)
+        bg_inds = torch.multinomial(bg_weights, rois_per_image, replacement=True)
+
+        # sampling fg without replacement: the top random keys among the fg
+        # rois of an image are a random subset of them
+        num_top = min(fg_rois_per_image, num_proposal)
+        keys = torch.rand(fg.size(), device=fg.device).masked_fill_(fg == 0, -1)
+        top_inds = torch.topk(keys, num_top, 1)[1]
+        fg_inds[:, :num_top] = torch.where(has_bg, top_inds, fg_inds[:, :num_top])
+
+        # The indices that we're selecting (both fg and bg)
+        keep_inds = torch.where(fg_slot, fg_inds, bg_inds)
+
+        # Select sampled values from various arrays:
+        labels_batch = labels.gather(1, keep_inds)
+        # Clamp labels for the background RoIs to 0
+        labels_batch.masked_fill_(fg_slot == 0, 0)
+
+        rois_batch = all_rois.gather(
+            1, keep_inds.unsqueeze(2).expand(batch_size, rois_per_image, 5)
+        )
+        rois_batch[:, :, 0] = (
+            torch.arange(batch_size, device=fg.device).view(-1, 1).type_as(rois_batch)
+        )
+
+        gt_inds = gt_assignment.gather(1, keep_inds)
+        gt_rois_batch = gt_boxes.gather(
+            1, gt_inds.unsqueeze(2).expand(batch_size, rois_per_image, 5)
+        )
 
         bbox_target_data = self._compute_targets_pytorch(
             rois_batch[:, :, 1:5], gt_rois_batch[:, :, :4]
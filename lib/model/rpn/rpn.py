@@ -8,6 +8,7 @@ from model.utils.config import cfg
 from model.utils.net_utils import _smooth_l1_loss
 from torch.autograd import Variable
 
+from .anchor_grid import precompute_anchor_grids
 from .anchor_target_layer import _AnchorTargetLayer
 from .proposal_layer import _ProposalLayer
 
@@ -51,6 +52,26 @@ class _RPN(nn.Module):
         self.rpn_loss_cls = 0
         self.rpn_loss_box = 0
 
+    def precompute_anchors(self, im_sizes, like):
+        """Build the anchor grids of the given (height, width) input sizes
+        ahead of inference, on the device and in the dtype of like."""
+        precompute_anchor_grids(
+            im_sizes, self.feat_stride, self.anchor_scales, self.anchor_ratios, like
+        )
+
+    def precompute_roidb_anchors(self, roidb, like):
+        """precompute_anchors for every input size the test loader makes of
+        the images of roidb; they come in a handful of sizes."""
+        im_sizes = set()
+        for entry in roidb:
+            for target_size in cfg.TRAIN.SCALES:
+                # the scale get_minibatch resizes the image with
+                im_scale = float(target_size) / min(entry["height"], entry["width"])
+                height = int(round(entry["height"] * im_scale))
+                width = int(round(entry["width"] * im_scale))
+                im_sizes.add((height, width))
+        self.precompute_anchors(im_sizes, like)
+
     @staticmethod
     def reshape(x, d):
         input_shape = x.size()
@@ -81,7 +102,8 @@ class _RPN(nn.Module):
         # proposal layer
         cfg_key = "TRAIN" if self.training else "TEST"
 
-        rois = self.RPN_proposal(
+        # rois is (R, 5) packed over the batch, num_rois counts them per image
+        rois, num_rois = self.RPN_proposal(
             (rpn_cls_prob.data, rpn_bbox_pred.data, im_info, cfg_key)
         )
 
@@ -131,4 +153,4 @@ class _RPN(nn.Module):
                 dim=[1, 2, 3],
             )
 
-        return rois, self.rpn_loss_cls, self.rpn_loss_box
+        return rois, num_rois, self.rpn_loss_cls, self.rpn_loss_box
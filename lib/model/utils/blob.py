@@ -17,14 +17,16 @@ except NameError:
     xrange = range  # Python 3
 
 
-def im_list_to_blob(ims):
+def im_list_to_blob(ims, dtype=np.float32, pad_value=0):
     """Convert a list of images into a network input.
 
     Assumes images are already prepared (means subtracted, BGR order, ...).
+    Uint8 images that still hold their means are padded with pad_value.
     """
     max_shape = np.array([im.shape for im in ims]).max(axis=0)
     num_images = len(ims)
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], 3), dtype=np.float32)
+    blob = np.empty((num_images, max_shape[0], max_shape[1], 3), dtype=dtype)
+    blob[...] = pad_value
     for i in xrange(num_images):
         im = ims[i]
         blob[i, 0 : im.shape[0], 0 : im.shape[1], :] = im
@@ -32,6 +34,11 @@ def im_list_to_blob(ims):
     return blob
 
 
+def pixel_means_as_uint8(pixel_means):
+    """Per-channel padding value that is ~0 once the means are subtracted."""
+    return np.round(pixel_means).reshape(-1).astype(np.uint8)
+
+
 def prep_im_for_blob(im, pixel_means, target_size, max_size):
     """Mean subtract and scale an image for use in a blob."""
 
@@ -65,6 +65,18 @@ __C.TRAIN.SCALES = (600,)
 # Max pixel size of the longest side of a scaled input image
 __C.TRAIN.MAX_SIZE = 1000
 
+# RAM budget (in MB, per data loader process) for decoded and resized
+# training images; 0 disables the in-memory cache
+__C.TRAIN.IMAGE_CACHE_MB = 0
+
+# Directory the image cache also writes its entries to, shared by all
+# workers and runs; empty to keep the cache in memory only
+__C.TRAIN.IMAGE_CACHE_DIR = ""
+
+# Let the data loader workers return uint8 images that still hold their
+# pixel means; the trainer converts and mean-subtracts them after the copy
+__C.TRAIN.UINT8_PIPELINE = False
+
 # Trim size for input images to create minibatch
 __C.TRAIN.TRIM_HEIGHT = 600
 __C.TRAIN.TRIM_WIDTH = 600
@@ -145,6 +157,12 @@ __C.TRAIN.RPN_PRE_NMS_TOP_N = 12000
 __C.TRAIN.RPN_POST_NMS_TOP_N = 2000
 # Proposal height and width both need to be greater than RPN_MIN_SIZE (at orig image scale)
 __C.TRAIN.RPN_MIN_SIZE = 8
+# Decode only the RPN_PRE_NMS_TOP_N best scoring anchors; small boxes are then
+# filtered out of that selection instead of before it
+__C.TRAIN.RPN_GATHER_BEFORE_DECODE = False
+# Memory cap in MB for the anchor/gt overlaps of the RPN targets, the anchors
+# are matched against the gt boxes in chunks that fit this size
+__C.TRAIN.RPN_OVERLAPS_MB = 64
 # Deprecated (outside weights)
 __C.TRAIN.RPN_BBOX_INSIDE_WEIGHTS = (1.0, 1.0, 1.0, 1.0)
 # Give the positive RPN examples weight of p * 1 / {num positives}
@@ -197,6 +215,8 @@ __C.TEST.RPN_POST_NMS_TOP_N = 300
 
 # Proposal height and width both need to be greater than RPN_MIN_SIZE (at orig image scale)
 __C.TEST.RPN_MIN_SIZE = 16
+# Decode only the RPN_PRE_NMS_TOP_N best scoring anchors
+__C.TEST.RPN_GATHER_BEFORE_DECODE = False
 
 # Testing mode, default to be 'nms', 'top' is slower but better
 # See report for details
@@ -274,6 +294,10 @@ __C.MATLAB = "matlab"
 # Place outputs under an experiments directory
 __C.EXP_DIR = "default"
 
+# Number of threads used for file system probing (image sizes that are not
+# in the size index, annotation file stats)
+__C.NUM_IO_THREADS = 16
+
 # Use GPU implementation of non-maximum suppression
 __C.USE_GPU_NMS = True
 
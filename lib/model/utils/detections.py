@@ -0,0 +1,85 @@
+"""Test time post-processing of the per-roi class scores and boxes.
+
+The scores of every class are thresholded together, a single nms call
+suppresses the boxes of all classes at once and the per-image cap is applied
+on the device. Only the final detections are copied to the host.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import math
+
+import numpy as np
+import torch
+from model.roi_layers import nms
+
+
+def _class_offsets(boxes, labels, num_classes):
+    """Shift the boxes of each class into a cell of its own.
+
+    Boxes in different cells never overlap, so one nms call over all classes
+    only suppresses boxes of the same class. The cells are laid out on a
+    square grid, which keeps the coordinates small enough for float32 even
+    with thousands of classes.
+    """
+    grid = int(math.ceil(math.sqrt(num_classes)))
+    origin = boxes.min()
+    span = boxes.max() - origin + 1
+    col = labels % grid
+    row = labels // grid
+    cells = torch.stack((col, row, col, row), 1).type_as(boxes)
+    return boxes - origin + cells * span
+
+
+def postprocess_detections(
+    scores, boxes, thresh, nms_thresh, max_per_image, class_agnostic
+):
+    """Threshold, per-class nms and the per-image cap for one image.
+
+    scores: (N, C) class probabilities of the rois, class 0 is background
+    boxes: (N, 4) class agnostic or (N, 4 * C) per-class boxes
+
+    Returns a (M, 5) float32 array of (x1, y1, x2, y2, score) detections and
+    the (M,) class of each one, grouped by class and sorted by decreasing
+    score within a class.
+    """
+    num_classes = scores.size(1)
+    inds = torch.nonzero(scores[:, 1:] > thresh)
+    if inds.numel() == 0:
+        return np.zeros((0, 5), dtype=np.float32), np.zeros((0,), dtype=np.int64)
+
+    roi_inds = inds[:, 0]
+    labels = inds[:, 1] + 1
+    det_scores = scores[roi_inds, labels]
+    if class_agnostic:
+        det_boxes = boxes[roi_inds]
+    else:
+        det_boxes = boxes.view(boxes.size(0), -1, 4)[roi_inds, labels]
+
+    det_scores, order = torch.sort(det_scores, 0, True)
+    det_boxes = det_boxes[order]
+    labels = labels[order]
+
+    # nms keeps its input order, so keep is sorted by decreasing score
+    keep = nms(_class_offsets(det_boxes, labels, num_classes), det_scores, nms_thresh)
+    keep = keep.long().view(-1).to(det_scores.device)
+
+    # Limit to max_per_image detections *over all classes*, boxes tied with
+    # the last one are kept as well
+    if max_per_image > 0 and keep.numel() > max_per_image:
+        image_thresh = det_scores[keep[max_per_image - 1]]
+        keep = keep[det_scores[keep] >= image_thresh]
+
+    dets = torch.cat((det_boxes[keep], det_scores[keep].unsqueeze(1)), 1)
+    dets = dets.cpu().numpy()
+    labels = labels[keep].cpu().numpy()
+    # group by class, the stable sort keeps the score order within a class
+    order = np.argsort(labels, kind="mergesort")
+    return dets[order], labels[order]
+
+
+def split_detections(dets, labels, num_classes):
+    """Per-class views of the postprocess_detections arrays, in the layout of
+    the all_boxes[j][i] entries of imdb.evaluate_detections."""
+    bounds = np.searchsorted(labels, np.arange(num_classes + 1))
+    return [dets[bounds[j] : bounds[j + 1]] for j in range(num_classes)]
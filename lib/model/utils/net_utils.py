@@ -80,6 +80,46 @@ def save_checkpoint(state, filename):
     torch.save(state, filename)
 
 
+def training_only_modules(lc, gc):
+    """Top-level modules of the DA models that detect() does not use.
+
+    The discriminators stay when their context vectors feed the ROI heads.
+    """
+    modules = ["conv_lst", "RCNN_instanceDA"]
+    if not lc:
+        modules.append("netD_pixel")
+    if not gc:
+        modules.append("netD")
+    return modules
+
+
+def strip_training_weights(state_dict, lc, gc):
+    """state_dict without the weights of training_only_modules(lc, gc)."""
+    modules = tuple(m + "." for m in training_only_modules(lc, gc))
+    return {k: v for k, v in state_dict.items() if not k.startswith(modules)}
+
+
+def load_detection_weights(model, state_dict):
+    """Load a full or a stripped checkpoint into model for detection.
+
+    Weights model does not have are ignored, so are missing weights of
+    training-only modules. Any other missing weight is an error.
+    """
+    own = model.state_dict()
+    model.load_state_dict(
+        {k: v for k, v in state_dict.items() if k in own}, strict=False
+    )
+    lc = getattr(model, "lc", False)
+    gc = getattr(model, "gc", False)
+    missing = set(strip_training_weights(own, lc, gc)) - set(state_dict)
+    if missing:
+        raise KeyError(
+            "checkpoint lacks weights used for detection: {}".format(
+                ", ".join(sorted(missing))
+            )
+        )
+
+
 def _smooth_l1_loss(
     bbox_pred,
     bbox_targets,
@@ -105,6 +145,43 @@ def _smooth_l1_loss(
     return loss_box
 
 
+def pad_rois(values, image_ids, num_rois, max_rois=None):
+    """Scatter per-roi rows packed by image into a padded batch.
+
+    values holds one row per roi, grouped by image, image_ids the image of
+    each row and num_rois the number of rois of each image. Returns a
+    (batch, max_rois, ...) tensor, zero filled past the rois of an image.
+    max_rois must be at least max(num_rois); it defaults to that, which
+    reads num_rois back to the host, so callers that know a bound pass it.
+    """
+    batch_size = num_rois.size(0)
+    if max_rois is None:
+        max_rois = int(num_rois.max()) if batch_size > 0 else 0
+    padded = values.new_zeros((batch_size, max_rois) + tuple(values.size()[1:]))
+    if values.size(0) == 0:
+        return padded
+    starts = torch.cumsum(num_rois, 0) - num_rois
+    rank = torch.arange(values.size(0), device=image_ids.device) - starts[image_ids]
+    padded[image_ids, rank] = values
+    return padded
+
+
+def context_linear(linear, feat, context, image_ids):
+    """linear applied to torch.cat((context[image_ids], feat), 1), without
+    building that concatenation.
+
+    context holds one row per image and its columns come first in the input
+    of linear. Their contribution is computed once per image and added to
+    the rois of that image.
+    """
+    if context is None:
+        return linear(feat)
+    context_dim = context.size(1)
+    image_term = F.linear(context, linear.weight[:, :context_dim])
+    roi_term = F.linear(feat, linear.weight[:, context_dim:], linear.bias)
+    return roi_term + image_term[image_ids]
+
+
 def _crop_pool_layer(bottom, rois, max_pool=True):
     # code modified from
     # https://github.com/ruotianluo/pytorch-faster-rcnn
@@ -119,13 +196,16 @@ def _crop_pool_layer(bottom, rois, max_pool=True):
     [           y2-y1    y1 + y2 - H + 1  ]
     [    0      -----    ---------------  ]
     [           H - 1         H - 1      ]
+
+    The rois of an image are sampled from that image's feature map with one
+    grid_sample call, their grids stacked along the output height, so the
+    feature map is never copied per roi.
     """
     rois = rois.detach()
     batch_size = bottom.size(0)
     D = bottom.size(1)
     H = bottom.size(2)
     W = bottom.size(3)
-    roi_per_batch = rois.size(0) / batch_size
     x1 = rois[:, 1::4] / 16.0
     y1 = rois[:, 2::4] / 16.0
     x2 = rois[:, 3::4] / 16.0
@@ -148,32 +228,34 @@ def _crop_pool_layer(bottom, rois, max_pool=True):
         1,
     ).view(-1, 2, 3)
 
-    if max_pool:
-        pre_pool_size = cfg.POOLING_SIZE * 2
-        grid = F.affine_grid(
-            theta, torch.Size((rois.size(0), 1, pre_pool_size, pre_pool_size))
+    crop_size = cfg.POOLING_SIZE * 2 if max_pool else cfg.POOLING_SIZE
+    grid = F.affine_grid(theta, torch.Size((rois.size(0), 1, crop_size, crop_size)))
+
+    image_ids = rois[:, 0].long()
+    crops = []
+    roi_inds = []
+    for b in range(batch_size):
+        inds = torch.nonzero(image_ids == b).view(-1)
+        if inds.numel() == 0:
+            continue
+        # (1, n * crop_size, crop_size, 2) -> (1, D, n * crop_size, crop_size)
+        image_grid = grid[inds].view(1, -1, crop_size, 2)
+        image_crops = F.grid_sample(bottom[b : b + 1], image_grid)
+        crops.append(
+            image_crops.view(D, -1, crop_size, crop_size).permute(1, 0, 2, 3)
         )
-        bottom = (
-            bottom.view(1, batch_size, D, H, W)
-            .contiguous()
-            .expand(roi_per_batch, batch_size, D, H, W)
-            .contiguous()
-            .view(-1, D, H, W)
-        )
-        crops = F.grid_sample(bottom, grid)
-        crops = F.max_pool2d(crops, 2, 2)
+        roi_inds.append(inds)
+
+    if len(crops) == 0:
+        crops = bottom.new_zeros((0, D, crop_size, crop_size))
     else:
-        grid = F.affine_grid(
-            theta, torch.Size((rois.size(0), 1, cfg.POOLING_SIZE, cfg.POOLING_SIZE))
-        )
-        bottom = (
-            bottom.view(1, batch_size, D, H, W)
-            .contiguous()
-            .expand(roi_per_batch, batch_size, D, H, W)
-            .contiguous()
-            .view(-1, D, H, W)
-        )
-        crops = F.grid_sample(bottom, grid)
+        crops = torch.cat(crops, 0)
+        # back to the order of the rois
+        _, inverse = torch.cat(roi_inds, 0).sort()
+        crops = crops[inverse].contiguous()
+
+    if max_pool:
+        crops = F.max_pool2d(crops, 2, 2)
 
     return crops, grid
 
@@ -244,19 +326,72 @@ def _affine_theta(rois, input_size):
 
 
 class GradReverse(Function):
-    def __init__(self, lambd):
-        self.lambd = lambd
-
-    def forward(self, x):
+    @staticmethod
+    def forward(ctx, x, lambd):
+        ctx.lambd = lambd
         return x.view_as(x)
 
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         # pdb.set_trace()
-        return grad_output * -self.lambd
+        return grad_output * -ctx.lambd, None
 
 
 def grad_reverse(x, lambd=1.0):
-    return GradReverse(lambd)(x)
+    return GradReverse.apply(x, lambd)
+
+
+class _ReverseInto(Function):
+    """Identity on trunk activations computed from a leaf copy of input.
+
+    The gradient reaching the activations through this path trains the trunk
+    as usual and is also reversed into input, as grad_reverse in front of the
+    trunk would do. Other uses of the activations train the trunk only.
+    """
+
+    @staticmethod
+    def forward(ctx, feat, trunk_input, input, lambd):
+        ctx.save_for_backward(feat, trunk_input)
+        ctx.lambd = lambd
+        return feat.view_as(feat)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        feat, trunk_input = ctx.saved_tensors
+        (grad_input,) = torch.autograd.grad(
+            feat, trunk_input, grad_output, retain_graph=True
+        )
+        return grad_output, None, grad_input * -ctx.lambd, None
+
+
+def detach_input(x):
+    """Leaf copy of a discriminator input, the trunk runs on it once for the
+    domain logits and the context vector, see reverse_into."""
+    trunk_input = x.detach()
+    if torch.is_grad_enabled() and x.requires_grad:
+        trunk_input.requires_grad_()
+    return trunk_input
+
+
+def reverse_into(feat, trunk_input, input, lambd=1.0):
+    """Route the gradient of feat, computed from trunk_input =
+    detach_input(input), reversed into input.
+
+    Only the path through the returned tensor reaches input. The context
+    vector pooled from feat trains the trunk like the old trunk(x.detach())
+    call did, but stops at trunk_input.
+    """
+    if not trunk_input.requires_grad:
+        return feat
+    return _ReverseInto.apply(feat, trunk_input, input, lambd)
+
+
+def pool_context(feat, crop=None):
+    """Context vector of a discriminator, the global average of its
+    activations; crop selects the part of the map to pool."""
+    if crop is not None:
+        feat = crop(feat)
+    return F.avg_pool2d(feat, (feat.size(2), feat.size(3)))
 
 
 class EFocalLoss(nn.Module):
@@ -299,8 +434,8 @@ class EFocalLoss(nn.Module):
         class_mask.scatter_(1, ids.data, 1.0)
         # print(class_mask)
 
-        if inputs.is_cuda and not self.alpha.is_cuda:
-            self.alpha = self.alpha.cuda()
+        if self.alpha.device != inputs.device:
+            self.alpha = self.alpha.to(inputs.device)
         alpha = self.alpha[ids.data.view(-1)]
 
         probs = (P * class_mask).sum(1).view(-1, 1)
@@ -381,8 +516,8 @@ class FocalLoss(nn.Module):
             class_mask.scatter_(1, ids.data, 1.0)
             # print(class_mask)
 
-            if inputs.is_cuda and not self.alpha.is_cuda:
-                self.alpha = self.alpha.cuda()
+            if self.alpha.device != inputs.device:
+                self.alpha = self.alpha.to(inputs.device)
             alpha = self.alpha[ids.data.view(-1)]
 
             probs = (P * class_mask).sum(1).view(-1, 1)
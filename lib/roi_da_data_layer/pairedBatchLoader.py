@@ -0,0 +1,216 @@
+"""Paired source/target data pipeline for domain adaptive training.
+
+Each domain is read through its own DataLoader over an infinite sampler, so
+the worker processes are started once and never torn down when the smaller
+domain wraps around. A background thread keeps a few (source, target) steps
+ready in a queue while the trainer runs the current one.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from model.utils.config import cfg
+from roi_da_data_layer.roibatchLoader import collate_minibatch
+from torch.utils.data.sampler import Sampler
+
+try:
+    import queue  # Python 3
+except ImportError:
+    import Queue as queue  # Python 2
+
+
+class infiniteSampler(Sampler):
+    """Endless version of the batch-grouped sampler used by the train scripts.
+
+    Every pass draws a fresh permutation of whole batches, so consecutive
+    indices of a batch keep sharing the aspect ratio group that roibatchLoader
+    pads them to. The images left over after the last full batch are dropped
+    so a batch never spans two passes. The order is a function of the seed and
+    of the number of samples already drawn, which makes the stream resumable.
+    """
+
+    def __init__(self, train_size, batch_size, seed=0, start=0):
+        self.num_data = train_size
+        self.num_per_batch = int(train_size / batch_size)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.start = start
+        assert self.num_per_batch > 0, "fewer images ({}) than batch_size ({})".format(
+            train_size, batch_size
+        )
+        self.range = torch.arange(0, batch_size).view(1, batch_size).long()
+
+    def _pass_order(self, num_pass):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + num_pass)
+        rand_num = (
+            torch.randperm(self.num_per_batch, generator=generator).view(-1, 1)
+            * self.batch_size
+        )
+        rand_num = rand_num.expand(self.num_per_batch, self.batch_size) + self.range
+        return rand_num.view(-1)
+
+    def __iter__(self):
+        pass_size = self.num_per_batch * self.batch_size
+        num_pass, offset = divmod(self.start, pass_size)
+        while True:
+            order = self._pass_order(num_pass)
+            for index in order[offset:].tolist():
+                yield index
+            offset = 0
+            num_pass += 1
+
+    def __len__(self):
+        return self.num_per_batch * self.batch_size
+
+
+def _worker_init_fn(worker_id):
+    # the minibatch code draws from numpy, give every worker its own stream
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+class pairedBatchLoader(object):
+    """Infinite, resumable stream of (source_batch, target_batch) tuples.
+
+    t_dataset may also be a list of target datasets, one per target domain.
+    Every step then pairs the source batch with a list holding one batch of
+    each domain.
+
+    prefetch is the number of steps assembled ahead of the consumer. With
+    pin_memory, which the train scripts set from --cuda, batches come out of
+    the DataLoader pin-memory thread already in page-locked memory.
+
+    close() stops the prefetch thread and the persistent workers; the loader
+    also works as a context manager that closes it on exit.
+    """
+
+    def __init__(
+        self,
+        s_dataset,
+        t_dataset,
+        batch_size,
+        num_workers=0,
+        prefetch=2,
+        seed=None,
+        pin_memory=False,
+    ):
+        # read the seed here, cfg_from_file/cfg_from_list run after import
+        if seed is None:
+            seed = cfg.RNG_SEED
+        self.batch_size = batch_size
+        self.prefetch = max(int(prefetch), 1)
+
+        self.multi_target = isinstance(t_dataset, (list, tuple))
+        t_datasets = list(t_dataset) if self.multi_target else [t_dataset]
+
+        self.s_sampler = infiniteSampler(len(s_dataset), batch_size, seed)
+        self.t_samplers = [
+            infiniteSampler(len(dataset), batch_size, seed + 1 + i)
+            for i, dataset in enumerate(t_datasets)
+        ]
+        self.s_loader = self._make_loader(
+            s_dataset, self.s_sampler, num_workers, pin_memory
+        )
+        self.t_loaders = [
+            self._make_loader(dataset, sampler, num_workers, pin_memory)
+            for dataset, sampler in zip(t_datasets, self.t_samplers)
+        ]
+
+        self._consumed = 0
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _make_loader(self, dataset, sampler, num_workers, pin_memory):
+        kwargs = {}
+        if num_workers > 0:
+            kwargs["persistent_workers"] = True
+            kwargs["prefetch_factor"] = self.prefetch
+            kwargs["worker_init_fn"] = _worker_init_fn
+        return data.DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            sampler=sampler,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            collate_fn=collate_minibatch,
+            **kwargs
+        )
+
+    def _fill(self):
+        try:
+            s_iter = iter(self.s_loader)
+            t_iters = [iter(loader) for loader in self.t_loaders]
+            while not self._stop.is_set():
+                t_batches = [next(t_iter) for t_iter in t_iters]
+                item = (next(s_iter), t_batches if self.multi_target else t_batches[0])
+                self._put(item)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # give up on a full queue once close() was called, nothing reads it
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._thread is None:
+            self._start()
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        self._consumed += 1
+        return item
+
+    next = __next__  # Python 2
+
+    def state_dict(self):
+        """Stream position of every domain, counted in delivered samples."""
+        drawn = self._consumed * self.batch_size
+        target = [sampler.start + drawn for sampler in self.t_samplers]
+        return {
+            "source": self.s_sampler.start + drawn,
+            "target": target if self.multi_target else target[0],
+        }
+
+    def load_state_dict(self, state):
+        assert self._thread is None, "load_state_dict must precede iteration"
+        self.s_sampler.start = state["source"]
+        target = state["target"] if self.multi_target else [state["target"]]
+        assert len(target) == len(self.t_samplers), "number of target domains"
+        for sampler, start in zip(self.t_samplers, target):
+            sampler.start = start
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for loader in [self.s_loader] + self.t_loaders:
+            # persistent_workers keeps the worker iterator on the loader
+            iterator = getattr(loader, "_iterator", None)
+            if iterator is not None and hasattr(iterator, "_shutdown_workers"):
+                iterator._shutdown_workers()
+            loader._iterator = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
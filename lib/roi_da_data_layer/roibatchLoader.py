@@ -7,9 +7,12 @@ import numpy as np
 import torch
 import torch.utils.data as data
 from model.rpn.bbox_transform import bbox_transform_inv, clip_boxes
+from model.utils.blob import pixel_means_as_uint8
 from model.utils.config import cfg
 from PIL import Image
+from torch.utils.data.dataloader import default_collate
 from roi_da_data_layer.minibatch import get_minibatch
+from roi_data_layer.packedShards import packedShards
 
 
 class roibatchLoader(data.Dataset):
@@ -22,6 +25,7 @@ class roibatchLoader(data.Dataset):
         num_classes,
         training=True,
         normalize=None,
+        packed=None,
     ):
         self._roidb = roidb
         self._num_classes = num_classes
@@ -31,6 +35,8 @@ class roibatchLoader(data.Dataset):
         self.max_num_box = cfg.MAX_NUM_GT_BOXES
         self.training = training
         self.normalize = normalize
+        # directory written by pack_dataset.py, images are then sliced from its shards
+        self.packed = packedShards(packed) if packed else None
         self.ratio_list = ratio_list
         self.ratio_index = ratio_index
         self.batch_size = batch_size
@@ -77,10 +83,10 @@ class roibatchLoader(data.Dataset):
         # here we set the anchor index to the last one
         # sample in this group
         minibatch_db = [self._roidb[index_ratio]]
-        blobs = get_minibatch(minibatch_db, self._num_classes)
+        blobs = get_minibatch(minibatch_db, self._num_classes, self.packed)
         data = torch.from_numpy(blobs["data"])
         im_info = torch.from_numpy(blobs["im_info"])
-        cls_lb = torch.from_numpy(blobs["cls_lb"])
+        cls_lb = torch.from_numpy(blobs["cls_lb"][0])
         # we need to random shuffle the bounding box.
         data_height, data_width = data.size(1), data.size(2)
         if self.training:
@@ -88,8 +94,8 @@ class roibatchLoader(data.Dataset):
             da-faster-rcnn layer............
         """
 
-            np.random.shuffle(blobs["gt_boxes"])
-            gt_boxes = torch.from_numpy(blobs["gt_boxes"])
+            np.random.shuffle(blobs["gt_boxes"][0])
+            gt_boxes = torch.from_numpy(blobs["gt_boxes"][0])
             need_backprop = blobs["need_backprop"][0]
 
             ########################################################
@@ -181,9 +187,9 @@ class roibatchLoader(data.Dataset):
                 # this means that data_width < data_height
                 trim_size = int(np.floor(data_width / ratio))
 
-                padding_data = torch.FloatTensor(
-                    int(np.ceil(data_width / ratio)), data_width, 3
-                ).zero_()
+                padding_data = _blank_image(
+                    data, int(np.ceil(data_width / ratio)), data_width
+                )
 
                 padding_data[:data_height, :, :] = data[0]
                 # update im_info
@@ -192,14 +198,13 @@ class roibatchLoader(data.Dataset):
             elif ratio > 1:
                 # this means that data_width > data_height
                 # if the image need to crop.
-                padding_data = torch.FloatTensor(
-                    data_height, int(np.ceil(data_height * ratio)), 3
-                ).zero_()
+                padding_data = _blank_image(
+                    data, data_height, int(np.ceil(data_height * ratio))
+                )
                 padding_data[:, :data_width, :] = data[0]
                 im_info[0, 1] = padding_data.size(1)
             else:
                 trim_size = min(data_height, data_width)
-                padding_data = torch.FloatTensor(trim_size, trim_size, 3).zero_()
                 padding_data = data[0][:trim_size, :trim_size, :]
                 # gt_boxes.clamp_(0, trim_size)
                 gt_boxes[:, :4].clamp_(0, trim_size)
@@ -257,3 +262,50 @@ class roibatchLoader(data.Dataset):
 
     def __len__(self):
         return len(self._roidb)
+
+
+def collate_minibatch(batch):
+    """Stack the samples of one aspect group into a minibatch.
+
+    Samples of a group are already padded to the group's aspect ratio, but
+    they can still differ in size when cfg.TRAIN.SCALES lists several scales,
+    so images are padded to the largest one. im_info keeps the size of each
+    image.
+    """
+    fields = list(zip(*batch))
+    ims = fields[0]
+    max_height = max(im.size(1) for im in ims)
+    max_width = max(im.size(2) for im in ims)
+    data = ims[0].new(len(ims), ims[0].size(0), max_height, max_width)
+    data[...] = _pad_value(data).view(1, -1, 1, 1)
+    for i, im in enumerate(ims):
+        data[i, :, : im.size(1), : im.size(2)] = im
+    return [data] + [default_collate(list(field)) for field in fields[1:]]
+
+
+def _pad_value(like):
+    """Per-channel padding for an image batch: zero, or the pixel means while
+    the images are still uint8 (see cfg.TRAIN.UINT8_PIPELINE)."""
+    if like.dtype == torch.uint8:
+        return torch.from_numpy(pixel_means_as_uint8(cfg.PIXEL_MEANS))
+    return like.new(3).zero_()
+
+
+def _blank_image(like, height, width):
+    """HWC canvas of the same type as like, filled with the padding value."""
+    canvas = like.new(height, width, 3)
+    canvas[...] = _pad_value(like)
+    return canvas
+
+
+def load_image_batch(im_data, images):
+    """Copy a collated image batch into im_data (any device).
+
+    uint8 batches from the UINT8_PIPELINE workers are converted and
+    mean-subtracted here, once per batch, instead of in every worker.
+    """
+    im_data.resize_(images.size()).copy_(images)
+    if images.dtype == torch.uint8:
+        means = torch.from_numpy(cfg.PIXEL_MEANS.reshape(1, -1, 1, 1))
+        im_data.sub_(means.to(im_data.device, im_data.dtype))
+    return im_data
@@ -3,9 +3,9 @@ from __future__ import absolute_import, division, print_function
 
 import datasets
 import numpy as np
-import PIL
 from datasets.factory import get_imdb
 from model.utils.config import cfg
+from roi_data_layer.compactRoidb import compactRoidb
 
 
 def prepare_roidb(imdb):
@@ -22,9 +22,7 @@ def prepare_roidb(imdb):
         or "car" in imdb.name
         or "sim10k" in imdb.name
     ):
-        sizes = [
-            PIL.Image.open(imdb.image_path_at(i)).size for i in range(imdb.num_images)
-        ]
+        sizes = imdb._get_sizes()
 
     for i in range(len(imdb.image_index)):
         roidb[i]["img_id"] = imdb.image_id_at(i)
@@ -148,6 +146,8 @@ def combined_roidb(imdb_names, training=True):  # dataset name
         print(len(roidb))
 
     ratio_list, ratio_index = rank_roidb_ratio(roidb)
+    # hand the data layers a few large arrays instead of one dict per image
+    roidb = compactRoidb(roidb)
     return (
         imdb,
         roidb,
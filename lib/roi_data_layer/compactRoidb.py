@@ -0,0 +1,103 @@
+"""Columnar storage for a prepared roidb.
+
+A roidb is built as a list with one dict per image, and each dict holds a few
+small numpy arrays. Every DataLoader worker touches these millions of little
+Python objects, and the refcount updates copy their pages into the worker.
+compactRoidb stores the same data as a handful of large arrays instead:
+
+* every per-box field (boxes, gt_classes, gt_overlaps, max_overlaps, ...) is
+  concatenated over all images, and box_offsets[i]:box_offsets[i + 1] picks
+  out the boxes of image i. Sparse fields are stored dense.
+* every per-image field (image, img_id, width, height, flipped, need_crop,
+  ...) is a flat array with one entry per image.
+
+roidb[i] returns a light view with the usual dict-style access, so the data
+layers read roidb[i]["boxes"] or set roidb[i]["need_crop"] as before.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import scipy.sparse
+
+try:
+    from collections.abc import Mapping  # Python 3
+except ImportError:
+    from collections import Mapping  # Python 2
+
+
+class compactRoidb(object):
+    def __init__(self, roidb):
+        num_boxes = np.array([len(r["boxes"]) for r in roidb], dtype=np.int64)
+        self.box_offsets = np.zeros(len(roidb) + 1, dtype=np.int64)
+        np.cumsum(num_boxes, out=self.box_offsets[1:])
+
+        self.box_fields = {}
+        self.image_fields = {}
+        # fields only some entries carry (the flipped copies lack seg_areas and
+        # gt_ishard, for instance) are not read by the data layers and dropped
+        keys = set(roidb[0].keys()) if len(roidb) else set()
+        for r in roidb:
+            keys.intersection_update(r.keys())
+        for key in sorted(keys):
+            values = [r[key] for r in roidb]
+            if isinstance(values[0], np.ndarray) or scipy.sparse.issparse(values[0]):
+                self.box_fields[key] = np.concatenate(
+                    [v.toarray() if scipy.sparse.issparse(v) else v for v in values]
+                )
+            else:
+                self.image_fields[key] = np.array(values)
+
+    def __len__(self):
+        return len(self.box_offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("roidb index {} out of range".format(i))
+        return _roidbEntry(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield _roidbEntry(self, i)
+
+
+class _roidbEntry(Mapping):
+    """dict-style view of one image of a compactRoidb."""
+
+    __slots__ = ("_db", "_i")
+
+    def __init__(self, db, i):
+        self._db = db
+        self._i = i
+
+    def __getitem__(self, key):
+        db = self._db
+        if key in db.box_fields:
+            return db.box_fields[key][
+                db.box_offsets[self._i] : db.box_offsets[self._i + 1]
+            ]
+        value = db.image_fields[key][self._i]
+        # hand out plain Python scalars, like the list roidb did
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __setitem__(self, key, value):
+        db = self._db
+        if key in db.box_fields:
+            db.box_fields[key][
+                db.box_offsets[self._i] : db.box_offsets[self._i + 1]
+            ] = value
+        elif key in db.image_fields:
+            db.image_fields[key][self._i] = value
+        else:
+            raise KeyError("cannot add field {} to a compact roidb".format(key))
+
+    def __iter__(self):
+        for key in self._db.box_fields:
+            yield key
+        for key in self._db.image_fields:
+            yield key
+
+    def __len__(self):
+        return len(self._db.box_fields) + len(self._db.image_fields)
@@ -0,0 +1,140 @@
+"""Cache of decoded and resized training images.
+
+Reading a Cityscapes frame means decoding a 2048x1024 PNG and shrinking it
+to the training scale, which costs far more than the rest of a minibatch.
+The cache keeps the result as uint8, keyed by image path, target scale and
+flip, so each image is decoded once per scale instead of once per epoch.
+
+Entries live in an in-memory LRU bounded by cfg.TRAIN.IMAGE_CACHE_MB. Every
+DataLoader worker holds its own copy of the cache, so the budget applies per
+process. When cfg.TRAIN.IMAGE_CACHE_DIR is set, every entry is also written
+there once, so it can be read back by other workers and later runs.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from model.utils.config import cfg
+
+
+def load_resized_image(path, target_size, flipped):
+    """Decode an image and resize its shortest side to target_size.
+
+    Returns the uint8 image in the channel order the blobs use, together with
+    the scale factor that was applied to it.
+    """
+    im = cv2.imread(path)
+    if im is None:
+        raise IOError("cannot read image {}".format(path))
+    if len(im.shape) == 2:
+        im = im[:, :, np.newaxis]
+        im = np.concatenate((im, im, im), axis=2)
+    # flip the channel, since the original one using cv2
+    # rgb -> bgr
+    im = im[:, :, ::-1]
+    if flipped:
+        im = im[:, ::-1, :]
+
+    im_scale = float(target_size) / float(np.min(im.shape[0:2]))
+    im = cv2.resize(
+        np.ascontiguousarray(im),
+        None,
+        None,
+        fx=im_scale,
+        fy=im_scale,
+        interpolation=cv2.INTER_LINEAR,
+    )
+    return im, im_scale
+
+
+class imageCache(object):
+    """LRU cache of load_resized_image results with an optional disk spill."""
+
+    def __init__(self, max_bytes, spill_dir=""):
+        self.max_bytes = int(max_bytes)
+        self.spill_dir = spill_dir
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        if self.spill_dir and not os.path.exists(self.spill_dir):
+            try:
+                os.makedirs(self.spill_dir)
+            except OSError:
+                # another worker created it first
+                if not os.path.isdir(self.spill_dir):
+                    raise
+
+    def get(self, path, target_size, flipped):
+        key = (path, int(target_size), bool(flipped))
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = self._load(key)
+        # re-inserting marks the entry as the most recently used one
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key, entry):
+        size = entry[0].nbytes
+        if size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, (old_im, _) = self._entries.popitem(last=False)
+            self.num_bytes -= old_im.nbytes
+
+    def _load(self, key):
+        if not self.spill_dir:
+            return load_resized_image(*key)
+
+        spill_file = self._spill_file(key)
+        if os.path.exists(spill_file):
+            try:
+                with np.load(spill_file) as spilled:
+                    return spilled["im"], float(spilled["scale"])
+            except (IOError, ValueError, KeyError):
+                pass  # partly written or corrupt, decode again below
+
+        im, im_scale = load_resized_image(*key)
+        # write to a private file first so readers never see a partial entry
+        fd, tmp_file = tempfile.mkstemp(dir=self.spill_dir, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, im=im, scale=im_scale)
+            os.rename(tmp_file, spill_file)
+        except (IOError, OSError):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return im, im_scale
+
+    def _spill_file(self, key):
+        path, target_size, flipped = key
+        # the source mtime is part of the name, so edited images are re-read
+        stamp = "{}|{}|{}|{}".format(
+            os.path.abspath(path), os.path.getmtime(path), target_size, int(flipped)
+        )
+        name = hashlib.sha1(stamp.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, name + ".npz")
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = None
+
+
+def get_image_cache():
+    """Return this process's cache, or None when caching is disabled."""
+    global _cache
+    if cfg.TRAIN.IMAGE_CACHE_MB <= 0 and not cfg.TRAIN.IMAGE_CACHE_DIR:
+        return None
+    if _cache is None:
+        _cache = imageCache(
+            cfg.TRAIN.IMAGE_CACHE_MB * 1024 * 1024, cfg.TRAIN.IMAGE_CACHE_DIR
+        )
+    return _cache
@@ -12,53 +12,70 @@ from __future__ import absolute_import, division, print_function
 import cv2
 import numpy as np
 import numpy.random as npr
-from model.utils.blob import im_list_to_blob, prep_im_for_blob
+import scipy.sparse
+from model.utils.blob import (
+    im_list_to_blob,
+    pixel_means_as_uint8,
+    prep_im_for_blob,
+)
 from model.utils.config import cfg
+from roi_data_layer.imageCache import get_image_cache, load_resized_image
+from roi_data_layer.packedShards import packedShards
 
 
-def get_minibatch(roidb, num_classes):
-    """Given a roidb, construct a minibatch sampled from it."""
+def get_minibatch(roidb, num_classes, image_source=None):
+    """Given a roidb, construct a minibatch sampled from it.
+
+    image_source serves pre-resized uint8 images (see packedShards); by
+    default images come from the image cache, or are read from disk. Packed
+    shards also serve the gt boxes and classes.
+    """
     num_images = len(roidb)
     # Sample random scales to use for each image in this batch
     random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES), size=num_images)
-    assert (
-        cfg.TRAIN.BATCH_SIZE % num_images == 0
-    ), "num_images ({}) must divide BATCH_SIZE ({})".format(
-        num_images, cfg.TRAIN.BATCH_SIZE
-    )
 
     # Get the input image blob, formatted for caffe
-    im_blob, im_scales = _get_image_blob(roidb, random_scale_inds)
+    im_blob, im_scales, im_shapes = _get_image_blob(roidb, random_scale_inds, image_source)
 
     blobs = {"data": im_blob}
 
-    assert len(im_scales) == 1, "Single batch only"
-    assert len(roidb) == 1, "Single batch only"
-
-    # gt boxes: (x1, y1, x2, y2, cls)
-    if cfg.TRAIN.USE_ALL_GT:
-        # Include all ground truth boxes
-        gt_inds = np.where(roidb[0]["gt_classes"] != 0)[0]
-    else:
-        # For the COCO ground truth boxes, exclude the ones that are ''iscrowd''
-        gt_inds = np.where(
-            (roidb[0]["gt_classes"] != 0)
-            & np.all(roidb[0]["gt_overlaps"].toarray() > -1.0, axis=1)
-        )[0]
-    gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
-    gt_boxes[:, 0:4] = roidb[0]["boxes"][gt_inds, :] * im_scales[0]
-    gt_boxes[:, 4] = roidb[0]["gt_classes"][gt_inds]
-    blobs["gt_boxes"] = gt_boxes
-    blobs["im_info"] = np.array(
-        [[im_blob.shape[1], im_blob.shape[2], im_scales[0]]], dtype=np.float32
-    )
-
-    blobs["img_id"] = roidb[0]["img_id"]
+    # every image keeps its own gt boxes and its own (height, width, scale);
+    # images are only padded to a common size in the blob
+    blobs["gt_boxes"] = []
+    blobs["im_info"] = np.empty((num_images, 3), dtype=np.float32)
+    blobs["img_id"] = []
+    for i in range(num_images):
+        boxes, gt_classes = _get_annotations(roidb[i], image_source)
+        # gt boxes: (x1, y1, x2, y2, cls)
+        if cfg.TRAIN.USE_ALL_GT:
+            # Include all ground truth boxes
+            gt_inds = np.where(gt_classes != 0)[0]
+        else:
+            # For the COCO ground truth boxes, exclude the ones that are ''iscrowd''
+            gt_overlaps = roidb[i]["gt_overlaps"]
+            if scipy.sparse.issparse(gt_overlaps):
+                # a compactRoidb already stores the overlaps dense
+                gt_overlaps = gt_overlaps.toarray()
+            gt_inds = np.where(
+                (gt_classes != 0) & np.all(gt_overlaps > -1.0, axis=1)
+            )[0]
+        gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
+        gt_boxes[:, 0:4] = boxes[gt_inds, :] * im_scales[i]
+        gt_boxes[:, 4] = gt_classes[gt_inds]
+        blobs["gt_boxes"].append(gt_boxes)
+        blobs["im_info"][i] = [im_shapes[i][0], im_shapes[i][1], im_scales[i]]
+        blobs["img_id"].append(roidb[i]["img_id"])
 
     return blobs
 
 
-def _get_image_blob(roidb, scale_inds):
+def _get_annotations(entry, image_source):
+    if isinstance(image_source, packedShards):
+        return image_source.annotations(entry["image"], entry["flipped"])
+    return entry["boxes"], entry["gt_classes"]
+
+
+def _get_image_blob(roidb, scale_inds, image_source=None):
     """Builds an input blob from the images in the roidb at the specified
   scales.
   """
@@ -66,27 +83,48 @@ def _get_image_blob(roidb, scale_inds):
 
     processed_ims = []
     im_scales = []
+    im_shapes = []
+    if image_source is None:
+        image_source = get_image_cache()
     for i in range(num_images):
-        im = cv2.imread(roidb[i]["image"])
-        # im = imread(roidb[i]["image"])
-
-        if len(im.shape) == 2:
-            im = im[:, :, np.newaxis]
-            im = np.concatenate((im, im, im), axis=2)
-        # flip the channel, since the original one using cv2
-        # rgb -> bgr
-        im = im[:, :, ::-1]
-
-        if roidb[i]["flipped"]:
-            im = im[:, ::-1, :]
         target_size = cfg.TRAIN.SCALES[scale_inds[i]]
-        im, im_scale = prep_im_for_blob(
-            im, cfg.PIXEL_MEANS, target_size, cfg.TRAIN.MAX_SIZE
-        )
+        if image_source is not None:
+            im, im_scale = image_source.get(
+                roidb[i]["image"], target_size, roidb[i]["flipped"]
+            )
+            if not cfg.TRAIN.UINT8_PIPELINE:
+                im = im.astype(np.float32)
+                im -= cfg.PIXEL_MEANS
+        elif cfg.TRAIN.UINT8_PIPELINE:
+            im, im_scale = load_resized_image(
+                roidb[i]["image"], target_size, roidb[i]["flipped"]
+            )
+        else:
+            im = cv2.imread(roidb[i]["image"])
+            # im = imread(roidb[i]["image"])
+
+            if len(im.shape) == 2:
+                im = im[:, :, np.newaxis]
+                im = np.concatenate((im, im, im), axis=2)
+            # flip the channel, since the original one using cv2
+            # rgb -> bgr
+            im = im[:, :, ::-1]
+
+            if roidb[i]["flipped"]:
+                im = im[:, ::-1, :]
+            im, im_scale = prep_im_for_blob(
+                im, cfg.PIXEL_MEANS, target_size, cfg.TRAIN.MAX_SIZE
+            )
         im_scales.append(im_scale)
+        im_shapes.append(im.shape[:2])
         processed_ims.append(im)
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    if cfg.TRAIN.UINT8_PIPELINE:
+        blob = im_list_to_blob(
+            processed_ims, np.uint8, pixel_means_as_uint8(cfg.PIXEL_MEANS)
+        )
+    else:
+        blob = im_list_to_blob(processed_ims)
 
-    return blob, im_scales
+    return blob, im_scales, im_shapes
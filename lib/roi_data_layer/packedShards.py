@@ -0,0 +1,158 @@
+"""Training images packed into a few large memory-mapped shard files.
+
+pack_dataset.py writes every image of an imdb, already resized to each
+cfg.TRAIN.SCALES entry, as raw uint8 into shard files of bounded size, and
+saves an index that records where each image starts, along with the gt
+boxes and classes from the roidb. The loader maps the shards read-only and slices each image straight out of the page cache, so
+a worker never opens or decodes a single image file. Flipped roidb entries
+are served as a flipped view of the stored image, with their boxes flipped
+the way imdb.append_flipped_images does.
+
+A packedShards reader has the same get(path, target_size, flipped)
+interface as imageCache, so get_minibatch can use either one.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+
+import numpy as np
+from model.utils.config import cfg
+
+PACK_VERSION = 2
+INDEX_FILE = "index.pkl"
+
+
+def get_packed_dir(imdb_name):
+    """Default location of the shards packed for an imdb."""
+    return os.path.join(cfg.DATA_DIR, "packed", imdb_name)
+
+
+class packedShardWriter(object):
+    """Appends uint8 images to shard files and builds their offset index."""
+
+    def __init__(self, pack_dir, shard_bytes=4 * 1024 ** 3):
+        self.pack_dir = pack_dir
+        self.shard_bytes = int(shard_bytes)
+        if not os.path.exists(pack_dir):
+            os.makedirs(pack_dir)
+        self.index = {
+            "version": PACK_VERSION,
+            "scales": tuple(cfg.TRAIN.SCALES),
+            "shards": [],
+            "images": {},
+            "annotations": {},
+        }
+        self._file = None
+        self._offset = 0
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = "shard_{:04d}.bin".format(len(self.index["shards"]))
+        self.index["shards"].append(name)
+        self._file = open(os.path.join(self.pack_dir, name), "wb")
+        self._offset = 0
+
+    def add(self, path, target_size, im, im_scale):
+        """Store one image resized to target_size for the roidb path."""
+        assert im.dtype == np.uint8 and im.ndim == 3, "expects a HxWxC uint8 image"
+        im = np.ascontiguousarray(im)
+        if self._file is None or (
+            self._offset > 0 and self._offset + im.nbytes > self.shard_bytes
+        ):
+            self._next_shard()
+        self._file.write(im.tobytes())
+        self.index["images"].setdefault(path, {})[int(target_size)] = (
+            len(self.index["shards"]) - 1,
+            self._offset,
+            im.shape,
+            float(im_scale),
+        )
+        self._offset += im.nbytes
+
+    def add_annotations(self, path, boxes, gt_classes, width):
+        """Store the unflipped gt boxes and classes of an image width pixels wide."""
+        self.index["annotations"][path] = (
+            np.asarray(boxes, dtype=np.float32),
+            np.asarray(gt_classes, dtype=np.int32),
+            int(width),
+        )
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(os.path.join(self.pack_dir, INDEX_FILE), "wb") as f:
+            pickle.dump(self.index, f, pickle.HIGHEST_PROTOCOL)
+
+
+class packedShards(object):
+    """Read-only, zero-copy access to the images of a packed dataset."""
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, INDEX_FILE), "rb") as f:
+            self.index = pickle.load(f)
+        assert (
+            self.index["version"] == PACK_VERSION
+        ), "{} was packed with format {}, expected {}; re-run pack_dataset.py".format(
+            pack_dir, self.index["version"], PACK_VERSION
+        )
+        missing = set(cfg.TRAIN.SCALES) - set(self.index["scales"])
+        assert not missing, "{} has no images at scales {}".format(
+            pack_dir, sorted(missing)
+        )
+        self._maps = {}
+
+    def _shard(self, shard_id):
+        shard = self._maps.get(shard_id)
+        if shard is None:
+            # mapped lazily, so every worker process opens its own maps
+            shard = np.memmap(
+                os.path.join(self.pack_dir, self.index["shards"][shard_id]),
+                dtype=np.uint8,
+                mode="r",
+            )
+            self._maps[shard_id] = shard
+        return shard
+
+    def get(self, path, target_size, flipped):
+        try:
+            shard_id, offset, shape, im_scale = self.index["images"][path][
+                int(target_size)
+            ]
+        except KeyError:
+            raise KeyError(
+                "{} at scale {} is not in {}".format(path, target_size, self.pack_dir)
+            )
+        size = int(np.prod(shape))
+        im = self._shard(shard_id)[offset : offset + size].reshape(shape)
+        if flipped:
+            im = im[:, ::-1, :]
+        return im, im_scale
+
+    def annotations(self, path, flipped):
+        """gt boxes and classes of an image, as the roidb entry holds them."""
+        boxes, gt_classes, width = self.index["annotations"][path]
+        if flipped:
+            oldx1 = boxes[:, 0].copy()
+            oldx2 = boxes[:, 2].copy()
+            boxes = boxes.copy()
+            boxes[:, 0] = width - oldx2 - 1
+            boxes[:, 2] = width - oldx1 - 1
+            boxes[boxes[:, 2] < boxes[:, 0], 0] = 0
+        return boxes, gt_classes
+
+    def __contains__(self, path):
+        return path in self.index["images"]
+
+    def __len__(self):
+        return len(self.index["images"])
+
+    def __getstate__(self):
+        # do not ship open maps to spawned workers
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
@@ -3,6 +3,7 @@
 
 import glob
 import os
+import sys
 
 from setuptools import find_packages, setup
 
@@ -24,8 +25,15 @@ def get_extensions():
     extension = CppExtension
 
     extra_compile_args = {"cxx": []}
+    extra_link_args = []
     define_macros = []
 
+    # the CPU kernels split rois and channels over OpenMP threads; Apple's
+    # clang has no OpenMP by default and builds them single threaded
+    if sys.platform != "darwin":
+        extra_compile_args["cxx"] += ["-fopenmp"]
+        extra_link_args += ["-fopenmp"]
+
     if torch.cuda.is_available() and CUDA_HOME is not None:
         extension = CUDAExtension
         sources += source_cuda
@@ -48,6 +56,7 @@ def get_extensions():
             include_dirs=include_dirs,
             define_macros=define_macros,
             extra_compile_args=extra_compile_args,
+            extra_link_args=extra_link_args,
         )
     ]
 
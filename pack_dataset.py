@@ -0,0 +1,101 @@
+# --------------------------------------------------------
+# Pack the training images of an imdb into memory-mapped shards
+# --------------------------------------------------------
+"""Write an imdb into the shard format read by roibatchLoader(packed=...).
+
+Every image is decoded once, resized to each cfg.TRAIN.SCALES entry and
+appended as raw uint8 to data/packed/<imdb_name>/shard_*.bin, and its gt
+boxes and classes go into the shard index. Train with
+--packed to read images and annotations from the shards. Re-run the tool
+whenever the images, the annotations, the image list or TRAIN.SCALES change.
+
+    python pack_dataset.py --imdb cityscape_2007_train_s --cfg cfgs/vgg16.yml
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import pprint
+import time
+
+import _init_paths
+from datasets.factory import get_imdb
+from model.utils.config import cfg, cfg_from_file, cfg_from_list
+from roi_data_layer.imageCache import load_resized_image
+from roi_data_layer.packedShards import get_packed_dir, packedShardWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack a dataset into shards")
+    parser.add_argument(
+        "--imdb",
+        dest="imdb_name",
+        help="imdb to pack, '+' joins several like in the train scripts",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "--cfg", dest="cfg_file", help="optional config file", default=None, type=str
+    )
+    parser.add_argument(
+        "--set",
+        dest="set_cfgs",
+        help="set config keys",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    parser.add_argument(
+        "--out",
+        dest="out_dir",
+        help="output directory, data/packed/<imdb> by default",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--shard_gb",
+        dest="shard_gb",
+        help="maximum size of one shard file in GB",
+        default=4.0,
+        type=float,
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    print("Packing at scales {}".format(pprint.pformat(cfg.TRAIN.SCALES)))
+
+    out_dir = args.out_dir or get_packed_dir(args.imdb_name)
+    writer = packedShardWriter(out_dir, int(args.shard_gb * 1024 ** 3))
+
+    start = time.time()
+    for imdb_name in args.imdb_name.split("+"):
+        imdb = get_imdb(imdb_name)
+        roidb = imdb.roidb
+        widths = imdb._get_widths()
+        print("Packing {} images of {}".format(imdb.num_images, imdb.name))
+        for i in range(imdb.num_images):
+            path = imdb.image_path_at(i)
+            if path in writer.index["images"]:
+                continue
+            for target_size in cfg.TRAIN.SCALES:
+                im, im_scale = load_resized_image(path, target_size, False)
+                writer.add(path, target_size, im, im_scale)
+            writer.add_annotations(
+                path, roidb[i]["boxes"], roidb[i]["gt_classes"], widths[i]
+            )
+            if (i + 1) % 500 == 0:
+                print(
+                    "  {}/{} ({:.1f}s)".format(
+                        i + 1, imdb.num_images, time.time() - start
+                    )
+                )
+    writer.close()
+    print(
+        "Wrote {} images into {} shards in {}".format(
+            len(writer.index["images"]), len(writer.index["shards"]), out_dir
+        )
+    )
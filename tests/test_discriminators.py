@@ -0,0 +1,161 @@
+"""The single-pass image discriminators against the two calls they replace.
+
+Before, the train step ran every discriminator twice: on grad_reverse(x) for
+the domain logits and on x.detach() for the context vector. The gradients
+that reach the backbone and the discriminator weights must not change.
+"""
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from model.da_faster_rcnn import resnet, vgg16
+from model.utils.net_utils import grad_reverse
+
+LAMBD = 0.7
+
+
+def _vgg_pixel(m, x):
+    x = F.relu(x)
+    x = F.relu(m.conv1(x))
+    x = F.relu(m.conv2(x))
+    feat = F.avg_pool2d(x, (x.size(2), x.size(3)))
+    return torch.sigmoid(m.conv3(x)).view(-1, 1), feat
+
+
+def _resnet_pixel(m, x):
+    x = F.relu(m.conv1(x))
+    x = F.relu(m.conv2(x))
+    feat = F.avg_pool2d(x, (x.size(2), x.size(3)))
+    return torch.sigmoid(m.conv3(x)), feat
+
+
+def _global(m, x):
+    x = F.dropout(F.relu(m.bn1(m.conv1(x))), training=m.training)
+    x = F.dropout(F.relu(m.bn2(m.conv2(x))), training=m.training)
+    x = F.dropout(F.relu(m.bn3(m.conv3(x))), training=m.training)
+    x = F.avg_pool2d(x, (x.size(2), x.size(3)))
+    feat = x.view(-1, 128)
+    return m.fc(feat), feat
+
+
+ARCHS = {
+    "vgg16": (vgg16, _vgg_pixel, 512),
+    "res101": (resnet, _resnet_pixel, 1024),
+}
+
+
+def _setup(arch):
+    module, _, base_dim = ARCHS[arch]
+    torch.manual_seed(0)
+    # stand-in for RCNN_base2 between the two discriminators
+    base2 = nn.Conv2d(256, base_dim, 3, stride=2, padding=1).double()
+    d_pixel = module.netD_pixel(context=True).double().eval()
+    d_global = module.netD(context=True).double().eval()
+    base_feat1 = torch.randn(2, 256, 12, 16, dtype=torch.double, requires_grad=True)
+    return base2, d_pixel, d_global, base_feat1
+
+
+def _losses(d_pixel_out, domain_p, feat_pixel, feat):
+    # a domain loss, and a stand-in for the detection loss on the context
+    domain_loss = (d_pixel_out ** 2).mean() + F.cross_entropy(
+        domain_p, torch.tensor([0, 1])
+    )
+    context_loss = (feat_pixel.view(2, -1) ** 3).sum() + (feat ** 3).sum()
+    return domain_loss, context_loss
+
+
+def _single_pass(base2, d_pixel, d_global, base_feat1):
+    base_feat = base2(base_feat1)
+    base_feat.retain_grad()
+    out_pixel, feat_pixel = d_pixel(base_feat1, lambd=LAMBD)
+    domain_p, feat = d_global(base_feat, lambd=LAMBD)
+    return base_feat, _losses(out_pixel, domain_p, feat_pixel, feat)
+
+
+def _two_calls(arch, base2, d_pixel, d_global, base_feat1):
+    pixel = ARCHS[arch][1]
+    base_feat = base2(base_feat1)
+    base_feat.retain_grad()
+    out_pixel, _ = pixel(d_pixel, grad_reverse(base_feat1, LAMBD))
+    _, feat_pixel = pixel(d_pixel, base_feat1.detach())
+    domain_p, _ = _global(d_global, grad_reverse(base_feat, LAMBD))
+    _, feat = _global(d_global, base_feat.detach())
+    return base_feat, _losses(out_pixel, domain_p, feat_pixel, feat)
+
+
+def _grads(tensors):
+    grads = [t.grad.clone() for t in tensors]
+    for t in tensors:
+        t.grad = None
+    return grads
+
+
+@pytest.mark.parametrize("arch", sorted(ARCHS))
+def test_backbone_gradients_match_two_calls(arch):
+    base2, d_pixel, d_global, base_feat1 = _setup(arch)
+
+    base_feat, (domain_loss, context_loss) = _single_pass(
+        base2, d_pixel, d_global, base_feat1
+    )
+    (domain_loss + context_loss).backward()
+    new = _grads([base_feat1, base_feat])
+    params = list(base2.parameters()) + list(d_pixel.parameters())
+    params += list(d_global.parameters())
+    for p in params:
+        p.grad = None
+
+    base_feat, (domain_loss, context_loss) = _two_calls(
+        arch, base2, d_pixel, d_global, base_feat1
+    )
+    (domain_loss + context_loss).backward()
+    old = _grads([base_feat1, base_feat])
+
+    for n, o in zip(new, old):
+        assert torch.allclose(n, o, atol=1e-10)
+
+
+@pytest.mark.parametrize("arch", sorted(ARCHS))
+def test_weight_gradients_match_two_calls(arch):
+    base2, d_pixel, d_global, base_feat1 = _setup(arch)
+    params = list(d_pixel.parameters()) + list(d_global.parameters())
+
+    _, losses = _single_pass(base2, d_pixel, d_global, base_feat1)
+    sum(losses).backward()
+    new = _grads(params)
+
+    _, losses = _two_calls(arch, base2, d_pixel, d_global, base_feat1)
+    sum(losses).backward()
+    old = _grads(params)
+
+    for n, o in zip(new, old):
+        assert torch.allclose(n, o, atol=1e-10)
+
+
+@pytest.mark.parametrize("arch", sorted(ARCHS))
+def test_context_trains_the_discriminator_but_not_the_backbone(arch):
+    base2, d_pixel, d_global, base_feat1 = _setup(arch)
+    base_feat, (_, context_loss) = _single_pass(base2, d_pixel, d_global, base_feat1)
+    context_loss.backward()
+
+    for conv in (d_pixel.conv1, d_pixel.conv2, d_global.conv1, d_global.conv3):
+        assert conv.weight.grad.abs().sum() > 0
+    for t in (base_feat1, base_feat):
+        assert t.grad is None or not t.grad.any()
+
+
+@pytest.mark.parametrize("arch", sorted(ARCHS))
+def test_context_is_cropped(arch):
+    _, d_pixel, _, base_feat1 = _setup(arch)
+    _, cropped = d_pixel(base_feat1, context_crop=lambda h: h[:1, :, :6, :8])
+    _, expected = ARCHS[arch][1](d_pixel, base_feat1[:1, :, :6, :8])
+    assert torch.allclose(cropped, expected)
+
+
+@pytest.mark.parametrize("arch", sorted(ARCHS))
+def test_context_vector_matches_forward(arch):
+    # detect() takes the context from the trunks alone
+    base2, d_pixel, d_global, base_feat1 = _setup(arch)
+    base_feat = base2(base_feat1)
+    with torch.no_grad():
+        assert torch.equal(d_pixel.context_vector(base_feat1), d_pixel(base_feat1)[1])
+        assert torch.equal(d_global.context_vector(base_feat), d_global(base_feat)[1])
@@ -0,0 +1,30 @@
+"""Images and annotations read back from packed shards."""
+import numpy as np
+from model.utils.config import cfg
+from roi_data_layer.packedShards import packedShards, packedShardWriter
+
+
+def test_annotations_round_trip_and_flip(tmp_path):
+    boxes = np.array([[10.5, 4.0, 30.25, 20.0], [0.0, 1.0, 63.0, 47.0]])
+    gt_classes = np.array([3, 1])
+    im = np.arange(48 * 64 * 3, dtype=np.uint8).reshape(48, 64, 3)
+
+    writer = packedShardWriter(str(tmp_path))
+    for target_size in cfg.TRAIN.SCALES:
+        writer.add("a.jpg", target_size, im, 1.0)
+    writer.add_annotations("a.jpg", boxes, gt_classes, 64)
+    writer.close()
+    shards = packedShards(str(tmp_path))
+
+    out_boxes, out_classes = shards.annotations("a.jpg", False)
+    # float coordinates survive, unlike the old uint16 index
+    assert np.array_equal(out_boxes, boxes.astype(np.float32))
+    assert np.array_equal(out_classes, gt_classes)
+
+    flipped, _ = shards.annotations("a.jpg", True)
+    # the boxes imdb.append_flipped_images builds for a 64 pixel wide image
+    expected = np.array([[32.75, 4.0, 52.5, 20.0], [0.0, 1.0, 63.0, 47.0]])
+    assert np.array_equal(flipped, expected.astype(np.float32))
+    assert np.array_equal(shards.annotations("a.jpg", False)[0], out_boxes)
+    im_out, _ = shards.get("a.jpg", cfg.TRAIN.SCALES[0], True)
+    assert np.array_equal(im_out, im[:, ::-1])
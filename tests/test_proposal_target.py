@@ -0,0 +1,56 @@
+"""Batched roi sampling of the proposal target layer."""
+import pytest
+import torch
+from model.rpn.proposal_target_layer_cascade import _ProposalTargetLayer
+from model.utils.config import cfg
+
+
+@pytest.fixture
+def train_cfg():
+    saved = dict(cfg.TRAIN)
+    cfg.TRAIN.BATCH_SIZE = 16
+    cfg.TRAIN.RPN_POST_NMS_TOP_N = 8
+    yield cfg.TRAIN
+    cfg.TRAIN.update(saved)
+
+
+def _batch(gt_per_image):
+    # four proposals per image around (10, 10, 50, 50), packed by image
+    rois = []
+    for i in range(len(gt_per_image)):
+        for shift in (0, 2, 30, 60):
+            rois.append([i, 10 + shift, 10, 50 + shift, 50])
+    rois = torch.tensor(rois, dtype=torch.float)
+    num_rois = torch.full((len(gt_per_image),), 4, dtype=torch.long)
+    gt_boxes = torch.zeros(len(gt_per_image), 3, 5)
+    for i, boxes in enumerate(gt_per_image):
+        if boxes:
+            gt_boxes[i, : len(boxes)] = torch.tensor(boxes, dtype=torch.float)
+    num_boxes = torch.tensor([len(boxes) for boxes in gt_per_image])
+    return rois, num_rois, gt_boxes, num_boxes
+
+
+def test_samples_a_static_number_of_rois_per_image(train_cfg):
+    torch.manual_seed(0)
+    layer = _ProposalTargetLayer(3)
+    rois, labels, targets, inside_ws, outside_ws = layer(
+        *_batch([[[10, 10, 50, 50, 2]], [[70, 10, 110, 50, 1], [0, 0, 5, 5, 2]]])
+    )
+    assert rois.shape == (2, 16, 5)
+    assert labels.shape == (2, 16)
+    assert torch.equal(rois[:, :, 0], torch.tensor([[0.0], [1.0]]).expand(2, 16))
+    # the fg rois come first and carry their gt class and box targets
+    for i in range(2):
+        fg = labels[i] > 0
+        assert fg.any() and (~fg).any()
+        assert not fg[fg.long().argmin() :].any()
+        assert torch.equal(outside_ws[i].sum(1) > 0, fg)
+    assert set(labels[0].tolist()) <= {0, 2}
+
+
+def test_image_without_fg_or_bg_candidates_raises(train_cfg):
+    # no gt box, and every proposal overlaps nothing, below BG_THRESH_LO
+    train_cfg.BG_THRESH_LO = 0.1
+    layer = _ProposalTargetLayer(3)
+    with pytest.raises(ValueError):
+        layer(*_batch([[[10, 10, 50, 50, 2]], []]))
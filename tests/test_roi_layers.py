@@ -0,0 +1,108 @@
+"""The CPU kernels of the _C extension against plain torch references."""
+import math
+
+import pytest
+import torch
+from torch.autograd import gradcheck
+from model.roi_layers import ROIPool, nms, roi_align, roi_pool
+
+SCALE = 1.0 / 4.0
+
+
+def _inputs(dtype=torch.double, num_rois=6):
+    torch.manual_seed(0)
+    feat = torch.randn(2, 3, 10, 12, dtype=dtype, requires_grad=True)
+    # (batch index, x1, y1, x2, y2) in image coordinates, a few past the border
+    xy1 = torch.rand(num_rois, 2, dtype=dtype) * 32
+    wh = torch.rand(num_rois, 2, dtype=dtype) * 24 + 1
+    ids = torch.arange(num_rois, dtype=dtype).remainder(2).view(-1, 1)
+    rois = torch.cat([ids, xy1, xy1 + wh], 1)
+    return feat, rois
+
+
+def _roi_pool_reference(feat, rois, size, scale):
+    out = feat.new_zeros(rois.size(0), feat.size(1), size, size)
+    height, width = feat.shape[2:]
+    for n, (b, x1, y1, x2, y2) in enumerate(rois.tolist()):
+        x1, y1, x2, y2 = (int(round(v * scale)) for v in (x1, y1, x2, y2))
+        bin_h = max(y2 - y1 + 1, 1) / size
+        bin_w = max(x2 - x1 + 1, 1) / size
+        for ph in range(size):
+            h0 = min(max(math.floor(ph * bin_h) + y1, 0), height)
+            h1 = min(max(math.ceil((ph + 1) * bin_h) + y1, 0), height)
+            for pw in range(size):
+                w0 = min(max(math.floor(pw * bin_w) + x1, 0), width)
+                w1 = min(max(math.ceil((pw + 1) * bin_w) + x1, 0), width)
+                if h1 > h0 and w1 > w0:
+                    region = feat[int(b), :, h0:h1, w0:w1]
+                    out[n, :, ph, pw] = region.amax(dim=(1, 2))
+    return out
+
+
+def _nms_reference(dets, scores, thresh):
+    areas = (dets[:, 2] - dets[:, 0] + 1) * (dets[:, 3] - dets[:, 1] + 1)
+    suppressed = torch.zeros(dets.size(0), dtype=torch.bool)
+    keep = []
+    for i in scores.argsort(descending=True, stable=True).tolist():
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        w = torch.min(dets[i, 2], dets[:, 2]) - torch.max(dets[i, 0], dets[:, 0])
+        h = torch.min(dets[i, 3], dets[:, 3]) - torch.max(dets[i, 1], dets[:, 1])
+        inter = (w + 1).clamp(min=0) * (h + 1).clamp(min=0)
+        suppressed |= inter / (areas[i] + areas - inter) >= thresh
+    return torch.tensor(sorted(keep))
+
+
+@pytest.mark.parametrize("dtype", [torch.float, torch.double])
+def test_roi_pool_forward_matches_reference(dtype):
+    feat, rois = _inputs(dtype)
+    out = roi_pool(feat, rois, (3, 3), SCALE)
+    assert torch.equal(out, _roi_pool_reference(feat.detach(), rois, 3, SCALE))
+
+
+def test_roi_pool_backward_gradcheck():
+    feat, rois = _inputs()
+    assert gradcheck(lambda x: roi_pool(x, rois, (3, 3), SCALE), (feat,))
+
+
+def test_roi_pool_module_trains_on_cpu():
+    # POOLING_MODE pool, the layer _fasterRCNN builds, on cpu tensors
+    feat, rois = _inputs(torch.float)
+    pooled = ROIPool((7, 7), SCALE)(feat, rois)
+    pooled.sum().backward()
+    assert pooled.shape == (rois.size(0), 3, 7, 7)
+    assert feat.grad.abs().sum() > 0
+
+
+@pytest.mark.parametrize("sampling_ratio", [0, 2])
+def test_roi_align_forward_matches_torchvision(sampling_ratio):
+    ops = pytest.importorskip("torchvision.ops")
+    feat, rois = _inputs()
+    out = roi_align(feat, rois, (3, 3), SCALE, sampling_ratio)
+    expected = ops.roi_align(feat, rois, (3, 3), SCALE, sampling_ratio, aligned=False)
+    assert torch.allclose(out, expected)
+
+
+@pytest.mark.parametrize("sampling_ratio", [0, 2])
+def test_roi_align_backward_gradcheck(sampling_ratio):
+    feat, rois = _inputs()
+    assert gradcheck(
+        lambda x: roi_align(x, rois, (3, 3), SCALE, sampling_ratio), (feat,)
+    )
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_nms_keep_matches_serial(num_threads):
+    torch.manual_seed(0)
+    # enough crowded boxes that the parallel inner loop runs
+    xy1 = torch.rand(3000, 2) * 200
+    dets = torch.cat([xy1, xy1 + torch.rand(3000, 2) * 60 + 5], 1)
+    scores = torch.rand(3000)
+    threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        keep = nms(dets, scores, 0.5)
+    finally:
+        torch.set_num_threads(threads)
+    assert torch.equal(keep.sort()[0], _nms_reference(dets, scores, 0.5))
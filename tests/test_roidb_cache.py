@@ -0,0 +1,48 @@
+"""The gt roidb round trip through the npz cache."""
+import numpy as np
+import scipy.sparse
+from datasets.imdb import _load_roidb_arrays, _save_roidb_arrays
+
+
+def _voc_entry(num_objs, size, num_classes=4):
+    # the fields pascal_voc._load_pascal_annotation returns
+    rng = np.random.RandomState(num_objs)
+    overlaps = np.zeros((num_objs, num_classes), dtype=np.float32)
+    gt_classes = rng.randint(1, num_classes, num_objs).astype(np.int32)
+    overlaps[np.arange(num_objs), gt_classes] = 1.0
+    return {
+        "boxes": rng.randint(0, 300, (num_objs, 4)).astype(np.uint16),
+        "gt_classes": gt_classes,
+        "gt_ishard": rng.randint(0, 2, num_objs).astype(np.int32),
+        "gt_overlaps": scipy.sparse.csr_matrix(overlaps),
+        "flipped": False,
+        "seg_areas": rng.rand(num_objs).astype(np.float32),
+        "seg_map": rng.rand(*size),
+    }
+
+
+def test_voc_roidb_round_trip(tmp_path):
+    # seg_map is per image: sizes differ, and one image has as many rows in
+    # its map as another has boxes
+    roidb = [
+        _voc_entry(3, (375, 500)),
+        _voc_entry(0, (333, 500)),
+        _voc_entry(2, (3, 4)),
+        _voc_entry(5, (2, 6)),
+    ]
+    cache_file = str(tmp_path / "voc_gt_roidb.npz")
+    assert _save_roidb_arrays(cache_file, roidb, "sig")
+
+    assert _load_roidb_arrays(cache_file, "other") is None
+    cached = _load_roidb_arrays(cache_file, "sig")
+    assert len(cached) == len(roidb)
+    for entry, expected in zip(cached, roidb):
+        assert sorted(entry) == sorted(expected)
+        for key, value in expected.items():
+            if scipy.sparse.issparse(value):
+                assert np.array_equal(entry[key].toarray(), value.toarray())
+            elif isinstance(value, np.ndarray):
+                assert entry[key].dtype == value.dtype
+                assert np.array_equal(entry[key], value)
+            else:
+                assert entry[key] == value